@@ -1,4 +1,5 @@
-from .dgcnn import DGCNN
-from .pointtrans import PointTransformer
-from .egnn import EGNN
-from .model_utils import GINConv
+from utils.registry import lazy_getattr
+
+_modules = {'DGCNN': '.dgcnn', 'PointTransformer': '.pointtrans', 'EGNN': '.egnn', 'GINConv': '.model_utils'}
+__all__ = list(_modules)
+__getattr__ = lazy_getattr(__name__, _modules)
@@ -0,0 +1,35 @@
+from contextlib import contextmanager
+import torch
+from torch.nn.modules.batchnorm import _BatchNorm
+from torch.utils.checkpoint import checkpoint
+
+
+def use_checkpoint(backbone):
+    # activation checkpointing only matters when activations are stored for backward
+    return backbone.model_config.get('checkpoint_layers', False) and backbone.training and torch.is_grad_enabled()
+
+
+@contextmanager
+def frozen_norm_stats(module):
+    # momentum 0 keeps the running statistics of batch norms unchanged while the forward pass is replayed
+    norms = [m for m in module.modules() if isinstance(m, _BatchNorm) and m.momentum is not None]
+    momentums = [m.momentum for m in norms]
+    for m in norms:
+        m.momentum = 0.0
+    try:
+        yield
+    finally:
+        for m, momentum in zip(norms, momentums):
+            m.momentum = momentum
+
+
+def checkpoint_layer(module, fn, *args):
+    # the activations of fn(*args) are recomputed in backward instead of stored. With reentrant checkpointing the
+    # first pass runs without grad and the replay in backward with grad, which must not update batch norms again;
+    # dropout masks are the same in both passes since the RNG state is restored for the replay
+    def run(*args):
+        if torch.is_grad_enabled():
+            with frozen_norm_stats(module):
+                return fn(*args)
+        return fn(*args)
+    return checkpoint(run, *args, use_reentrant=True)
@@ -0,0 +1,50 @@
+import math
+import weakref
+import torch
+
+# backbone -> {shape bucket: compiled layer stack, or None if compiling that bucket failed}
+_compiled = weakref.WeakKeyDictionary()
+
+
+def shape_bucket(x, edge_index, *optional):
+    # compiled graphs are specialized on which optional inputs are given and on grad mode; node and edge counts
+    # are dynamic within a power-of-two bucket, which bounds the number of recompilations when graph sizes vary
+    n_bucket = math.ceil(math.log2(max(x.shape[0], 1)))
+    e_bucket = math.ceil(math.log2(max(edge_index.shape[1], 1)))
+    return (x.device, x.dtype, torch.is_grad_enabled(), n_bucket, e_bucket) + tuple(t is None for t in optional)
+
+
+def compile_errors():
+    # errors of dynamo and of the compiler backends (wrapped in BackendCompilerFailed); any other error is raised as is,
+    # rather than being taken for a compile failure and running the layers a second time eagerly
+    import torch._dynamo.exc as exc
+    return tuple(getattr(exc, name) for name in ['TorchDynamoException', 'BackendCompilerFailed'] if hasattr(exc, name))
+
+
+def run_layers(backbone, x, pos, edge_attr, edge_index, batch, edge_attn=None, ptr=None):
+    # opt-in (model_config['compile']) torch.compile of backbone.layers_forward, i.e. the message passing layers after
+    # the encoders and the edge preprocessing; graph construction (Model.calc_geo_feat) and the structure cache stay
+    # eager. Falls back to eager without torch.compile, with hooks (GradCAM, GNNLRP), in training and when compiling fails.
+    args = (x, pos, edge_attr, edge_index, batch, edge_attn, ptr)
+    modules = list(backbone.modules())
+    if not backbone.model_config.get('compile', False) or not hasattr(torch, 'compile') or backbone.training \
+            or any(len(m._forward_hooks) > 0 or len(m._forward_pre_hooks) > 0 for m in modules):
+        return backbone.layers_forward(*args)
+
+    cache = _compiled.setdefault(backbone, {})
+    key = shape_bucket(x, edge_index, edge_attr, edge_attn, ptr)
+    if key not in cache:
+        cache[key] = torch.compile(type(backbone).layers_forward, dynamic=True, mode=backbone.model_config.get('compile_mode', None))
+    if cache[key] is None:
+        return backbone.layers_forward(*args)
+
+    try:
+        return cache[key](backbone, *args)
+    except compile_errors() as e:
+        print(f'[WARNING] Compiling {type(backbone).__name__} failed for bucket {key}, running it eagerly: {e}')
+        cache[key] = None
+        return backbone.layers_forward(*args)
+
+
+def clear_compiled(backbone):
+    _compiled.pop(backbone, None)
@@ -0,0 +1,54 @@
+import torch
+import torch.nn as nn
+from torch_geometric.utils import to_dense_batch, to_dense_adj
+
+
+def use_dense(model_config, batch, edge_index, modules):
+    # pack small graphs into padded [B, Nmax, H] tensors and run message passing with batched dense ops.
+    # modules with hooks (e.g. GradCAM, GNNLRP tracking activations) always run the sparse path.
+    dense_mode = model_config.get('dense_mode', 'auto')
+    if dense_mode == 'never' or any(len(m._forward_hooks) > 0 or len(m._forward_pre_hooks) > 0 for m in modules):
+        return False
+    if dense_mode == 'always':
+        return True
+
+    # the dense path computes messages for all B * Nmax^2 pairs, which only pays off where the per-edge indexing
+    # overhead dominates (small graphs on GPU); on CPU it is compute bound and the sparse path is faster. A single
+    # graph without a batch vector (e.g. PGMExplainer on graphs from to_data_list()) has nothing to pack
+    if batch is None or batch.device.type != 'cuda':
+        return False
+    num_nodes = torch.bincount(batch)
+    max_num_nodes = num_nodes.max().item()
+    fill = edge_index.shape[1] / (num_nodes.shape[0] * max_num_nodes ** 2)
+    return max_num_nodes <= model_config.get('dense_max_nodes', 32) and fill >= model_config.get('dense_min_fill', 0.25)
+
+
+def to_dense_graph(x, pos, edge_index, batch, edge_attr=None, edge_attn=None, target_first=False):
+    # adj[b, i, j] is True if there is an edge i -> j, or j -> i with target_first (i.e. rows are the aggregating nodes).
+    # graphs from knn_graph/radius_graph have no duplicate edges, so dense edge features hold exactly one edge per entry.
+    x, mask = to_dense_batch(x, batch)
+    pos, _ = to_dense_batch(pos, batch)
+    max_num_nodes = x.shape[1]
+    edge_index = edge_index.flip(0) if target_first else edge_index
+    adj = to_dense_adj(edge_index, batch, max_num_nodes=max_num_nodes) > 0
+    edge_attr = to_dense_adj(edge_index, batch, edge_attr, max_num_nodes=max_num_nodes) if edge_attr is not None else None
+    edge_attn = to_dense_adj(edge_index, batch, edge_attn.view(-1, 1), max_num_nodes=max_num_nodes) if edge_attn is not None else None
+    return x, pos, mask, adj, edge_attr, edge_attn
+
+
+def masked_apply(module, x, mask):
+    # apply module only to the valid entries of a padded tensor, e.g. for norms whose statistics must ignore padding
+    valid = module(x[mask])
+    out = x.new_zeros(x.shape[:-1] + valid.shape[-1:])
+    out[mask] = valid
+    return out
+
+
+def apply_sequential(layers, x, mask):
+    # elementwise layers run on the whole padded tensor, anything else (norms) only on the valid entries
+    for layer in layers:
+        if isinstance(layer, (nn.Linear, nn.ReLU, nn.SiLU, nn.Identity, nn.Dropout)):
+            x = layer(x)
+        else:
+            x = masked_apply(layer, x, mask)
+    return x
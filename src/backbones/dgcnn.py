@@ -1,7 +1,7 @@
 # https://github.com/pyg-team/pytorch_geometric/blob/master/examples/dgcnn_classification.py
 
 from torch import Tensor
-from typing import Callable, Union
+from typing import Callable, Optional, Union
 from torch_geometric.typing import OptTensor, PairOptTensor, PairTensor
 
 import torch
@@ -12,6 +12,11 @@ from torch_geometric.nn.inits import reset
 from torch_geometric.nn.conv import MessagePassing
 
 from utils import FeatEncoder, MLP
+from .dense_utils import use_dense, to_dense_graph, apply_sequential, masked_apply
+from .compile_utils import run_layers
+from .checkpoint_utils import use_checkpoint, checkpoint_layer
+from .segment_utils import StructureCache, gather_edges
+from torch_scatter import segment_csr
 
 
 class DGCNN(torch.nn.Module):
@@ -25,16 +30,20 @@ class DGCNN(torch.nn.Module):
         self.pos_dim = pos_dim
 
         self.dropout_p = model_config['dropout_p']
+        self.model_config = model_config
         norm_type = model_config['norm_type']
         act_type = model_config['act_type']
 
-        self.node_encoder = FeatEncoder(hidden_size, feat_info['node_categorical_feat'], feat_info['node_scalar_feat'], n_categorical_feat_to_use, n_scalar_feat_to_use)
+        self.node_encoder = FeatEncoder(hidden_size, feat_info['node_categorical_feat'], feat_info['node_scalar_feat'], n_categorical_feat_to_use, n_scalar_feat_to_use,
+                                        fold_dim_mapping=model_config.get('fold_feat_encoder', False))
         self.edge_encoder = FeatEncoder(hidden_size, feat_info['edge_categorical_feat'], feat_info['edge_scalar_feat'])
 
+        factorize = model_config.get('factorize_edge_mlp', False)
         self.convs = torch.nn.ModuleList()
         for _ in range(self.n_layers):
             mlp = MLP([hidden_size*3, hidden_size*2, hidden_size], 0.0, norm_type, act_type)
-            self.convs.append(EdgeConv(mlp, hidden_size, norm_type, act_type, aggr='mean'))
+            self.convs.append(EdgeConv(mlp, hidden_size, norm_type, act_type, aggr='mean', factorize=factorize))
+        self.structure_cache = StructureCache(dim=1)
 
     def forward(self, x, pos, edge_attr, edge_index, batch, edge_attn=None):
         if self.x_dim == 0 and self.pos_dim != 0:
@@ -48,12 +57,39 @@ class DGCNN(torch.nn.Module):
 
         x = self.node_encoder(feats)
         edge_attr = self.edge_encoder(edge_attr)
+        if use_dense(self.model_config, batch, edge_index, self.convs):
+            return self.dense_forward(x, pos, edge_attr, edge_index, batch, edge_attn)
+
+        # EdgeConv aggregates at the targets edge_index[1]
+        ptr = None
+        if self.model_config.get('sorted_aggregation', True):
+            edge_index, ptr, eid = self.structure_cache(edge_index, x.shape[0])
+            edge_attr, edge_attn = gather_edges(eid, edge_attr, edge_attn)
+
+        return run_layers(self, x, pos, edge_attr, edge_index, batch, edge_attn, ptr)
+
+    def layers_forward(self, x, pos, edge_attr, edge_index, batch, edge_attn=None, ptr=None):
+        for i in range(self.n_layers):
+            if use_checkpoint(self):
+                x = checkpoint_layer(self, self.layer_forward, i, x, pos, edge_attr, edge_index, batch, edge_attn, ptr)
+            else:
+                x = self.layer_forward(i, x, pos, edge_attr, edge_index, batch, edge_attn, ptr)
+        return x
+
+    def layer_forward(self, i, x, pos, edge_attr, edge_index, batch, edge_attn=None, ptr=None):
+        identity = x
+        x = self.convs[i](x, edge_index, batch=batch, edge_attr=edge_attr, edge_attn=edge_attn, ptr=ptr)
+        x = x + identity
+        return F.dropout(x, self.dropout_p, training=self.training)
+
+    def dense_forward(self, x, pos, edge_attr, edge_index, batch, edge_attn=None):
+        x, _, mask, adj, edge_attr, edge_attn = to_dense_graph(x, pos, edge_index, batch, edge_attr, edge_attn, target_first=True)
         for i in range(self.n_layers):
             identity = x
-            x = self.convs[i](x, edge_index, batch=batch, edge_attr=edge_attr, edge_attn=edge_attn)
+            x = self.convs[i].dense_forward(x, mask, adj, edge_attr=edge_attr, edge_attn=edge_attn)
             x = x + identity
             x = F.dropout(x, self.dropout_p, training=self.training)
-        return x
+        return x[mask]
 
 
 class EdgeConv(MessagePassing):
@@ -87,10 +123,11 @@ class EdgeConv(MessagePassing):
         - **output:** node features :math:`(|\mathcal{V}|, F_{out})` or
           :math:`(|\mathcal{V}_t|, F_{out})` if bipartite
     """
-    def __init__(self, nn: Callable, hidden_size, norm_type, act_type, aggr: str = 'max', **kwargs):
+    def __init__(self, nn: Callable, hidden_size, norm_type, act_type, aggr: str = 'max', factorize=False, **kwargs):
         super().__init__(aggr=aggr, flow='source_to_target', **kwargs)
 
         self.nn = nn
+        self.factorize = factorize
         self.post_nn = Linear(hidden_size, hidden_size)
         self.act_fn = MLP.get_act(act_type)()
         self.norm = MLP.get_norm(norm_type)(hidden_size)
@@ -101,7 +138,7 @@ class EdgeConv(MessagePassing):
 
     def forward(
             self, x: Union[Tensor, PairTensor], edge_index,
-            batch, edge_attr=None, edge_attn=None) -> Tensor:
+            batch, edge_attr=None, edge_attn=None, ptr=None) -> Tensor:
         # type: (Tensor, OptTensor) -> Tensor  # noqa
         # type: (PairTensor, Optional[PairTensor]) -> Tensor  # noqa
         """"""
@@ -118,18 +155,51 @@ class EdgeConv(MessagePassing):
             assert batch is not None
             b = (batch[0], batch[1])
 
+        if self.factorize:
+            # nn[0](cat([x_i, x_j - x_i, e])) = (W_1 - W_2) x_i + W_2 x_j + W_3 e + b, so the node parts are projected
+            # once per node here and message() only gathers them and adds the projected edge features
+            lin, nf = self.nn[0], x[0].shape[1]
+            w_i, w_j = lin.weight[:, :nf] - lin.weight[:, nf:2 * nf], lin.weight[:, nf:2 * nf]
+            x = (F.linear(x[0], w_j), F.linear(x[1], w_i, lin.bias))
+
         # propagate_type: (x: PairTensor)
-        out = self.propagate(edge_index, x=x, size=None, edge_attr=edge_attr, edge_attn=edge_attn)
+        out = self.propagate(edge_index, x=x, size=None, edge_attr=edge_attr, edge_attn=edge_attn, edge_ptr=ptr)
         out = self.post_nn(out)
         out = self.act_fn(self.norm(out))
         return out
 
+    def dense_forward(self, x, mask, adj, edge_attr, edge_attn=None):
+        # padded version of forward with mean aggregation: x [B, N, H], adj [B, N, N] with adj[b, target, source]
+        lin, nf = self.nn[0], x.shape[-1]
+        w_i, w_j = lin.weight[:, :nf] - lin.weight[:, nf:2 * nf], lin.weight[:, nf:2 * nf]
+        msg = F.linear(x, w_i, lin.bias).unsqueeze(2) + F.linear(x, w_j).unsqueeze(1) + F.linear(edge_attr, lin.weight[:, 2 * nf:])
+        msg = apply_sequential(list(self.nn)[1:], msg, adj)
+        if edge_attn is not None:
+            msg = msg * edge_attn
+
+        adj = adj.unsqueeze(-1)
+        out = (msg * adj).sum(dim=2) / adj.sum(dim=2).clamp(min=1)
+        out = self.post_nn(out)
+        return self.act_fn(masked_apply(self.norm, out, mask))
+
     def message(self, x_i: Tensor, x_j: Tensor, edge_attr, edge_attn) -> Tensor:
-        msg = self.nn(torch.cat([x_i, x_j - x_i, edge_attr], dim=-1))
+        if self.factorize:
+            lin = self.nn[0]
+            msg = x_i + x_j + F.linear(edge_attr, lin.weight[:, -edge_attr.shape[1]:])
+            for layer in list(self.nn)[1:]:
+                msg = layer(msg)
+        else:
+            msg = self.nn(torch.cat([x_i, x_j - x_i, edge_attr], dim=-1))
         if edge_attn is not None:
             return msg * edge_attn
         else:
             return msg
 
+    def aggregate(self, inputs: Tensor, index: Tensor, ptr: OptTensor = None, dim_size: Optional[int] = None, edge_ptr=None) -> Tensor:
+        # edge_ptr: CSR pointer of the targets if edge_index is sorted by them (see edge_structure)
+        if edge_ptr is not None:
+            return segment_csr(inputs, edge_ptr, reduce=self.aggr)
+        return super().aggregate(inputs, index, ptr=ptr, dim_size=dim_size)
+
     def __repr__(self) -> str:
         return f'{self.__class__.__name__}(nn={self.nn}, k={self.k})'
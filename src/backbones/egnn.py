@@ -5,6 +5,10 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 from utils import FeatEncoder, MLP
+from .dense_utils import use_dense, to_dense_graph, masked_apply
+from .compile_utils import run_layers
+from .checkpoint_utils import use_checkpoint, checkpoint_layer
+from .segment_utils import StructureCache, gather_edges, sorted_segment_sum, sorted_segment_mean
 
 
 class EGNN(nn.Module):
@@ -17,17 +21,21 @@ class EGNN(nn.Module):
         self.pos_dim = pos_dim
         self.dropout_p = model_config['dropout_p']
         self.dataset_name = kwargs['aux_info']['dataset_name']
+        self.model_config = model_config
         act_fn = MLP.get_act(model_config['act_type'])()
         norm_type = model_config['norm_type']
 
-        self.node_encoder = FeatEncoder(hidden_size, feat_info['node_categorical_feat'], feat_info['node_scalar_feat'], n_categorical_feat_to_use, n_scalar_feat_to_use)
+        self.node_encoder = FeatEncoder(hidden_size, feat_info['node_categorical_feat'], feat_info['node_scalar_feat'], n_categorical_feat_to_use, n_scalar_feat_to_use,
+                                        fold_dim_mapping=model_config.get('fold_feat_encoder', False))
         self.edge_encoder = FeatEncoder(hidden_size, feat_info['edge_categorical_feat'], feat_info['edge_scalar_feat'])
 
         edges_in_d = hidden_size if 'acts' in self.dataset_name else 0
+        factorize = model_config.get('factorize_edge_mlp', False)
         self.convs = nn.ModuleList()
         for _ in range(self.n_layers):
-            conv = E_GCL_mask(hidden_size, hidden_size, hidden_size, edges_in_d=edges_in_d, nodes_attr_dim=0, act_fn=act_fn, norm_type=norm_type, recurrent=False, coords_weight=1.0, attention=False)
+            conv = E_GCL_mask(hidden_size, hidden_size, hidden_size, edges_in_d=edges_in_d, nodes_attr_dim=0, act_fn=act_fn, norm_type=norm_type, recurrent=False, coords_weight=1.0, attention=False, factorize=factorize)
             self.convs.append(conv)
+        self.structure_cache = StructureCache(dim=0)
 
     def forward(self, x, pos, edge_attr, edge_index, batch, edge_attn=None):
         if self.x_dim == 0 and self.pos_dim != 0:
@@ -41,12 +49,39 @@ class EGNN(nn.Module):
 
         x = self.node_encoder(feats)
         edge_attr = self.edge_encoder(edge_attr) if 'acts' in self.dataset_name else None
+        if use_dense(self.model_config, batch, edge_index, self.convs):
+            return self.dense_forward(x, pos, edge_attr, edge_index, batch, edge_attn)
+
+        # E_GCL aggregates at row = edge_index[0]
+        ptr = None
+        if self.model_config.get('sorted_aggregation', True):
+            edge_index, ptr, eid = self.structure_cache(edge_index, x.shape[0])
+            edge_attr, edge_attn = gather_edges(eid, edge_attr, edge_attn)
+
+        return run_layers(self, x, pos, edge_attr, edge_index, batch, edge_attn, ptr)
+
+    def layers_forward(self, x, pos, edge_attr, edge_index, batch, edge_attn=None, ptr=None):
+        for i in range(self.n_layers):
+            if use_checkpoint(self):
+                x = checkpoint_layer(self, self.layer_forward, i, x, pos, edge_attr, edge_index, batch, edge_attn, ptr)
+            else:
+                x = self.layer_forward(i, x, pos, edge_attr, edge_index, batch, edge_attn, ptr)
+        return x
+
+    def layer_forward(self, i, x, pos, edge_attr, edge_index, batch, edge_attn=None, ptr=None):
+        identity = x
+        x, _, _ = self.convs[i](x, edge_index, pos, batch=batch, edge_attr=edge_attr, edge_attn=edge_attn, ptr=ptr)
+        x = x + identity
+        return F.dropout(x, self.dropout_p, training=self.training)
+
+    def dense_forward(self, x, pos, edge_attr, edge_index, batch, edge_attn=None):
+        x, pos, mask, adj, edge_attr, edge_attn = to_dense_graph(x, pos, edge_index, batch, edge_attr, edge_attn)
         for i in range(self.n_layers):
             identity = x
-            x, _, _ = self.convs[i](x, edge_index, pos, batch=batch, edge_attr=edge_attr, edge_attn=edge_attn)
+            x = self.convs[i].dense_forward(x, pos, mask, adj, edge_attr=edge_attr, edge_attn=edge_attn)
             x = x + identity
             x = F.dropout(x, self.dropout_p, training=self.training)
-        return x
+        return x[mask]
 
 
 class E_GCL(nn.Module):
@@ -114,9 +149,26 @@ class E_GCL(nn.Module):
             out = out * att_val
         return out
 
-    def node_model(self, x, edge_index, edge_attr, node_attr):
+    def factorized_edge_model(self, h, edge_index, radial, edge_attr):
+        # same as edge_model(h[row], h[col], radial, edge_attr), but the first linear layer of edge_mlp is applied
+        # to h once per node and the projections are gathered per edge, instead of projecting [h[row], h[col]] per edge
+        row, col = edge_index
+        lin, nf = self.edge_mlp[0], h.shape[1]
+        h_source, h_target = F.linear(h, torch.cat([lin.weight[:, :nf], lin.weight[:, nf:2 * nf]], dim=0)).chunk(2, dim=1)
+        edge_in = radial if edge_attr is None else torch.cat([radial, edge_attr], dim=1)
+        out = h_source[row] + h_target[col] + F.linear(edge_in, lin.weight[:, 2 * nf:], lin.bias)
+        out = self.edge_mlp[1:](out)
+        if self.attention:
+            att_val = self.att_mlp(out)
+            out = out * att_val
+        return out
+
+    def node_model(self, x, edge_index, edge_attr, node_attr, ptr=None):
         row, col = edge_index
-        agg = unsorted_segment_sum(edge_attr, row, num_segments=x.size(0))
+        if ptr is not None:
+            agg = sorted_segment_sum(edge_attr, ptr)
+        else:
+            agg = unsorted_segment_sum(edge_attr, row, num_segments=x.size(0))
         if node_attr is not None:
             agg = torch.cat([x, agg, node_attr], dim=1)
         else:
@@ -126,11 +178,14 @@ class E_GCL(nn.Module):
         #     out = x + out
         return out, agg
 
-    def coord_model(self, coord, edge_index, coord_diff, edge_feat):
+    def coord_model(self, coord, edge_index, coord_diff, edge_feat, ptr=None):
         row, col = edge_index
         trans = coord_diff * self.coord_mlp(edge_feat)
         trans = torch.clamp(trans, min=-100, max=100) #This is never activated but just in case it case it explosed it may save the train
-        agg = unsorted_segment_mean(trans, row, num_segments=coord.size(0))
+        if ptr is not None:
+            agg = sorted_segment_mean(trans, ptr)
+        else:
+            agg = unsorted_segment_mean(trans, row, num_segments=coord.size(0))
         coord += agg*self.coords_weight
         return coord
 
@@ -167,33 +222,59 @@ class E_GCL_mask(E_GCL):
           temp: Softmax temperature.
     """
 
-    def __init__(self, input_nf, output_nf, hidden_nf, edges_in_d=0, nodes_attr_dim=0, act_fn=nn.ReLU(), norm_type='batch', recurrent=True, coords_weight=1.0, attention=False):
+    def __init__(self, input_nf, output_nf, hidden_nf, edges_in_d=0, nodes_attr_dim=0, act_fn=nn.ReLU(), norm_type='batch', recurrent=True, coords_weight=1.0, attention=False, factorize=False):
         E_GCL.__init__(self, input_nf, output_nf, hidden_nf, edges_in_d=edges_in_d, nodes_att_dim=nodes_attr_dim, act_fn=act_fn, recurrent=recurrent, coords_weight=coords_weight, attention=attention)
 
         del self.coord_mlp
+        self.factorize = factorize
         self.act_fn = act_fn
         self.norm = MLP.get_norm(norm_type)(hidden_nf)
 
-    def coord_model(self, coord, edge_index, coord_diff, edge_feat):
+    def coord_model(self, coord, edge_index, coord_diff, edge_feat, ptr=None):
         row, col = edge_index
         trans = coord_diff * self.coord_mlp(edge_feat)
-        agg = unsorted_segment_sum(trans, row, num_segments=coord.size(0))
+        if ptr is not None:
+            agg = sorted_segment_sum(trans, ptr)
+        else:
+            agg = unsorted_segment_sum(trans, row, num_segments=coord.size(0))
         coord += agg*self.coords_weight
         return coord
 
-    def forward(self, h, edge_index, coord, batch, edge_attr=None, node_attr=None, edge_attn=None):
+    def forward(self, h, edge_index, coord, batch, edge_attr=None, node_attr=None, edge_attn=None, ptr=None):
+        # ptr: CSR pointer of row if edge_index is sorted by row (see edge_structure), to reduce contiguous segments instead of scattering
         row, col = edge_index
         radial, coord_diff = self.coord2radial(edge_index, coord)
 
-        edge_feat = self.edge_model(h[row], h[col], radial, edge_attr)
+        if self.factorize:
+            edge_feat = self.factorized_edge_model(h, edge_index, radial, edge_attr)
+        else:
+            edge_feat = self.edge_model(h[row], h[col], radial, edge_attr)
 
         if edge_attn is not None:
             edge_feat = edge_feat * edge_attn
 
-        h, agg = self.node_model(h, edge_index, edge_feat, node_attr)
+        h, agg = self.node_model(h, edge_index, edge_feat, node_attr, ptr=ptr)
         h = self.act_fn(self.norm(h))
         return h, coord, edge_attr
 
+    def dense_forward(self, h, coord, mask, adj, edge_attr=None, edge_attn=None):
+        # padded version of forward: h [B, N, H], coord [B, N, D], adj [B, N, N] with adj[b, row, col]
+        lin, nf = self.edge_mlp[0], h.shape[-1]
+        h_source, h_target = F.linear(h, torch.cat([lin.weight[:, :nf], lin.weight[:, nf:2 * nf]], dim=0)).chunk(2, dim=-1)
+        radial = (coord.unsqueeze(2) - coord.unsqueeze(1)).pow(2).sum(-1, keepdim=True)
+        edge_in = radial if edge_attr is None else torch.cat([radial, edge_attr], dim=-1)
+        edge_feat = h_source.unsqueeze(2) + h_target.unsqueeze(1) + F.linear(edge_in, lin.weight[:, 2 * nf:], lin.bias)
+        edge_feat = self.edge_mlp[1:](edge_feat)
+        if self.attention:
+            edge_feat = edge_feat * self.att_mlp(edge_feat)
+
+        if edge_attn is not None:
+            edge_feat = edge_feat * edge_attn
+
+        agg = (edge_feat * adj.unsqueeze(-1)).sum(dim=2)
+        h = self.node_mlp(torch.cat([h, agg], dim=-1))
+        return self.act_fn(masked_apply(self.norm, h, mask))
+
 
 def unsorted_segment_sum(data, segment_ids, num_segments):
     """Custom PyTorch op to replicate TensorFlow's `unsorted_segment_sum`."""
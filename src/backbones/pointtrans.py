@@ -9,12 +9,16 @@ import torch.nn.functional as F
 from torch.nn import Linear as Lin
 
 from torch_geometric.nn.inits import reset
-from torch_sparse import SparseTensor, set_diag
 from torch_geometric.nn.conv import MessagePassing
 from torch_geometric.nn.dense.linear import Linear
 from torch_geometric.utils import add_self_loops, remove_self_loops, softmax
 
 from utils import FeatEncoder
+from .dense_utils import use_dense, to_dense_graph
+from .compile_utils import run_layers
+from .checkpoint_utils import use_checkpoint, checkpoint_layer
+from .segment_utils import StructureCache, gather_edges
+from torch_scatter import segment_csr
 
 
 class PointTransformer(torch.nn.Module):
@@ -27,14 +31,17 @@ class PointTransformer(torch.nn.Module):
         self.x_dim = x_dim
         self.pos_dim = pos_dim
         self.dropout_p = model_config['dropout_p']
+        self.model_config = model_config
         self.raw_pos_dim = kwargs['aux_info']['raw_pos_dim']
 
-        self.node_encoder = FeatEncoder(hidden_size, feat_info['node_categorical_feat'], feat_info['node_scalar_feat'], n_categorical_feat_to_use, n_scalar_feat_to_use)
+        self.node_encoder = FeatEncoder(hidden_size, feat_info['node_categorical_feat'], feat_info['node_scalar_feat'], n_categorical_feat_to_use, n_scalar_feat_to_use,
+                                        fold_dim_mapping=model_config.get('fold_feat_encoder', False))
         self.edge_encoder = FeatEncoder(hidden_size, feat_info['edge_categorical_feat'], feat_info['edge_scalar_feat'])
 
         self.convs = torch.nn.ModuleList()
         for _ in range(self.n_layers):
             self.convs.append(TransformerBlock(hidden_size, hidden_size, pos_dim=self.raw_pos_dim))
+        self.structure_cache = StructureCache(dim=1, self_loops=self.convs[0].transformer.add_self_loops)
 
     def forward(self, x, pos, edge_attr, edge_index, batch, edge_attn=None):
         if self.x_dim == 0 and self.pos_dim != 0:
@@ -48,13 +55,40 @@ class PointTransformer(torch.nn.Module):
 
         x = self.node_encoder(feats)
         edge_attr = self.edge_encoder(edge_attr)
+        if use_dense(self.model_config, batch, edge_index, self.convs):
+            return self.dense_forward(x, pos, edge_attr, edge_index, batch, edge_attn)
 
+        # PointTransformerConv normalizes and aggregates at the targets edge_index[1]; self-loops, edge order and
+        # the softmax/aggregation pointer are prepared once here instead of in every layer
+        ptr = None
+        if self.model_config.get('sorted_aggregation', True):
+            edge_index, ptr, eid = self.structure_cache(edge_index, x.shape[0])
+            edge_attr, edge_attn = gather_edges(eid, edge_attr, edge_attn)
+
+        return run_layers(self, x, pos, edge_attr, edge_index, batch, edge_attn, ptr)
+
+    def layers_forward(self, x, pos, edge_attr, edge_index, batch, edge_attn=None, ptr=None):
+        for i in range(self.n_layers):
+            if use_checkpoint(self):
+                x = checkpoint_layer(self, self.layer_forward, i, x, pos, edge_attr, edge_index, batch, edge_attn, ptr)
+            else:
+                x = self.layer_forward(i, x, pos, edge_attr, edge_index, batch, edge_attn, ptr)
+        return x
+
+    def layer_forward(self, i, x, pos, edge_attr, edge_index, batch, edge_attn=None, ptr=None):
+        identity = x
+        x = self.convs[i](x, pos, edge_index, edge_attr=edge_attr, edge_attn=edge_attn, ptr=ptr)
+        x = x + identity
+        return F.dropout(x, self.dropout_p, training=self.training)
+
+    def dense_forward(self, x, pos, edge_attr, edge_index, batch, edge_attn=None):
+        x, pos, mask, adj, edge_attr, edge_attn = to_dense_graph(x, pos, edge_index, batch, edge_attr, edge_attn, target_first=True)
         for i in range(self.n_layers):
             identity = x
-            x = self.convs[i](x, pos, edge_index, edge_attr=edge_attr, edge_attn=edge_attn)
+            x = self.convs[i].dense_forward(x, pos, adj, edge_attr=edge_attr, edge_attn=edge_attn)
             x = x + identity
             x = F.dropout(x, self.dropout_p, training=self.training)
-        return x
+        return x[mask]
 
 
 class TransformerBlock(torch.nn.Module):
@@ -64,9 +98,15 @@ class TransformerBlock(torch.nn.Module):
         self.lin_out = Lin(out_channels, out_channels)
         self.transformer = PointTransformerConv(in_channels, out_channels, pos_dim=pos_dim)
 
-    def forward(self, x, pos, edge_index, edge_attr=None, edge_attn=None):
+    def forward(self, x, pos, edge_index, edge_attr=None, edge_attn=None, ptr=None):
+        x = self.lin_in(x).relu()
+        x = self.transformer(x, pos, edge_index, edge_attr=edge_attr, edge_attn=edge_attn, ptr=ptr)
+        x = self.lin_out(x).relu()
+        return x
+
+    def dense_forward(self, x, pos, adj, edge_attr=None, edge_attn=None):
         x = self.lin_in(x).relu()
-        x = self.transformer(x, pos, edge_index, edge_attr=edge_attr, edge_attn=edge_attn)
+        x = self.transformer.dense_forward(x, pos, adj, edge_attr=edge_attr, edge_attn=edge_attn)
         x = self.lin_out(x).relu()
         return x
 
@@ -167,7 +207,7 @@ class PointTransformerConv(MessagePassing):
         self,
         x: Union[Tensor, PairTensor],
         pos: Union[Tensor, PairTensor],
-        edge_index: Adj, edge_attr=None, edge_attn=None
+        edge_index: Adj, edge_attr=None, edge_attn=None, ptr=None
     ) -> Tensor:
         """"""
         if isinstance(x, Tensor):
@@ -180,27 +220,52 @@ class PointTransformerConv(MessagePassing):
         if isinstance(pos, Tensor):
             pos: PairTensor = (pos, pos)
 
-        if self.add_self_loops:
+        # with ptr, edge_index comes from edge_structure and already has its self-loops
+        if self.add_self_loops and ptr is None:
             if isinstance(edge_index, Tensor):
                 edge_index, _ = remove_self_loops(edge_index)
                 edge_index, _ = add_self_loops(
                     edge_index, num_nodes=min(pos[0].size(0), pos[1].size(0)))
-            elif isinstance(edge_index, SparseTensor):
-                edge_index = set_diag(edge_index)
+            else:
+                edge_index = edge_index.set_diag()
 
         # propagate_type: (x: PairTensor, pos: PairTensor, alpha: PairTensor)
-        out = self.propagate(edge_index, x=x, pos=pos, alpha=alpha, size=None, edge_attr=edge_attr, edge_attn=edge_attn)
+        out = self.propagate(edge_index, x=x, pos=pos, alpha=alpha, size=None, edge_attr=edge_attr, edge_attn=edge_attn, edge_ptr=ptr)
         return out
 
+    def dense_forward(self, x, pos, adj, edge_attr=None, edge_attn=None):
+        # padded version of forward: x [B, N, H], pos [B, N, D], adj [B, N, N] with adj[b, target, source]
+        if self.add_self_loops:
+            adj = adj | torch.eye(adj.shape[1], dtype=torch.bool, device=adj.device)
+
+        delta = self.pos_nn(pos.unsqueeze(2) - pos.unsqueeze(1))
+        alpha = self.lin_dst(x).unsqueeze(2) - self.lin_src(x).unsqueeze(1) + delta
+        if self.attn_nn is not None:
+            alpha = self.attn_nn(alpha)
+        # softmax over the sources of each target, nodes without incoming edges receive nothing
+        adj = adj.unsqueeze(-1)
+        alpha = alpha.float().masked_fill(~adj, float('-inf'))
+        alpha = (alpha - alpha.amax(dim=2, keepdim=True).clamp(min=-1e30)).exp()
+        alpha = alpha / (alpha.sum(dim=2, keepdim=True) + 1e-16)
+
+        msg = self.lin(x).unsqueeze(1) + delta
+        if edge_attr is not None:
+            msg = msg + edge_attr
+        msg = alpha * msg
+        if edge_attn is not None:
+            msg = msg * edge_attn
+        return msg.sum(dim=2)
+
     def message(self, x_j: Tensor, pos_i: Tensor, pos_j: Tensor,
                 alpha_i: Tensor, alpha_j: Tensor, index: Tensor,
-                ptr: OptTensor, size_i: Optional[int], edge_attr=None, edge_attn=None) -> Tensor:
+                ptr: OptTensor, size_i: Optional[int], edge_attr=None, edge_attn=None, edge_ptr=None) -> Tensor:
 
         delta = self.pos_nn(pos_i - pos_j)
         alpha = alpha_i - alpha_j + delta
         if self.attn_nn is not None:
             alpha = self.attn_nn(alpha)
-        alpha = softmax(alpha, index, ptr, size_i)
+        # the softmax stays in float32 under bf16 autocast
+        alpha = softmax(alpha.float(), index, ptr if edge_ptr is None else edge_ptr, size_i)
 
         if edge_attr is not None:
             msg = alpha * (x_j + delta + edge_attr)
@@ -211,6 +276,12 @@ class PointTransformerConv(MessagePassing):
             msg = msg * edge_attn
         return msg
 
+    def aggregate(self, inputs: Tensor, index: Tensor, ptr: OptTensor = None, dim_size: Optional[int] = None, edge_ptr=None) -> Tensor:
+        # edge_ptr: CSR pointer of the targets if edge_index is sorted by them (see edge_structure)
+        if edge_ptr is not None:
+            return segment_csr(inputs, edge_ptr, reduce=self.aggr)
+        return super().aggregate(inputs, index, ptr=ptr, dim_size=dim_size)
+
     def __repr__(self) -> str:
         return (f'{self.__class__.__name__}({self.in_channels}, '
                 f'{self.out_channels})')
@@ -0,0 +1,67 @@
+import torch
+from torch_scatter import segment_csr
+
+
+def edge_structure(edge_index, num_nodes, dim, self_loops=False):
+    # sort the edges of a batch by their aggregating node edge_index[dim] once and build the CSR pointer, so that all
+    # layers reduce over contiguous ranges (segment_csr) instead of scattering with an expanded index.
+    # with self_loops, existing self-loops are replaced by one self-loop per node.
+    # returns (edge_index, ptr, eid) where eid[e] is the input edge of edge e (-1 for added self-loops),
+    # or None if edge_index is used as is; edge_index coming from knn_graph/radius_graph is usually sorted already.
+    eid = None
+    if self_loops:
+        eid = (edge_index[0] != edge_index[1]).nonzero().view(-1)
+        loops = torch.arange(num_nodes, device=edge_index.device)
+        edge_index = torch.cat([edge_index[:, eid], torch.stack([loops, loops])], dim=1)
+        eid = torch.cat([eid, torch.full_like(loops, -1)])
+
+    index = edge_index[dim]
+    if index.numel() > 1 and not bool((index[1:] >= index[:-1]).all()):
+        perm = torch.sort(index, stable=True)[1]
+        edge_index = edge_index[:, perm]
+        eid = perm if eid is None else eid[perm]
+
+    ptr = index.new_zeros(num_nodes + 1)
+    torch.cumsum(torch.bincount(edge_index[dim], minlength=num_nodes), dim=0, out=ptr[1:])
+    return edge_index, ptr, eid
+
+
+def gather_edges(eid, edge_attr=None, edge_attn=None):
+    # align per-edge inputs with the edges of edge_structure, added self-loops get edge_attr 0 and edge_attn 1
+    if eid is None:
+        return edge_attr, edge_attn
+    out = []
+    for t, fill in [(edge_attr, 0.0), (edge_attn, 1.0)]:
+        if t is not None:
+            t = torch.cat([t, t.new_full((1,) + t.shape[1:], fill)])[eid]
+        out.append(t)
+    return out
+
+
+class StructureCache(object):
+    # keeps the edge_structure of the last edge_index, so that repeated forward passes on the same topology
+    # (e.g. explainers evaluating many edge masks of one batch) skip the preprocessing.
+    # a reference to edge_index is kept, so a hit means the same tensor object, not modified in place since.
+    def __init__(self, dim, self_loops=False):
+        self.dim = dim
+        self.self_loops = self_loops
+        self.entry = None
+
+    def __call__(self, edge_index, num_nodes):
+        # the (key, structure) pair is replaced as a whole, so concurrent branches sharing a backbone never mix entries
+        key, entry = (edge_index, edge_index._version, num_nodes), self.entry
+        if entry is None or entry[0][0] is not key[0] or entry[0][1:] != key[1:]:
+            entry = (key, edge_structure(edge_index, num_nodes, self.dim, self.self_loops))
+            self.entry = entry
+        return entry[1]
+
+    def clear(self):
+        self.entry = None
+
+
+def sorted_segment_sum(data, ptr):
+    return segment_csr(data, ptr, reduce='sum')
+
+
+def sorted_segment_mean(data, ptr):
+    return segment_csr(data, ptr, reduce='mean')
@@ -1,4 +1,8 @@
-from .posthoc import *
-from .inherent import *
-from .base import BaseRandom, LabelPerturb
-from .test_method import Test
+from utils.registry import lazy_getattr
+
+_modules = {'PGExplainer': '.posthoc.pgexplainer', 'GNNExplainer': '.posthoc.gnnexplainer', 'GNNLRP': '.posthoc.gnnlrp', 'Orphicx': '.posthoc.orphicx',
+            'GradX': '.posthoc.grads', 'GradCAM': '.posthoc.grads', 'InterGrad': '.posthoc.grads', 'PGMExplainer': '.posthoc.pgmexplainer',
+            'SubgraphX': '.posthoc.subgraphx', 'CIGA': '.inherent.ciga', 'VGIB': '.inherent.vgib', 'DIR': '.inherent.dir',
+            'LRIGaussian': '.inherent.lri_gaussian', 'LRIBern': '.inherent.lri_bern', 'BaseRandom': '.base', 'LabelPerturb': '.base', 'Test': '.test_method'}
+__all__ = list(_modules)
+__getattr__ = lazy_getattr(__name__, _modules)
@@ -1,5 +1,5 @@
-from .ciga import CIGA
-from .vgib import VGIB
-from .dir import DIR
-from .lri_gaussian import LRIGaussian
-from .lri_bern import LRIBern
+from utils.registry import lazy_getattr
+
+_modules = {'CIGA': '.ciga', 'VGIB': '.vgib', 'DIR': '.dir', 'LRIGaussian': '.lri_gaussian', 'LRIBern': '.lri_bern'}
+__all__ = list(_modules)
+__getattr__ = lazy_getattr(__name__, _modules)
@@ -5,6 +5,7 @@ import torch.nn.functional as F
 import numpy as np
 from torch_geometric.utils import degree
 from ..base import BaseRandom
+from utils.parallel_utils import run_branches
 
 def split_batch(g, edge_index):
     split = degree(g.batch[edge_index[0]], dtype=torch.long).tolist()
@@ -149,8 +150,9 @@ class CIGA(BaseRandom):
                             x=spu_x, pos=spu_pos)
 
 
-        causal_node_emb = self.clf.get_emb(causal_data, edge_attn=causal_data.edge_weight)[0]
-        conf_node_emb = self.clf.get_emb(conf_data, edge_attn=conf_data.edge_weight)[0]
+        causal_node_emb, conf_node_emb = run_branches([lambda: self.clf.get_emb(causal_data, edge_attn=causal_data.edge_weight)[0],
+                                                       lambda: self.clf.get_emb(conf_data, edge_attn=conf_data.edge_weight)[0]],
+                                                      [self.clf, self.clf], self.clf.parallel_branches)
         causal_graph_emb = self.clf.pool(causal_node_emb, causal_data.batch)
 
         causal_logits = self.clf.get_pred_from_emb(causal_node_emb, causal_data.batch)
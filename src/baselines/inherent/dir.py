@@ -6,6 +6,7 @@ from torch_sparse import transpose
 from torch_geometric.data import Data, Batch
 from torch_geometric.utils import degree
 from ..base import BaseRandom
+from utils.parallel_utils import run_branches
 
 
 def relabel(x, edge_index, batch, pos=None):
@@ -148,13 +149,15 @@ class DIR(BaseRandom):
                                 x=spu_x, pos=spu_pos)
 
         if self.split_data == 'continuous':
-            causal_node_emb = self.clf.get_emb(data, edge_attn=causal_edge_weight.reshape(-1, 1))[0]
-            conf_node_emb = self.clf.get_emb(data, edge_attn=spu_edge_weight.reshape(-1, 1))[0].detach()
+            causal_node_emb, conf_node_emb = run_branches([lambda: self.clf.get_emb(data, edge_attn=causal_edge_weight.reshape(-1, 1))[0],
+                                                           lambda: self.clf.get_emb(data, edge_attn=spu_edge_weight.reshape(-1, 1))[0].detach()],
+                                                          [self.clf, self.clf], self.clf.parallel_branches)
             causal_out = self.clf.get_pred_from_emb(causal_node_emb, data.batch)
             conf_out = self.clf.get_pred_from_spu_emb(conf_node_emb, data.batch)
         else:
-            causal_node_emb = self.clf.get_emb(causal_data, edge_attn=causal_data.edge_weight)[0]
-            conf_node_emb = self.clf.get_emb(conf_data, edge_attn=conf_data.edge_weight)[0].detach()
+            causal_node_emb, conf_node_emb = run_branches([lambda: self.clf.get_emb(causal_data, edge_attn=causal_data.edge_weight)[0],
+                                                           lambda: self.clf.get_emb(conf_data, edge_attn=conf_data.edge_weight)[0].detach()],
+                                                          [self.clf, self.clf], self.clf.parallel_branches)
             # causal_graph_emb = self.clf.pool(causal_node_emb, causal_data.batch)
             # conf_graph_emb = self.clf.pool(conf_node_emb, conf_data.batch)
             causal_out = self.clf.get_pred_from_emb(causal_node_emb, causal_data.batch)
@@ -3,6 +3,7 @@ import torch.nn as nn
 from torch_scatter import scatter
 import numpy as np
 from ..base import BaseRandom
+from utils.parallel_utils import run_branches
 
 
 class LRIBern(BaseRandom):
@@ -61,8 +62,8 @@ class LRIBern(BaseRandom):
         # node_attn = node_attn * (data.num_nodes / node_attn.sum())
         edge_attn = self.node_attn_to_edge_attn(node_attn, edge_index)
         # masked_clf_logits = self.clf.get_pred_from_emb(node_attn * emb, batch=data.batch)
-        masked_clf_logits =  self.clf(data, edge_attn=edge_attn)
-        original_clf_logits = self.clf(data)
+        masked_clf_logits, original_clf_logits = run_branches([lambda: self.clf(data, edge_attn=edge_attn), lambda: self.clf(data)],
+                                                              [self.clf, self.clf], self.clf.parallel_branches)
 
         loss, loss_dict = self.__loss__(node_attn_log_logits.sigmoid(), masked_clf_logits, data.y, epoch)
         return loss, loss_dict, masked_clf_logits, node_attn.reshape(-1)
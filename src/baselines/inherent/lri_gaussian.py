@@ -4,6 +4,8 @@ import numpy as np
 import torch.nn.functional as F
 from torch_scatter import scatter, scatter_max
 from ..base import BaseRandom
+from utils.parallel_utils import run_branches
+from utils.precision_utils import float32
 
 
 class LRIGaussian(BaseRandom):
@@ -22,6 +24,7 @@ class LRIGaussian(BaseRandom):
         self.attn_constraint = config['attn_constraint']
 
     @staticmethod
+    @float32
     def kl(pred_sigma, reg_sigma):
         first_term = torch.log(reg_sigma.det() / (abs(pred_sigma.det()) + 1e-6))
         second_term = -reg_sigma.shape[0]
@@ -61,21 +64,27 @@ class LRIGaussian(BaseRandom):
         emb, edge_index = self.clf.get_emb(data)
         U = self.extractor(emb, batch=data.batch, pool_out_lig=None)
 
-        sig1 = F.softplus(U[:, [0]]).clamp(1e-6, 1e6)
-        sig2 = F.softplus(U[:, [1]]).clamp(1e-6, 1e6)
-
-        U = U[:, 2:].reshape(emb.shape[0], self.dim, self.dim)
-        pred_sigma = sig1.reshape(-1, 1, 1) * U @ U.transpose(1, 2) + sig2.reshape(-1, 1, 1) * torch.eye(self.dim, device=self.device).reshape(-1, self.dim, self.dim)
+        U, sig1, sig2, pred_sigma = self.get_pred_sigma(U)
         # pred_sigma = self.smooth_min(edge_index, pred_sigma, U, sig1, sig2) if self.attn_constraint == 'smooth_min' else pred_sigma
 
         node_noise = self.sampling(U, do_sampling, sig1, sig2)
-        masked_clf_logits = self.clf(data, node_noise=node_noise)
-        original_clf_logits = self.clf(data)
+        masked_clf_logits, original_clf_logits = run_branches([lambda: self.clf(data, node_noise=node_noise), lambda: self.clf(data)],
+                                                              [self.clf, self.clf], self.clf.parallel_branches)
 
         loss, loss_dict = self.__loss__(pred_sigma, masked_clf_logits, data.y, epoch)
 
         return loss, loss_dict, masked_clf_logits, 1-(pred_sigma.det()).reshape(-1)
 
+    @float32
+    def get_pred_sigma(self, U):
+        # covariances and their determinants stay in float32 under bf16 autocast
+        sig1 = F.softplus(U[:, [0]]).clamp(1e-6, 1e6)
+        sig2 = F.softplus(U[:, [1]]).clamp(1e-6, 1e6)
+
+        U = U[:, 2:].reshape(U.shape[0], self.dim, self.dim)
+        pred_sigma = sig1.reshape(-1, 1, 1) * U @ U.transpose(1, 2) + sig2.reshape(-1, 1, 1) * torch.eye(self.dim, device=self.device).reshape(-1, self.dim, self.dim)
+        return U, sig1, sig2, pred_sigma
+
     def sampling(self, U, do_sampling, sig1, sig2):
         if do_sampling:
             epsilon_1 = torch.randn((U.shape[0], U.shape[2], 1), device=self.device)
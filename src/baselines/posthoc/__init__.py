@@ -1,7 +1,6 @@
-from .pgexplainer import PGExplainer
-from .gnnexplainer import GNNExplainer
-from .gnnlrp import GNNLRP
-from .orphicx import Orphicx
-from .grads import GradX, GradCAM, InterGrad
-from .pgmexplainer import PGMExplainer
-from .subgraphx import SubgraphX
+from utils.registry import lazy_getattr
+
+_modules = {'PGExplainer': '.pgexplainer', 'GNNExplainer': '.gnnexplainer', 'GNNLRP': '.gnnlrp', 'Orphicx': '.orphicx',
+            'GradX': '.grads', 'GradCAM': '.grads', 'InterGrad': '.grads', 'PGMExplainer': '.pgmexplainer', 'SubgraphX': '.subgraphx'}
+__all__ = list(_modules)
+__getattr__ = lazy_getattr(__name__, _modules)
@@ -4,7 +4,9 @@
 import torch
 import torch.nn as nn
 from math import sqrt
+from torch_geometric.data import Batch
 from ..base import BaseRandom
+from utils.budget_utils import ExplanationBudget
 
 
 class GNNExplainer(BaseRandom):
@@ -22,6 +24,14 @@ class GNNExplainer(BaseRandom):
         self.mask_ent_loss_coef = config['mask_ent_loss_coef']
         self.iter_per_sample = config['iter_per_sample']
         self.iter_lr = config['iter_lr']
+        self.budget_config = {k: config[k] for k in ['max_evals', 'max_sec', 'rank_tol', 'rank_patience'] if k in config}
+        self.rank_every = config.get('rank_every', 10)
+        self.restart_generators = None
+
+    def set_restarts(self, seeds):
+        # one independent mask per seed, initialized from its own generator and optimized together with the others
+        # on the batch replicated once per seed (see forward_pass); None goes back to a single mask
+        self.restart_generators = None if seeds is None else [torch.Generator().manual_seed(seed) for seed in seeds]
 
     def __loss__(self, mask, clf_logits, clf_labels, epoch):
         pred_loss = self.criterion(clf_logits, clf_labels.float())
@@ -41,7 +51,11 @@ class GNNExplainer(BaseRandom):
     def _initialize_masks(self, x, init="normal"):
         N = x.size()[0]
         std = torch.nn.init.calculate_gain("relu") * sqrt(2.0 / (2 * N))
-        self.node_mask = torch.nn.Parameter(torch.FloatTensor(N, 1).normal_(1, std))
+        if self.restart_generators is None:
+            self.node_mask = torch.nn.Parameter(torch.FloatTensor(N, 1).normal_(1, std))
+        else:
+            self.node_mask = torch.nn.Parameter(torch.cat([torch.FloatTensor(N, 1).normal_(1, std, generator=generator)
+                                                           for generator in self.restart_generators]))
 
     def _clear_masks(self):
         self.node_mask = None
@@ -49,26 +63,46 @@ class GNNExplainer(BaseRandom):
     def forward_pass(self, data, epoch, **kwargs):
 
         self._clear_masks()
-        _, edge_index = self.clf.get_emb(data)
         with torch.no_grad():
             original_clf_logits = self.clf(data)
 
-        self._initialize_masks(data.x)
+        # with restarts the batch is replicated once per restart, the nodes of restart r come after those of
+        # restart r - 1, and all masks are optimized in the same forward and backward passes. The losses are means
+        # over equally sized replicas, so scaling by the number of restarts gives every mask the gradient of its own run
+        num_restarts = 1 if self.restart_generators is None else len(self.restart_generators)
+        num_nodes = data.num_nodes
+        if num_restarts > 1:
+            data = Batch.from_data_list(data.to_data_list() * num_restarts, follow_batch=['x_lig'] if 'x_lig' in data else None)
+        _, edge_index = self.clf.get_emb(data)
+        labels = original_clf_logits.sigmoid().repeat(num_restarts, 1)
+
+        self._initialize_masks(data.x[:num_nodes])
         self.to(data.x.device)
 
         parameters = [self.node_mask]
         optimizer = torch.optim.Adam(parameters, lr=self.iter_lr)
 
-        for _ in range(self.iter_per_sample):
+        # the masks of the whole batch are optimized together, every iteration evaluates each graph once. The
+        # optimization stops early when the budget of the batch is exhausted or the node ranking of every graph has
+        # converged; single Adam steps hardly reorder the nodes, so the rankings are compared every rank_every iterations
+        budget = ExplanationBudget.from_config(self.budget_config, num_graphs=data.num_graphs)
+        for i in range(self.iter_per_sample):
             optimizer.zero_grad()
             node_mask = torch.sigmoid(self.node_mask)
             edge_mask = self.node_attn_to_edge_attn(node_mask, edge_index)
             masked_clf_logits = self.clf(data, edge_attn=edge_mask)
-            loss, loss_dict = self.__loss__(self.node_mask.sigmoid(), masked_clf_logits, original_clf_logits.sigmoid(), epoch)
-            loss.backward()
+            loss, loss_dict = self.__loss__(self.node_mask.sigmoid(), masked_clf_logits, labels, epoch)
+            (loss * num_restarts).backward()
             optimizer.step()
-
-        return loss, loss_dict, original_clf_logits, self.node_mask.sigmoid().reshape(-1)
+            budget.charge(data.num_graphs)
+            check_ranking = budget.tracks_ranking and (i + 1) % self.rank_every == 0
+            if budget.should_stop(self.node_mask.detach() if check_ranking else None, data.batch):
+                break
+
+        loss_dict.update(budget.finish())
+        # a (num_nodes, num_restarts) attention with restarts, one column per seed
+        node_attn = self.node_mask.sigmoid().reshape(-1) if num_restarts == 1 else self.node_mask.sigmoid().reshape(num_restarts, num_nodes).T
+        return loss, loss_dict, original_clf_logits, node_attn
 
     @staticmethod
     def node_attn_to_edge_attn(node_attn, edge_index):
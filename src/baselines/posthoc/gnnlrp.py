@@ -28,27 +28,10 @@ class GNNLRP(BaseRandom):
         original_clf_logits = self.activations_and_grads(data)
         # H_end, transforms = self.get_H_transforms(data, gammas)
         H_end = self.activations_and_grads.activations[-1].data
-        sum_nodes = 0
-        node_weights_list = []
-        for graph in data.to_data_list():
-            add_nodes = graph.num_nodes
-            relevance = H_end[sum_nodes:sum_nodes+add_nodes, :]
-            transforms = self.get_single_graph_transforms(graph, self.gammas, start=sum_nodes)
-            sum_nodes = sum_nodes+add_nodes
-            for transform in reversed(transforms):
-                # einsum slow
-                # relevance_subgraph = torch.einsum('ijkl,kl->ij', transform, mask @ relevance_subgraph)
-                nbnodes = transform.shape[0]
-                nbneurons_in = transform.shape[1]
-                nbneurons_out = transform.shape[3]
-
-                transform = transform.reshape(nbnodes * nbneurons_in, nbnodes * nbneurons_out)
-                relevance = relevance.reshape([nbnodes * nbneurons_out, 1])
-
-                relevance = (transform @ relevance).reshape(nbnodes, nbneurons_in)
-            graph_node_weights = relevance.sum(axis=1)
-            node_weights_list.append(graph_node_weights)
-        node_weights = torch.cat(node_weights_list)
+        activations_list = [a.data for a in self.activations_and_grads.activations]
+        weight_list = [g.data for g in self.activations_and_grads.weights]
+        bias_list = [b.data for b in self.activations_and_grads.biases]
+        node_weights = self.propagate_relevance(data.edge_index, data.num_nodes, H_end, activations_list, weight_list, bias_list, self.gammas)
 
         res_weights = self.node_attn_to_edge_attn(node_weights, data.edge_index) if hasattr(data, 'edge_label') else node_weights
         # sparse_edge_mask = control_sparsity(edge_attn)
@@ -57,24 +40,59 @@ class GNNLRP(BaseRandom):
 
         return -1, {}, original_clf_logits, res_weights.sigmoid()
 
+    @staticmethod
+    def propagate_relevance(edge_index, num_nodes, relevance, activations_list, weight_list, bias_list, gammas):
+        # LRP-gamma over the edges of a whole batch, the same relevance as explain_graph without the dense
+        # [N, H, N, H] transforms: a node j sends (H_j * R_j / z_j) @ W to every neighbour i with A[i, j] = 1 (the
+        # adjacency of get_adj: undirected, with self loops), where z_j = deg_j * H_j * W.sum(1) + b. A 1-D weight (the
+        # last weight of a conv is the one of its norm, e.g. BatchNorm with norm_type: batch) broadcasts in the dense
+        # transforms of explain_graph like a matrix whose rows all equal it, so it is expanded to that matrix
+        loops = torch.arange(num_nodes, device=edge_index.device)
+        edge_index = torch.cat([edge_index, edge_index.flip(0), torch.stack([loops, loops])], dim=1)
+        row, col = torch.unique(edge_index, dim=1)
+        deg = scatter(torch.ones_like(col, dtype=relevance.dtype), col, dim=0, dim_size=num_nodes, reduce='sum')
+        layers = list(zip(weight_list, bias_list, activations_list, gammas))
+        for W, b, H, gamma in reversed(layers):
+            W = W.expand(H.shape[1], -1) if W.dim() == 1 else W
+            W = W + gamma * W.clamp(min=0)
+            b = b + gamma * b.clamp(min=0) + 1e-6
+            z = deg.unsqueeze(-1) * H * W.sum(axis=1) + b
+            message = (H * relevance / z) @ W
+            relevance = scatter(message[col], row, dim=0, dim_size=num_nodes, reduce='sum')
+        return relevance.sum(axis=1)
+
+    @staticmethod
+    def explain_graph(graph, relevance, activations_list, weight_list, bias_list, gammas):
+        # dense reference of propagate_relevance for one graph, O(N^2 H^2) memory
+        transforms = GNNLRP.get_single_graph_transforms(graph, gammas, activations_list, weight_list, bias_list)
+        for transform in reversed(transforms):
+            # einsum slow
+            # relevance_subgraph = torch.einsum('ijkl,kl->ij', transform, mask @ relevance_subgraph)
+            nbnodes = transform.shape[0]
+            nbneurons_in = transform.shape[1]
+            nbneurons_out = transform.shape[3]
+
+            transform = transform.reshape(nbnodes * nbneurons_in, nbnodes * nbneurons_out)
+            relevance = relevance.reshape([nbnodes * nbneurons_out, 1])
+
+            relevance = (transform @ relevance).reshape(nbnodes, nbneurons_in)
+        return relevance.sum(axis=1)
+
     @staticmethod
     def get_adj(data):
         adj = torch.eye(data.num_nodes, device=data.edge_index.device)
-        for i, j in data.edge_index.T:
-            adj[i, j] = 1
-            adj[j, i] = 1
+        adj[data.edge_index[0], data.edge_index[1]] = 1
+        adj[data.edge_index[1], data.edge_index[0]] = 1
         return adj
 
-    def get_single_graph_transforms(self, graph, gammas, start):
-        activations_list = [a.data for a in self.activations_and_grads.activations]
-        weight_list = [g.data for g in self.activations_and_grads.weights]
-        bias_list = [b.data for b in self.activations_and_grads.biases]
+    @staticmethod
+    def get_single_graph_transforms(graph, gammas, activations_list, weight_list, bias_list):
+        # activations_list holds the activations of the nodes of graph only
         transforms = []
-        A = self.get_adj(graph)
+        A = GNNLRP.get_adj(graph)
         for W, b, H, gamma in zip(weight_list, bias_list, activations_list, gammas):
             W = W + gamma * W.clamp(min=0)
             b = b + gamma * b.clamp(min=0) + 1e-6
-            H = H[start:start+graph.num_nodes, :]
             neuron_weight = (A.unsqueeze(-1).unsqueeze(-1) * W.unsqueeze(0).unsqueeze(0)).permute(0, 3, 1, 2)
             neuro_feature = H.unsqueeze(0).unsqueeze(0)
             transform = neuron_weight * neuro_feature  # 这里没加b？
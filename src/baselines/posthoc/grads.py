@@ -3,9 +3,10 @@
 import numpy as np
 import torch
 from torch.autograd import Variable
-from torch_geometric.data import Data, Batch
+from torch_geometric.data import Batch
 from torch_geometric.nn import MessagePassing
 from ..base import BaseRandom
+from utils.get_data_loaders import replicate_edge_index
 
 
 class Grad(BaseRandom):
@@ -127,8 +128,8 @@ class GradCAM(Grad):
 
 
     def compute_cam_per_layer(self) -> np.ndarray:
-        activations_list = [a.cpu().data.numpy() for a in self.activations_and_grads.activations]
-        grads_list = [g.cpu().data.numpy() for g in self.activations_and_grads.gradients]
+        activations_list = [a.cpu().data.float().numpy() for a in self.activations_and_grads.activations]
+        grads_list = [g.cpu().data.float().numpy() for g in self.activations_and_grads.gradients]
 
         cam_per_target_layer = []
         # Loop over the saliency image from every layer
@@ -144,57 +145,85 @@ class GradCAM(Grad):
             cam_per_target_layer.append(cam)
         return cam_per_target_layer
 
+def integration_points(baseline, steps, rule):
+    """ interpolation scales between baseline and 1 and their weights for the Riemann (left, right, middle) or
+    trapezoid rule with steps intervals """
+    t = torch.arange(steps + 1, dtype=torch.float) / steps
+    weights = torch.full((steps,), 1 / steps)
+    if rule == 'right':
+        t = t[1:]
+    elif rule == 'left':
+        t = t[:-1]
+    elif rule == 'middle':
+        t = (t[:-1] + t[1:]) / 2
+    elif rule == 'trapezoid':
+        weights = torch.cat([weights[:1] / 2, weights[1:], weights[:1] / 2])
+    else:
+        raise ValueError(f'Unknown integration rule: {rule}')
+    return baseline + t * (1 - baseline), weights * (1 - baseline)
+
+
+def interpolation_batch(data, scales, x_level):
+    """ len(scales) copies of the batch with pos (geometric) or x (graph) multiplied by each scale, as one Batch; the
+    nodes of copy i come after those of copy i - 1 and the scaled input is a leaf that requires grad """
+    num_steps, num_nodes = len(scales), data.num_nodes
+    node_scales = scales.to(data.x.device).repeat_interleave(num_nodes).unsqueeze(-1)
+    x, pos = data.x.repeat(num_steps, 1), data.pos.repeat(num_steps, 1)
+    if x_level == 'geometric':
+        pos = (node_scales * pos).requires_grad_()
+    else:
+        x = node_scales * x
+        try:
+            x.requires_grad_()
+        except(RuntimeError, ValueError):
+            pass
+    steps = torch.arange(num_steps, device=x.device)
+    batch = data.batch.repeat(num_steps) + steps.repeat_interleave(num_nodes) * data.num_graphs
+    ptr = torch.cat([data.ptr[:-1] + i * num_nodes for i in range(num_steps)] + [data.ptr.new_full((1,), num_steps * num_nodes)])
+    return Batch(x=x, pos=pos, edge_index=replicate_edge_index(data.edge_index, num_steps, num_nodes),
+                 y=torch.cat([data.y] * num_steps), batch=batch, ptr=ptr)
+
+
 class InterGrad(Grad):
 
     def __init__(self, clf, criterion, config):
         super(InterGrad, self).__init__(clf, criterion, config)
         self.target_layers = [clf.model.node_encoder]
         self.name = 'inter_grad'
+        self.steps = config.get('steps', 20)
+        self.rule = config.get('rule', 'right')
+        self.max_batch_nodes = config.get('max_batch_nodes', 8192)
 
-    def forward_pass(self, data, baseline=0, steps=20, **kwargs):
+    def forward_pass(self, data, baseline=0, steps=None, **kwargs):
         # node_base = torch.zeros_like(data.x) if node_base == None else node_base
         # edge_base = torch.zeros_like(data.edge_attr) if edge_base == None else edge_base
         x_level = 'geometric'
         self.clf.eval()
         original_clf_logits = self.activations_and_grads(data)
-        scales = [baseline + (float(i) / steps) * (1 - baseline) for i in range(1, steps + 1)]
-        node_grads = []
-        step_len = float(1 - baseline) / steps
-
-        for scale in reversed(scales):
-            if x_level == 'geometric':
-                new_data_list = [Data(x=graph.x, edge_index=graph.edge_index, pos=scale * graph.pos, y=graph.y) for graph in data.to_data_list()]
-            else:
-                new_data_list = [Data(x=scale * graph.x, edge_index=graph.edge_index, y=graph.y) for graph in data.to_data_list()]
-
-            new_data = Batch.from_data_list(new_data_list)
-            if x_level == 'geometric':
-                new_data.pos.requires_grad = True
-            else:
-                try:
-                    is_cat_feat = False
-                    new_data.x.requires_grad = True
-                except(RuntimeError, ValueError):
-                    is_cat_feat = True
+        scales, weights = integration_points(baseline, self.steps if steps is None else steps, self.rule)
+        node_grads = torch.zeros(data.num_nodes, device=data.x.device)
+
+        # the interpolation steps are stacked into replicated batches of at most max_batch_nodes nodes, the graphs of
+        # the copies are independent, so one backward gives the gradients of every step
+        chunk = max(self.max_batch_nodes // data.num_nodes, 1)
+        for start in range(0, len(scales), chunk):
+            new_data = interpolation_batch(data, scales[start:start + chunk], x_level)
+            num_steps = new_data.num_graphs // data.num_graphs
             pred = self.activations_and_grads(new_data)
             # pred = self.clf(new_data, edge_attr=data.edge_attr)
-            sum(pred).backward(retain_graph=True)
+            pred.sum().backward()
             if x_level == 'geometric':
-                score = new_data.pos.grad.norm(dim=1, p=2)
+                grad = new_data.pos.grad
+            elif new_data.x.requires_grad:
+                grad = new_data.x.grad
             else:
-                if is_cat_feat:
-                    grad = self.activations_and_grads.gradients[0].squeeze().to(pred.device)
-                    # value = self.activations_and_grads.activations[0].squeeze().to(loss.device)
-                    score = grad.norm(dim=1)
-                else:
-                    score = new_data.x.grad.norm(dim=1, p=2)
-            # score = pow(new_data.pos.grad, 2).sum(dim=1).cpu().numpy()
-            node_grads.append((score * step_len).cpu())
-
+                # categorical features, the gradients of the node embeddings
+                grad = self.activations_and_grads.gradients[0].squeeze().to(pred.device)
+            score = grad.reshape(num_steps, data.num_nodes, -1).norm(dim=2, p=2)
+            node_grads += (weights[start:start + chunk].to(score.device).unsqueeze(-1) * score).sum(dim=0).detach()
             self.clf.zero_grad()
-        node_grads = torch.tensor(np.stack(node_grads), device=data.x.device).sum(axis=0)
         # node_grads[node_grads < 0] = 1e-16
-        node_imp = (node_grads - min(node_grads)) / (max(node_grads) - min(node_grads))
+        node_imp = (node_grads - node_grads.min()) / (node_grads.max() - node_grads.min())
 
         res_weights = self.node_attn_to_edge_attn(node_imp, data.edge_index) if hasattr(data,'edge_label') else node_imp
         res_weights = self.min_max_scalar(res_weights)
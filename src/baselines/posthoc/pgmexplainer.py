@@ -3,17 +3,39 @@
 import math
 import torch.nn as nn
 import torch
-import copy
 import numpy as np
-import pandas as pd
 from scipy.special import softmax
-from pgmpy.estimators.CITests import chi_square
+from scipy.stats import chi2
 from torch_geometric.data import Data, Batch
 from ..base import BaseRandom
+from utils.parallel_utils import run_per_graph
+from utils.budget_utils import ExplanationBudget, mean_diagnostics
 
 # from evaluation import control_sparsity
 
 
+def chi_square_tests(samples, target):
+    # chi-square independence tests of every binary column of samples against the binary column target at once,
+    # the same statistics as pgmpy's chi_square(node, target, [], data) (scipy chi2_contingency with Yates' correction)
+    samples = np.asarray(samples, dtype=np.float64)
+    y = samples[:, target]
+    n = samples.shape[0]
+    row1 = samples.sum(axis=0)
+    n11 = samples.T @ y
+    observed = np.stack([n - row1 - y.sum() + n11, y.sum() - n11, row1 - n11, n11], axis=1).reshape(-1, 2, 2)
+    rows, cols = observed.sum(axis=2, keepdims=True), observed.sum(axis=1, keepdims=True)
+    expected = rows * cols / n
+
+    # a constant column gives a 1xk table with zero degrees of freedom, for which the statistic is 0 and p is 1
+    valid = (rows > 0).all(axis=(1, 2)) & (cols > 0).all(axis=(1, 2))
+    expected = np.where(valid[:, None, None], expected, 1.0)
+    diff = expected - observed
+    corrected = observed + np.sign(diff) * np.minimum(0.5, np.abs(diff))
+    stats = np.where(valid, ((corrected - expected) ** 2 / expected).sum(axis=(1, 2)), 0.0)
+    p_values = np.where(valid, chi2.sf(stats, 1), 1.0)
+    return stats, p_values
+
+
 class MetaPGMExplainer:
     def __init__(
             self,
@@ -22,6 +44,8 @@ class MetaPGMExplainer:
             pred_threshold=0.5,
             perturb_mode="mean",  # mean, zero, max or uniform
             perturb_indicator="diff",
+            batch_size=250,
+            rank_every=25,
     ):
         self.model = model
         # self.model.eval()
@@ -34,137 +58,146 @@ class MetaPGMExplainer:
         self.X_feat = graph.x
         self.geo_feat = graph.pos
         self.pred_threshold = pred_threshold
+        self.batch_size = batch_size
+        self.rank_every = rank_every
 
-    def perturb_on_graph(self, node_idx, x_level):
+    def sample_masks(self, num_samples, index_to_perturb, percentage, x_level):
+        # perturbation masks of a round as one (num_samples, num_nodes) array, with the numpy draws made in the same
+        # order as when the graphs were perturbed one sample at a time
         candi_feat = self.X_feat if x_level == 'graph' else self.geo_feat if x_level == 'geometric' else None
+        num_nodes = self.X_feat.size(0)
+        perturb_num = int(percentage / 100 * num_nodes)
 
-        # X_perturb = copy.deepcopy(candi_feat)
-        perturb_array = copy.deepcopy(candi_feat)
-        epsilon = 0.05 * torch.max(candi_feat, dim=0).values
-        epsilon = epsilon.detach().cpu().numpy()
-
-        for i in node_idx:
-            if self.perturb_mode == "mean":
-                perturb_array[i] = torch.mean(candi_feat, dim=0)
-            elif self.perturb_mode == "zero":
-                perturb_array[i] = torch.zeros((candi_feat.shape[1], 1))
-            elif self.perturb_mode == "max":
-                perturb_array[i] = torch.max(candi_feat, dim=0).values
-            elif self.perturb_mode == "uniform":
-                perturb_array[i] = perturb_array[i] + np.random.uniform(low=-epsilon, high=epsilon)
-            else:
-                assert self.perturb_mode == 'split'
-                tmp_graph = self.graph.clone().cpu()
-                all_idx = np.arange(self.graph.num_nodes)
-                node_idx = np.setdiff1d(all_idx, node_idx)
-
-                new_x = tmp_graph.x[node_idx]
-                new_pos = None if tmp_graph.pos==None else tmp_graph.pos[node_idx]
-
-                edge_index = tmp_graph.edge_index
-                row = edge_index[0]
-                new_idx = row.new_full((self.graph.num_nodes + 1,), -1)
-                # print(new_idx.device)
-                new_idx[node_idx] = torch.arange(node_idx.size)
-                new_edge_index = new_idx[edge_index]
-
-                new_edge_index = new_edge_index.T[(new_edge_index.T != torch.tensor([-1, -1])).all(dim=1)].T
-                # delete the -1 ones
-
-                tmp_graph.x = new_x
-                tmp_graph.pos = new_pos
-                tmp_graph.edge_index = new_edge_index
-
-                return tmp_graph.to(self.graph.x.device)
-
-        tmp_graph = self.graph.clone()
-        if x_level == 'graph':
-            tmp_graph.x = perturb_array
-        elif x_level == 'geometric':
-            tmp_graph.pos = perturb_array
-        else:
+        masks = np.zeros((num_samples, num_nodes), dtype=bool)
+        noise = np.zeros((num_samples, num_nodes, candi_feat.shape[1])) if self.perturb_mode == 'uniform' else None
+        epsilon = None if noise is None else (0.05 * torch.max(candi_feat, dim=0).values).detach().cpu().float().numpy()
+        for i in range(num_samples):
+            perturb_indexes = np.random.permutation(index_to_perturb)[:perturb_num]
+            masks[i, perturb_indexes] = True
+            if noise is not None:
+                for j in perturb_indexes:
+                    noise[i, j] = np.random.uniform(low=-epsilon, high=epsilon)
+        return masks, noise
+
+    def perturb_batch(self, masks, noise, x_level):
+        # all perturbed copies of the graph as one Batch, the mask rows are the copies
+        n_copies, num_nodes = masks.shape
+        batch = Batch.from_data_list([self.graph] * n_copies, follow_batch=['x_lig'] if 'x_lig' in self.graph else None)
+        perturbed = torch.as_tensor(masks.reshape(-1), device=batch.x.device)
+
+        if self.perturb_mode == 'split':
+            # perturbed nodes are removed together with their edges, the remaining nodes are relabeled in order
+            keep = ~perturbed
+            new_idx = torch.full((keep.shape[0],), -1, dtype=torch.long, device=keep.device)
+            new_idx[keep] = torch.arange(int(keep.sum()), device=keep.device)
+            edge_index = new_idx[batch.edge_index]
+            batch.edge_index = edge_index[:, (edge_index != -1).all(dim=0)]
+            batch.x = batch.x[keep]
+            batch.pos = None if batch.pos is None else batch.pos[keep]
+            batch.batch = batch.batch[keep]
+            return batch
+
+        candi_feat = self.X_feat if x_level == 'graph' else self.geo_feat if x_level == 'geometric' else None
+        if candi_feat is None:
             raise ValueError(f'Unknown x_level: {x_level}')
+        feat = candi_feat.repeat(n_copies, 1)
+        if self.perturb_mode == "mean":
+            feat[perturbed] = torch.mean(candi_feat, dim=0)
+        elif self.perturb_mode == "zero":
+            feat[perturbed] = 0
+        elif self.perturb_mode == "max":
+            feat[perturbed] = torch.max(candi_feat, dim=0).values
+        else:
+            assert self.perturb_mode == "uniform"
+            # the float64 noise is added in float64, as adding a numpy array to a row did
+            noise = torch.as_tensor(noise.reshape(-1, feat.shape[1]), device=feat.device)
+            feat[perturbed] = (feat[perturbed].double() + noise[perturbed]).to(feat.dtype)
 
-        return tmp_graph
+        if x_level == 'graph':
+            batch.x = feat
+        else:
+            batch.pos = feat
+        return batch
 
+    @torch.no_grad()
     def batch_perturb_features_on_node(self, num_samples, index_to_perturb,
-                                       percentage, x_level):
+                                       percentage, x_level, budget=None):
         clf_logits = self.model(self.graph)
-        soft_pred = clf_logits.sigmoid().detach().cpu().numpy()
+        soft_pred = clf_logits.sigmoid().detach().cpu().float().numpy().reshape(-1)
+        budget.charge(1) if budget is not None else None
+
+        # the perturbed graphs are scored in chunks of batch_size copies instead of one forward pass per sample.
+        # With a budget the round stops after the chunk that exhausts it or makes the p-value ranking converge,
+        # and the samples scored so far are returned. The ranking is checked every rank_every samples, so a round
+        # of a few chunks still has enough checks for rank_patience
+        masks, noise = self.sample_masks(num_samples, index_to_perturb, percentage, x_level)
+        perturb_logits = []
+        for i in range(0, num_samples, self.batch_size):
+            perturb_logits.append(self.model(self.perturb_batch(masks[i:i + self.batch_size], None if noise is None else noise[i:i + self.batch_size], x_level)))
+            if budget is not None:
+                budget.charge(perturb_logits[-1].shape[0])
+                num_scored = i + perturb_logits[-1].shape[0]
+                stop = budget.exhausted()
+                if budget.tracks_ranking and not stop:
+                    scored_logits = torch.cat(perturb_logits)
+                    for end in range((i // self.rank_every + 1) * self.rank_every, num_scored + 1, self.rank_every):
+                        if budget.update(self.sample_p_values(masks[:end], soft_pred, scored_logits[:end])):
+                            stop = True
+                            break
+                if stop:
+                    masks = masks[:num_scored]
+                    break
+        return self.label_samples(masks, soft_pred, torch.cat(perturb_logits))
+
+    def sample_p_values(self, masks, soft_pred, perturb_logits):
         num_nodes = self.X_feat.size(0)
-        Samples = []
-        for iteration in range(num_samples):
-            # perturb_feat = copy.deepcopy(candi_feat)
-            sample = np.zeros((num_nodes+1,))
+        return chi_square_tests(self.label_samples(masks, soft_pred, perturb_logits), num_nodes)[1][:num_nodes]
 
-            perturb_num = int(percentage / 100 * num_nodes)
+    def label_samples(self, masks, soft_pred, perturb_logits):
+        num_samples, num_nodes = masks.shape
+        soft_pred_perturb = perturb_logits.sigmoid().detach().cpu().float().numpy().reshape(-1)
 
-            perturb_indexes = np.random.permutation(index_to_perturb)[:perturb_num]
-            sample[perturb_indexes] = 1
-            perturb_graph = self.perturb_on_graph(perturb_indexes, x_level)
-
-            perturb_logits = self.model(perturb_graph)
-            soft_pred_perturb = perturb_logits.sigmoid().detach().cpu().numpy()
-            # self.model(tmp_g)
-            # soft_pred_perturb = np.asarray(softmax(self.model.readout[0].detach().cpu().numpy()))
-
-            pred_change = (soft_pred - soft_pred_perturb).item()
-            sample[-1] = pred_change
-            Samples.append(sample)
-        Samples = np.asarray(Samples)
+        pred_change = soft_pred - soft_pred_perturb
+        Samples = np.concatenate([masks, pred_change[:, None]], axis=1).astype(float)
         # np.set_printoptions(precision=0, suppress=True, threshold=np.inf)
         if self.perturb_indicator == "abs":
             Samples = np.abs(Samples)
 
         top = int(num_samples / 8)
         top_idx = np.argsort(Samples[:, num_nodes])[-top:]
-        #
-        # for i in range(num_samples):
-        for i in range(num_samples):
-            if self.pred_threshold:
-                if Samples[i, num_nodes] > self.pred_threshold:
-                    Samples[i, num_nodes] = 1
-                else:
-                    Samples[i, num_nodes] = 0
-            else:  # select most significant 1/8 changes and set to 1
-                if i in top_idx:
-                    Samples[i, num_nodes] = 1
-                else:
-                    Samples[i, num_nodes] = 0
+        if self.pred_threshold:
+            Samples[:, num_nodes] = Samples[:, num_nodes] > self.pred_threshold
+        else:  # select most significant 1/8 changes and set to 1
+            Samples[:, num_nodes] = 0
+            Samples[top_idx, num_nodes] = 1
         return Samples
 
-    def explain(self, x_level, num_samples=1000, percentage=20, top_node=5, p_threshold=0.05):
+    def explain(self, x_level, num_samples=1000, percentage=20, top_node=5, p_threshold=0.05, budget=None):
 
         num_nodes = self.X_feat.size(0)
 
         #       Round 1
-        Samples = self.batch_perturb_features_on_node(int(num_samples / 2), range(num_nodes), percentage, x_level)
-
-        data = pd.DataFrame(Samples)
-        p_values = []
+        Samples = self.batch_perturb_features_on_node(int(num_samples / 2), range(num_nodes), percentage, x_level, budget)
 
         target = num_nodes  # The entry for the graph classification result is at "num_nodes"
-        for node in range(num_nodes):
-            chi2, p, _ = chi_square(node, target, [], data, boolean=False)
-            p_values.append(p)
+        _, p_values = chi_square_tests(Samples, target)
+        p_values = p_values[:num_nodes]
+        if budget is not None and budget.exhausted():
+            # the p-values of the first round are the best-so-far result
+            return torch.tensor(p_values.tolist(), device=self.graph.x.device)
+        budget.reset_ranking() if budget is not None else None
 
         number_candidates = min(int(top_node * 2), num_nodes - 1)
         candidate_nodes = np.argpartition(p_values, number_candidates)[0:number_candidates]
 
         #         Round 2
-        Samples = self.batch_perturb_features_on_node(num_samples, candidate_nodes, percentage, x_level)
-        data = pd.DataFrame(Samples)
-
-        p_values = []
-        dependent_nodes = []
+        Samples = self.batch_perturb_features_on_node(num_samples, candidate_nodes, percentage, x_level, budget)
 
         target = num_nodes
-        for node in range(num_nodes):
-            chi2, p, _ = chi_square(node, target, [], data, boolean=False)
-            p_values.append(p)
-            if p < p_threshold:
-                dependent_nodes.append(node)
-        return torch.tensor(p_values, device=self.graph.x.device)
+        _, p_values = chi_square_tests(Samples, target)
+        p_values = p_values[:num_nodes]
+        dependent_nodes = np.nonzero(p_values < p_threshold)[0]
+        return torch.tensor(p_values.tolist(), device=self.graph.x.device)
 
 
 class PGMExplainer(BaseRandom):
@@ -180,20 +213,27 @@ class PGMExplainer(BaseRandom):
         self.pred_threshold = config['pred_threshold']
         self.percentage = config['percentage']
         self.perturb_mode = config['perturb_mode']
+        self.perturb_batch_size = config.get('perturb_batch_size', 250)
+        self.explain_workers = config.get('explain_workers', 0)
+        self.budget_config = {k: config[k] for k in ['max_evals', 'max_sec', 'rank_tol', 'rank_patience'] if k in config}
+        self.rank_every = config.get('rank_every', 25)
 
     def forward_pass(self, data, epoch, do_sampling):
         x_level = 'geometric'
         clf_logits = self.clf(data)
-        batch_imp = []
-        for graph in data.to_data_list():
-            node_imp = self.explain_graph(graph, x_level)
-            batch_imp += [node_imp]
+        graphs = data.to_data_list()
+        results = run_per_graph(type(self).explain_graph, [(graph, x_level) for graph in graphs],
+                                [graph.num_nodes for graph in graphs], self.explain_workers, shared=self)
+        batch_imp, diagnostics = zip(*results)
+        batch_imp = [node_imp.to(clf_logits.device) for node_imp in batch_imp]
         # imp = self.explain_graph(data, x_level)
         res_weights = self.min_max_scalar(torch.cat(batch_imp))
-        return -1, {}, clf_logits, res_weights
+        return -1, mean_diagnostics(diagnostics), clf_logits, res_weights
 
     def explain_graph(self, graph, x_level):
 
+        budget = ExplanationBudget.from_config(self.budget_config)
+        budget.charge(1)
         clf_logits = self.clf(graph)
         soft_pred = clf_logits.sigmoid()
         # self.model(graph)
@@ -204,11 +244,13 @@ class PGMExplainer(BaseRandom):
         explainer = MetaPGMExplainer(self.clf, graph,
                                      perturb_indicator="abs",
                                      perturb_mode=self.perturb_mode,
-                                     pred_threshold=self.pred_threshold)
+                                     pred_threshold=self.pred_threshold,
+                                     batch_size=self.perturb_batch_size,
+                                     rank_every=self.rank_every)
         pct = self.percentage / 100
         # int(graph.num_nodes / pct)
         p_values = explainer.explain(x_level=x_level, num_samples=500, p_threshold=0.05,
-                                     percentage=self.percentage, top_node=int(pct * graph.num_nodes))
+                                     percentage=self.percentage, top_node=int(pct * graph.num_nodes), budget=budget)
         # p_values = np.array(p_values)
         row, col = graph.edge_index #.detach().cpu()
         edge_imp = (1-p_values[row]) * (1-p_values[col])
@@ -224,7 +266,7 @@ class PGMExplainer(BaseRandom):
         edge_imp = norm_imp(edge_imp)
 
         # edge_imp if x_level == 'graph' else
-        return 1-p_values if x_level == 'geometric' else edge_imp
+        return (1-p_values if x_level == 'geometric' else edge_imp), budget.finish()
 
 
 EPS = 1e-6
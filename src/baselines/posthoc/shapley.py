@@ -1,14 +1,17 @@
 import copy
 import torch
+from collections import OrderedDict
 import numpy as np
 from typing import Callable, Union
 from scipy.special import comb
+import scipy.sparse as sp
 from itertools import combinations
 import torch.nn.functional as F
 from torch_geometric.utils import to_networkx
 from torch_geometric.data import Data, Batch, Dataset
 from torch_geometric.loader import DataLoader
 import networkx as nx
+from utils.get_data_loaders import replicate_edge_index
 #from .utils.testing_datasets import MarginalSubgraphDataset
 
 '''
@@ -17,6 +20,8 @@ Code: https://github.com/divelab/DIG
 '''
 
 empty_tuple = tuple()
+# nodes per forward pass when the Monte-Carlo subgraphs are scored in batch
+MAX_BATCH_NODES = 2 ** 17
 
 class MarginalSubgraphDataset(Dataset):
     """ Collect pair-wise graph data to calculate marginal contribution. """
@@ -44,6 +49,86 @@ class MarginalSubgraphDataset(Dataset):
         include_data = Data(x=include_graph_X, edge_index=include_graph_edge_index, pos=include_pos)
         return exclude_data, include_data
 
+class NeighborIndex(object):
+    """ Adjacency of one graph, built once and shared by the MCTS expansion and the local Shapley rewards. """
+    def __init__(self, data):
+        # the neighbour lists keep the order of networkx, which decides the order of the players sampled below
+        graph = to_networkx(data)
+        self.num_nodes = graph.number_of_nodes()
+        self.neighbors = [list(graph.neighbors(node)) for node in range(self.num_nodes)]
+
+        # undirected adjacency for the degrees of coalition subgraphs, a self-loop counts twice as in networkx
+        self.undirected_graph = to_networkx(data, to_undirected=True)
+        edges = np.array(list(self.undirected_graph.edges()), dtype=np.int64).reshape(-1, 2)
+        loops = edges[:, 0] == edges[:, 1]
+        row = np.concatenate([edges[:, 0], edges[~loops, 1]])
+        col = np.concatenate([edges[:, 1], edges[~loops, 0]])
+        value = np.where(np.concatenate([loops, np.zeros((~loops).sum(), dtype=bool)]), 2, 1)
+        self.adj = sp.csr_matrix((value, (row, col)), shape=(self.num_nodes, self.num_nodes))
+        self.regions = {}
+
+    def local_region(self, coalition, local_radius):
+        """ nodes within local_radius - 1 hops of the coalition, in the order the per-call expansion produced """
+        key = (tuple(coalition), local_radius)
+        if key not in self.regions:
+            local_region = copy.copy(coalition)
+            for k in range(local_radius - 1):
+                k_neiborhoood = []
+                for node in local_region:
+                    k_neiborhoood += self.neighbors[node]
+                local_region += k_neiborhoood
+                local_region = list(set(local_region))
+            self.regions[key] = local_region
+        return self.regions[key]
+
+    def subgraph_degree(self, coalition):
+        """ (node, degree) pairs of the subgraph induced by coalition, as list(graph.subgraph(coalition).degree) """
+        # networkx walks the node set of the subgraph when it is less than half of the graph, else the graph's nodes
+        nodes = list(set(coalition)) if 2 * len(coalition) < self.num_nodes else sorted(coalition)
+        degree = np.asarray(self.adj[nodes][:, nodes].sum(axis=1)).reshape(-1)
+        return list(zip(nodes, degree.tolist()))
+
+
+class CoalitionValueCache(object):
+    """ LRU cache of value_func outputs keyed by the node mask of a subgraph, for one explained graph. """
+    def __init__(self, max_size=2 ** 16):
+        self.max_size = max_size
+        self.values = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def keys(node_masks: np.ndarray, build_func):
+        packed = np.packbits(node_masks == 1, axis=1)
+        return [(build_func.__name__, row.tobytes()) for row in packed]
+
+    def lookup(self, keys):
+        # cached values (None if missing) and the first index of every missing key; a key repeated within keys is
+        # scored once, so its repeats count as hits and the misses are exactly the masks that are scored
+        values = [self.values.get(key) for key in keys]
+        first = {}
+        for i, key in enumerate(keys):
+            if values[i] is None:
+                first.setdefault(key, i)
+            else:
+                self.values.move_to_end(key)
+        self.misses += len(first)
+        self.hits += len(keys) - len(first)
+        return values, first
+
+    def put(self, key, value):
+        self.values[key] = value
+        self.values.move_to_end(key)
+        while len(self.values) > self.max_size:
+            self.values.popitem(last=False)
+
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def diagnostics(self):
+        return {'cache_hits': self.hits, 'cache_misses': self.misses, 'cache_hit_rate': self.hit_rate()}
+
+
 def GnnNets_GC2value_func(gnnNets, target_class, forward_kwargs = {}):
     def value_func(batch):
         with torch.no_grad():
@@ -83,8 +168,36 @@ def get_graph_build_func(build_method):
 
 
 def marginal_contribution(data: Data, exclude_mask: np.ndarray, include_mask: np.ndarray,
-                          value_func, subgraph_build_func):
+                          value_func, subgraph_build_func, max_batch_nodes=MAX_BATCH_NODES, value_cache=None):
     """ Calculate the marginal value for each pair. Here exclude_mask and include_mask are node mask. """
+    batch_build_func = batch_build_funcs.get(subgraph_build_func)
+    if batch_build_func is not None:
+        # all exclude and include subgraphs are built from the replicated graph and scored together,
+        # max_batch_nodes bounds the number of nodes per forward pass
+        node_masks = np.concatenate([exclude_mask, include_mask])
+        values = [None] * node_masks.shape[0]
+        keys = CoalitionValueCache.keys(node_masks, subgraph_build_func) if value_cache is not None else None
+        if keys is not None:
+            # only the masks that are neither cached nor repeated within this call are scored
+            values, first = value_cache.lookup(keys)
+            todo = list(first.values())
+        else:
+            todo = list(range(node_masks.shape[0]))
+
+        if todo:
+            masks = torch.tensor(node_masks[todo], dtype=torch.float32, device=data.x.device)
+            graphs_per_batch = max(1, max_batch_nodes // max(data.num_nodes, 1))
+            scored = torch.cat([value_func(batch_build_func(data, masks[i:i + graphs_per_batch]))
+                                for i in range(0, masks.shape[0], graphs_per_batch)], dim=0)
+            for i, value in zip(todo, scored.tolist()):
+                values[i] = value
+                if keys is not None:
+                    value_cache.put(keys[i], value)
+        if keys is not None:
+            values = [values[i] if values[i] is not None else values[first[key]] for i, key in enumerate(keys)]
+        values = torch.tensor(values, device=data.x.device)
+        return values[exclude_mask.shape[0]:] - values[:exclude_mask.shape[0]]
+
     marginal_subgraph_dataset = MarginalSubgraphDataset(data, exclude_mask, include_mask, subgraph_build_func)
     dataloader = DataLoader(marginal_subgraph_dataset, batch_size=256, shuffle=False, pin_memory=False, num_workers=0)
 
@@ -111,6 +224,44 @@ def graph_build_zero_filling(data, node_mask: torch.Tensor):
     return X, pos, edge_index
 
 
+def batch_build_zero_filling(data, node_masks: torch.Tensor):
+    """ graph_build_zero_filling for every row of node_masks, collated into one Batch """
+    num_graphs, num_nodes = node_masks.shape
+    node_mask = node_masks.reshape(-1, 1)
+    x = data.x.repeat(num_graphs, 1) * node_mask
+    pos = None if data.pos is None else data.pos.repeat(num_graphs, 1) * node_mask
+    edge_index = replicate_edge_index(data.edge_index, num_graphs, num_nodes)
+    batch = torch.arange(num_graphs, device=x.device).repeat_interleave(num_nodes)
+    ptr = torch.arange(num_graphs + 1, device=x.device) * num_nodes
+    return Batch(x=x, pos=pos, edge_index=edge_index, batch=batch, ptr=ptr)
+
+
+def batch_build_split(data, node_masks: torch.Tensor):
+    """ graph_build_split for every row of node_masks, collated into one Batch """
+    num_graphs, num_nodes = node_masks.shape
+    node_mask = node_masks.reshape(-1) == 1
+    edge_index = replicate_edge_index(data.edge_index, num_graphs, num_nodes)
+    edge_index = edge_index[:, node_mask[edge_index[0]] & node_mask[edge_index[1]]]
+
+    # the nodes of a subgraph are the ones left with an edge, a subgraph without edges keeps all nodes zero filled
+    keep = torch.zeros(num_graphs * num_nodes, dtype=torch.bool, device=edge_index.device)
+    keep[edge_index.reshape(-1)] = True
+    empty = ~keep.view(num_graphs, num_nodes).any(dim=1)
+    keep.view(num_graphs, num_nodes)[empty] = True
+    zero = empty.repeat_interleave(num_nodes)[keep]
+
+    x = data.x.repeat(num_graphs, 1)[keep]
+    x[zero] = 0
+    pos = None
+    if data.pos is not None:
+        pos = data.pos.repeat(num_graphs, 1)[keep]
+        pos[zero] = 0
+    node_idx = keep.long().cumsum(0) - 1
+    batch = torch.arange(num_graphs, device=x.device).repeat_interleave(num_nodes)[keep]
+    ptr = torch.cat([batch.new_zeros(1), keep.view(num_graphs, num_nodes).sum(dim=1).cumsum(0)])
+    return Batch(x=x, pos=pos, edge_index=node_idx[edge_index], batch=batch, ptr=ptr)
+
+
 def graph_build_split(data, node_mask: torch.Tensor):
     """ subgraph building through spliting the selected nodes from the original graph """
     x, pos, edge_index = data.x, data.pos, data.edge_index
@@ -142,20 +293,18 @@ def graph_build_split(data, node_mask: torch.Tensor):
     return x, pos, edge_index
 
 
+batch_build_funcs = {graph_build_zero_filling: batch_build_zero_filling, graph_build_split: batch_build_split}
+
+
 def l_shapley(coalition: list, data: Data, local_raduis: int,
-              value_func: Callable, subgraph_building_method='zero_filling'):
+              value_func: Callable, subgraph_building_method='zero_filling', graph_index=None,
+              max_batch_nodes=MAX_BATCH_NODES, value_cache=None):
     """ shapley value where players are local neighbor nodes """
-    graph = to_networkx(data)
-    num_nodes = graph.number_of_nodes()
+    graph_index = NeighborIndex(data) if graph_index is None else graph_index
+    num_nodes = graph_index.num_nodes
     subgraph_build_func = get_graph_build_func(subgraph_building_method)
 
-    local_region = copy.copy(coalition)
-    for k in range(local_raduis - 1):
-        k_neiborhoood = []
-        for node in local_region:
-            k_neiborhoood += list(graph.neighbors(node))
-        local_region += k_neiborhoood
-        local_region = list(set(local_region))
+    local_region = graph_index.local_region(coalition, local_raduis)
 
     set_exclude_masks = []
     set_include_masks = []
@@ -184,7 +333,7 @@ def l_shapley(coalition: list, data: Data, local_raduis: int,
     coeffs = torch.tensor(1.0 / comb(p, S) / (p - S + 1e-6))
 
     marginal_contributions = \
-        marginal_contribution(data, exclude_mask, include_mask, value_func, subgraph_build_func)
+        marginal_contribution(data, exclude_mask, include_mask, value_func, subgraph_build_func, max_batch_nodes, value_cache)
 
     l_shapley_value = (marginal_contributions.squeeze().cpu() * coeffs).sum().item()
     return l_shapley_value
@@ -192,7 +341,7 @@ def l_shapley(coalition: list, data: Data, local_raduis: int,
 
 def mc_shapley(coalition: list, data: Data,
                value_func: Callable, subgraph_building_method='zero_filling',
-               sample_num=1000) -> float:
+               sample_num=1000, max_batch_nodes=MAX_BATCH_NODES, value_cache=None) -> float:
     """ monte carlo sampling approximation of the shapley value """
     subset_build_func = get_graph_build_func(subgraph_building_method)
 
@@ -218,7 +367,7 @@ def mc_shapley(coalition: list, data: Data,
 
     exclude_mask = np.stack(set_exclude_masks, axis=0)
     include_mask = np.stack(set_include_masks, axis=0)
-    marginal_contributions = marginal_contribution(data, exclude_mask, include_mask, value_func, subset_build_func)
+    marginal_contributions = marginal_contribution(data, exclude_mask, include_mask, value_func, subset_build_func, max_batch_nodes, value_cache)
     mc_shapley_value = marginal_contributions.mean().item()
 
     return mc_shapley_value
@@ -226,19 +375,13 @@ def mc_shapley(coalition: list, data: Data,
 
 def mc_l_shapley(coalition: list, data: Data, local_raduis: int,
                  value_func: Callable, subgraph_building_method='zero_filling',
-                 sample_num=1000) -> float:
+                 sample_num=1000, graph_index=None, max_batch_nodes=MAX_BATCH_NODES, value_cache=None) -> float:
     """ monte carlo sampling approximation of the l_shapley value """
-    graph = to_networkx(data)
-    num_nodes = graph.number_of_nodes()
+    graph_index = NeighborIndex(data) if graph_index is None else graph_index
+    num_nodes = graph_index.num_nodes
     subgraph_build_func = get_graph_build_func(subgraph_building_method)
 
-    local_region = copy.copy(coalition)
-    for k in range(local_raduis - 1):
-        k_neiborhoood = []
-        for node in local_region:
-            k_neiborhoood += list(graph.neighbors(node))
-        local_region += k_neiborhoood
-        local_region = list(set(local_region))
+    local_region = graph_index.local_region(coalition, local_raduis)
 
     coalition_placeholder = num_nodes
     set_exclude_masks = []
@@ -264,7 +407,7 @@ def mc_l_shapley(coalition: list, data: Data, local_raduis: int,
     exclude_mask = np.stack(set_exclude_masks, axis=0)
     include_mask = np.stack(set_include_masks, axis=0)
     marginal_contributions = \
-        marginal_contribution(data, exclude_mask, include_mask, value_func, subgraph_build_func)
+        marginal_contribution(data, exclude_mask, include_mask, value_func, subgraph_build_func, max_batch_nodes, value_cache)
 
     mc_l_shapley_value = (marginal_contributions).mean().item()
     return mc_l_shapley_value
@@ -286,19 +429,14 @@ def gnn_score(coalition: list, data: Data, value_func: Callable,
 
 
 def NC_mc_l_shapley(coalition: list, data: Data, local_raduis: int,
-                    value_func: Callable, node_idx: int=-1, subgraph_building_method='zero_filling', sample_num=1000) -> float:
+                    value_func: Callable, node_idx: int=-1, subgraph_building_method='zero_filling', sample_num=1000,
+                    graph_index=None, max_batch_nodes=MAX_BATCH_NODES, value_cache=None) -> float:
     """ monte carlo approximation of l_shapley where the target node is kept in both subgraph """
-    graph = to_networkx(data)
-    num_nodes = graph.number_of_nodes()
+    graph_index = NeighborIndex(data) if graph_index is None else graph_index
+    num_nodes = graph_index.num_nodes
     subgraph_build_func = get_graph_build_func(subgraph_building_method)
 
-    local_region = copy.copy(coalition)
-    for k in range(local_raduis - 1):
-        k_neiborhoood = []
-        for node in local_region:
-            k_neiborhoood += list(graph.neighbors(node))
-        local_region += k_neiborhoood
-        local_region = list(set(local_region))
+    local_region = graph_index.local_region(coalition, local_raduis)
 
     coalition_placeholder = num_nodes
     set_exclude_masks = []
@@ -323,7 +461,7 @@ def NC_mc_l_shapley(coalition: list, data: Data, local_raduis: int,
     exclude_mask = np.stack(set_exclude_masks, axis=0)
     include_mask = np.stack(set_include_masks, axis=0)
     marginal_contributions = \
-        marginal_contribution(data, exclude_mask, include_mask, value_func, subgraph_build_func)
+        marginal_contribution(data, exclude_mask, include_mask, value_func, subgraph_build_func, max_batch_nodes, value_cache)
 
     mc_l_shapley_value = (marginal_contributions).mean().item()
     return mc_l_shapley_value
\ No newline at end of file
@@ -3,16 +3,16 @@ import torch
 import torch.nn as nn
 from torch import Tensor
 from functools import partial
-from collections import Counter
 import torch.nn.functional as F
-from .shapley import gnn_score, mc_shapley, l_shapley, mc_l_shapley, NC_mc_l_shapley
+from .shapley import gnn_score, mc_shapley, l_shapley, mc_l_shapley, NC_mc_l_shapley, NeighborIndex, MAX_BATCH_NODES, CoalitionValueCache
 import networkx as nx
 from typing import Callable, Optional, Tuple
-from torch_geometric.utils import to_networkx
 from torch_geometric.utils.num_nodes import maybe_num_nodes
 from torch_geometric.nn import MessagePassing
 from torch_geometric.data import Data, Batch
 from ..base import BaseRandom
+from utils.parallel_utils import run_per_graph
+from utils.budget_utils import ExplanationBudget, mean_diagnostics, cache_keys
 
 def compute_scores(score_func, children):
     results = []
@@ -49,6 +49,9 @@ def find_closest_node_result(results, max_nodes):
 def find_closest_node_result_list(results, nodes_num_list):
     result_list = []
     for node_num in nodes_num_list:  # 10, 12 increase
+        if not results:
+            # a search stopped by its budget may have fewer states than sparsity levels
+            break
         result_node = find_closest_node_result(results, node_num)
         results.remove(result_node)
         result_list.append(result_node)
@@ -57,7 +60,8 @@ def find_closest_node_result_list(results, nodes_num_list):
 
 def reward_func(reward_method, value_func,
                 local_radius=4, sample_num=100,
-                subgraph_building_method='split'):
+                subgraph_building_method='split', graph_index=None, max_batch_nodes=MAX_BATCH_NODES,
+                value_cache=None):
     if reward_method.lower() == 'gnn_score':
         return partial(gnn_score,
                        value_func=value_func,
@@ -67,20 +71,28 @@ def reward_func(reward_method, value_func,
         return partial(mc_shapley,
                        value_func=value_func,
                        subgraph_building_method=subgraph_building_method,
-                       sample_num=sample_num)
+                       sample_num=sample_num,
+                       max_batch_nodes=max_batch_nodes,
+                       value_cache=value_cache)
 
     elif reward_method.lower() == 'l_shapley':
         return partial(l_shapley,
                        local_raduis=local_radius,
                        value_func=value_func,
-                       subgraph_building_method=subgraph_building_method)
+                       subgraph_building_method=subgraph_building_method,
+                       graph_index=graph_index,
+                       max_batch_nodes=max_batch_nodes,
+                       value_cache=value_cache)
 
     elif reward_method.lower() == 'mc_l_shapley':
         return partial(mc_l_shapley,
                        local_raduis=local_radius,
                        value_func=value_func,
                        subgraph_building_method=subgraph_building_method,
-                       sample_num=sample_num)
+                       sample_num=sample_num,
+                       graph_index=graph_index,
+                       max_batch_nodes=max_batch_nodes,
+                       value_cache=value_cache)
     else:
         raise NotImplementedError
 
@@ -188,15 +200,19 @@ class MCTS(object):
         high2low (:obj:`bool`): Whether to expand children tree node from high degree nodes to low degree nodes.
         node_idx (:obj:`int`): The target node index to extract the neighborhood.
         score_func (:obj:`Callable`): The reward function for tree node, such as mc_shapely and mc_l_shapely.
+        budget (:obj:`ExplanationBudget`): Stops the search once exhausted or converged, checked after every expansion.
+        node_scores (:obj:`Callable`): Node scores of the best-so-far explanation of the search, for the convergence.
     """
     # score_threshold = 0.3
     def __init__(self, graph, num_hops: int, use_mcts=True, use_pruning=True,
                  n_rollout: int = 20, min_atoms: int = 3, c_puct: float = 10.0,
-                 expand_atoms: int = 14, high2low: bool = False, score_func: Callable = None, score_threshold: float = 0.3):
+                 expand_atoms: int = 14, high2low: bool = False, score_func: Callable = None, score_threshold: float = 0.3,
+                 graph_index: NeighborIndex = None, budget: ExplanationBudget = None, node_scores: Callable = None):
 
         self.num_hops = num_hops
         self.data = graph
-        self.graph = to_networkx(self.data, to_undirected=True)  # NETWORKX VERSION OF GRAPH
+        self.graph_index = NeighborIndex(self.data) if graph_index is None else graph_index
+        self.graph = self.graph_index.undirected_graph  # NETWORKX VERSION OF GRAPH
         self.data = Batch.from_data_list([self.data])
         self.num_nodes = self.graph.number_of_nodes()
         self.score_func = score_func
@@ -208,6 +224,9 @@ class MCTS(object):
         self.score_threshold = score_threshold
         self.use_mcts = use_mcts
         self.use_pruning = use_pruning
+        self.budget = budget
+        self.node_scores = node_scores
+        self.stopped = False
 
         inv_mapping = None
 
@@ -216,7 +235,8 @@ class MCTS(object):
         self.root_coalition = sorted([node for node in range(self.num_nodes)])
         self.MCTSNodeClass = partial(MCTSNode, data=self.data, ori_graph=self.graph, c_puct=self.c_puct, mapping=inv_mapping)
         self.root = self.MCTSNodeClass(self.root_coalition)  # Root of tree
-        self.state_map = {str(self.root.coalition): self.root}
+        # states are keyed by their sorted coalition tuple, so merging identical sub-graphs is a dict lookup
+        self.state_map = {tuple(self.root.coalition): self.root}
 
     def set_score_func(self, score_func):
         self.score_func = score_func
@@ -239,6 +259,8 @@ class MCTS(object):
 
     def mcts_rollout(self, tree_node):
         cur_graph_coalition = tree_node.coalition
+        if self.stopped:
+            return tree_node.P
         if len(cur_graph_coalition) <= self.min_atoms:
             return tree_node.P
         if tree_node.signal == -1 and self.use_pruning:
@@ -246,7 +268,7 @@ class MCTS(object):
 
         # Expand if this node has never been visited
         if len(tree_node.children) == 0:
-            node_degree_list = list(self.graph.subgraph(cur_graph_coalition).degree)
+            node_degree_list = self.graph_index.subgraph_degree(cur_graph_coalition)
             node_degree_list = sorted(node_degree_list, key=lambda x: x[1], reverse=self.high2low)
             all_nodes = [x[0] for x in node_degree_list]
 
@@ -255,40 +277,22 @@ class MCTS(object):
             else:
                 expand_nodes = all_nodes[:self.expand_atoms]
 
+            children = set()
             for each_node in expand_nodes:
                 # for each node, pruning it and get the remaining sub-graph
-                # here we check the resulting sub-graphs and only keep the largest one
-                subgraph_coalition = [node for node in all_nodes if node != each_node]
-
-                subgraphs = [self.graph.subgraph(c)
-                             for c in nx.connected_components(self.graph.subgraph(subgraph_coalition))]
-                main_sub = subgraphs[0]
-                for sub in subgraphs:
-                    if sub.number_of_nodes() > main_sub.number_of_nodes():
-                        main_sub = sub
-
-                new_graph_coalition = sorted(subgraph_coalition)
+                new_graph_coalition = sorted([node for node in all_nodes if node != each_node])
+                key = tuple(new_graph_coalition)
 
                 # check the state map and merge the same sub-graph
-                Find_same = False
-                for old_graph_node in self.state_map.values():
-                    if Counter(old_graph_node.coalition) == Counter(new_graph_coalition):
-                        new_node = old_graph_node
-                        Find_same = True
-
-                if Find_same == False:
+                new_node = self.state_map.get(key)
+                if new_node is None:
                     new_node = self.MCTSNodeClass(new_graph_coalition)
-                    self.state_map[str(new_graph_coalition)] = new_node
+                    self.state_map[key] = new_node
 
-                Find_same_child = False
-                for cur_child in tree_node.children:
-                    if Counter(cur_child.coalition) == Counter(new_graph_coalition):
-                        Find_same_child = True
-
-                if Find_same_child == False:
+                if key not in children:
+                    children.add(key)
                     tree_node.children.append(new_node)
 
-
             scores = compute_scores(self.score_func, tree_node.children)
 
             # label_nodes = set(torch.where(self.data.node_label)[0].numpy())
@@ -304,6 +308,12 @@ class MCTS(object):
                 #     pass
                     # print(f"Labeled Nodes: {label_nodes}, Subgraph: {set(child.coalition)}, Value: {score}")
 
+            # the states explored so far are the best-so-far result once the search stops
+            if self.budget is not None and self.budget.should_stop(
+                    self.node_scores(self) if self.node_scores is not None and self.budget.tracks_ranking else None):
+                self.stopped = True
+                return tree_node.P
+
         sum_count = sum([c.N for c in tree_node.children])
         if self.use_mcts:
             selected_node = max(tree_node.children, key=lambda x: x.Q() + x.U(sum_count))
@@ -329,10 +339,11 @@ class MCTS(object):
             # if verbose:
             #     print(f"At the {rollout_idx} rollout, {len(self.state_map)} states that have been explored.")
 
-        explanations = [node for _, node in self.state_map.items()]
-        explanations = sorted(explanations, key=lambda x: x.P, reverse=True)
+        return self.explanations()
+
+    def explanations(self):
         # Sorts explanations based on P value (i.e. Score(.,.,.) function in MCTS)
-        return explanations
+        return sorted(self.state_map.values(), key=lambda x: x.P, reverse=True)
 
 
 class SubgraphX(BaseRandom):
@@ -386,6 +397,10 @@ class SubgraphX(BaseRandom):
         self.use_pruning = config['use_pruning']
         self.high2low = config['high2low']  # False
         self.subgraph_building_method = config['subgraph_building_method']  # "zero_filling"
+        self.max_batch_nodes = config.get('max_batch_nodes', MAX_BATCH_NODES)
+        self.value_cache_size = config.get('value_cache_size', 2 ** 16)
+        self.explain_workers = config.get('explain_workers', 0)
+        self.budget_config = {k: config[k] for k in ['max_evals', 'max_sec', 'rank_tol', 'rank_patience'] if k in config}
         # # mcts hyper-parameters
         # self.rollout = rollout
         # self.min_atoms = min_atoms  # N_{min}
@@ -402,11 +417,11 @@ class SubgraphX(BaseRandom):
     def forward_pass(self, data, epoch, do_sampling, **kwargs):
         x_level = 'geometric'
         clf_logits = self.clf(data)
-        batch_imp = []
-        for graph in data.to_data_list():
-            imp = self.get_explanation_graph(graph, x_level, self.sparsity_set)
-            batch_imp += [imp]
-        return -1, {}, clf_logits, torch.cat(batch_imp)
+        graphs = data.to_data_list()
+        results = run_per_graph(type(self).get_explanation_graph, [(graph, x_level, self.sparsity_set) for graph in graphs],
+                                [graph.num_nodes for graph in graphs], self.explain_workers, shared=self)
+        batch_imp, diagnostics = zip(*results)
+        return -1, mean_diagnostics(diagnostics), clf_logits, torch.cat([imp.to(clf_logits.device) for imp in batch_imp])
 
     def update_num_hops(self, num_hops):
         if num_hops is not None:
@@ -418,16 +433,22 @@ class SubgraphX(BaseRandom):
                 k += 1
         return k
 
-    def get_reward_func(self, value_func):
+    def get_reward_func(self, value_func, graph_index=None, value_cache=None):
         return reward_func(reward_method=self.reward_method,
                            value_func=value_func,
                            local_radius=self.local_radius,
                            sample_num=self.sample_num,
-                           subgraph_building_method=self.subgraph_building_method)
+                           subgraph_building_method=self.subgraph_building_method,
+                           graph_index=graph_index,
+                           max_batch_nodes=self.max_batch_nodes,
+                           value_cache=value_cache)
 
-    def get_mcts_class(self, graph, score_func: Callable = None):
+    def get_mcts_class(self, graph, score_func: Callable = None, graph_index=None, budget=None, node_scores=None):
         # only for graph classification
         return MCTS(graph, use_mcts=self.use_mcts,
+                    graph_index=graph_index,
+                    budget=budget,
+                    node_scores=node_scores,
                     use_pruning=self.use_pruning,
                     score_func=score_func,
                     num_hops=self.num_hops,
@@ -459,6 +480,8 @@ class SubgraphX(BaseRandom):
                 (default: :obj:`{}`)
         :rtype: :class:`Explanation`
         Returns:
+            The node (or edge) importance of the best-so-far explanation and the budget and value cache diagnostics
+            of the search.
             exp (dict):
                 exp['feature_imp'] is `None` because no feature explanations are generated.
                 exp['node_imp'] (torch.Tensor, (n,)): Node mask of size `(n,)` where `n`
@@ -490,10 +513,19 @@ class SubgraphX(BaseRandom):
         #
         # prediction = probs.argmax(-1)
 
-        value_func = self._prob_score_func_graph(target_class=label)
+        budget = ExplanationBudget.from_config(self.budget_config)
+        value_func = self._prob_score_func_graph(target_class=label, budget=budget)
+
+        graph_index = NeighborIndex(graph)
+        # values of identical subgraphs are shared across the Shapley samples and rollouts of this graph only
+        value_cache = CoalitionValueCache(self.value_cache_size) if self.value_cache_size > 0 else None
+        payoff_func = self.get_reward_func(value_func, graph_index, value_cache)
 
-        payoff_func = self.get_reward_func(value_func)
-        self.mcts_state_map = self.get_mcts_class(graph, score_func=payoff_func)
+        def node_scores(mcts):
+            best_results = find_closest_node_result_list(mcts.explanations(), sub_nodes_list)
+            return self.__parse_results_list(best_results, edge_index)[0]
+        self.mcts_state_map = self.get_mcts_class(graph, score_func=payoff_func, graph_index=graph_index,
+                                                  budget=budget, node_scores=node_scores)
         results = self.mcts_state_map.mcts(verbose=False)
 
         # best_result = find_closest_node_result(results, max_nodes=max_nodes)
@@ -510,18 +542,23 @@ class SubgraphX(BaseRandom):
         # exp.edge_imp = edge_mask
 
         # return {'feature_imp': None, 'node_imp': node_mask, 'edge_imp': edge_mask}
-        return edge_imp if hasattr(graph, 'edge_label') else node_imp
+        diagnostics = budget.finish()
+        diagnostics.update(value_cache.diagnostics() if value_cache is not None else {k: 0 for k in cache_keys})
+        return (edge_imp if hasattr(graph, 'edge_label') else node_imp), diagnostics
 
-    def _prob_score_func_graph(self, target_class):
+    def _prob_score_func_graph(self, target_class, budget=None):
         """
         Get a function that computes the predicted probability that the input graphs
         are classified as target classes.
         Args:
             target_class (int): the targeted class of the graph
+            budget (ExplanationBudget, optional): charged with the number of graphs scored
         Returns:
             get_prob_score (callable): the probability score function
         """
         def get_prob_score(graph):
+            if budget is not None:
+                budget.charge(getattr(graph, 'num_graphs', 1))
             prob = self.clf(graph).sigmoid()
             score = prob if target_class == 1 else 1-prob
             # score = prob[:, target_class]
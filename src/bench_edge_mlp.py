@@ -0,0 +1,88 @@
+import time
+import argparse
+import torch
+from backbones.egnn import E_GCL_mask
+from backbones.dgcnn import EdgeConv
+from utils import MLP
+
+
+def knn_edges(pos, batch, k):
+    # brute-force kNN per graph, with the same flow (source -> target) as knn_graph(..., loop=True)
+    rows, cols = [], []
+    for b in batch.unique():
+        idx = (batch == b).nonzero().view(-1)
+        nbr = torch.cdist(pos[idx], pos[idx]).topk(min(k, idx.numel()), largest=False).indices
+        rows.append(idx[nbr.reshape(-1)])
+        cols.append(idx.repeat_interleave(nbr.shape[1]))
+    return torch.stack([torch.cat(rows), torch.cat(cols)])
+
+
+def first_layer_cost(conv_name, N, E, H, e_dim):
+    # (flops, floats of per-edge intermediates up to the output of the first linear layer)
+    if conv_name == 'egnn':
+        base = (2 * E * (2 * H + 1 + e_dim) * H, 2 * E * H + E * (2 * H + 1 + e_dim))
+        fact = (2 * N * H * 2 * H + 2 * E * (1 + e_dim) * H + 2 * E * H, 2 * N * H + 2 * E * H + E * (1 + e_dim))
+    else:
+        base = (2 * E * 3 * H * 2 * H + E * H, 3 * E * H + E * 3 * H)
+        fact = (2 * 2 * N * H * 2 * H + 2 * E * H * 2 * H + 2 * E * 2 * H, 2 * N * 2 * H + 2 * E * 2 * H)
+    return base, fact
+
+
+def timeit(fn, n_iters, device):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    peak = torch.cuda.max_memory_allocated() / 1024 ** 2 if device.type == 'cuda' else float('nan')
+    return (time.perf_counter() - start) / n_iters * 1000, peak
+
+
+def main(args):
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    H = args.hidden_size
+    batch = torch.arange(args.num_graphs).repeat_interleave(args.nodes_per_graph).to(device)
+    pos = torch.randn(batch.shape[0], 3, device=device)
+    h = torch.randn(batch.shape[0], H, device=device)
+
+    print(f'{args.num_graphs} graphs x {args.nodes_per_graph} nodes, hidden_size {H}, one conv layer, forward only')
+    print(f'{"conv":<6} {"k":>3} {"GFLOPs":>15} {"MFloats":>15} {"ms":>17} {"CUDA MB":>15} {"max diff":>9}')
+    for conv_name in ['egnn', 'dgcnn']:
+        for k in range(args.k_min, args.k_max + 1):
+            edge_index = knn_edges(pos, batch, k)
+            E = edge_index.shape[1]
+            edge_attr = torch.randn(E, H, device=device)
+            outs, stats = [], []
+            for factorize in [False, True]:
+                torch.manual_seed(0)
+                if conv_name == 'egnn':
+                    conv = E_GCL_mask(H, H, H, edges_in_d=H, act_fn=torch.nn.ReLU(), norm_type='batch', recurrent=False, attention=False, factorize=factorize)
+                    fn = lambda: conv(h, edge_index, pos, batch, edge_attr=edge_attr)[0]
+                else:
+                    conv = EdgeConv(MLP([H * 3, H * 2, H], 0.0, 'batch', 'relu'), H, 'batch', 'relu', aggr='mean', factorize=factorize)
+                    fn = lambda: conv(h, edge_index, batch=batch, edge_attr=edge_attr)
+                conv = conv.to(device).eval()
+                with torch.no_grad():
+                    outs.append(fn())
+                    stats.append(timeit(fn, args.n_iters, device))
+            (base_flops, base_mem), (fact_flops, fact_mem) = first_layer_cost(conv_name, h.shape[0], E, H, H)
+            print(f'{conv_name:<6} {k:>3} {base_flops / 1e9:>7.3f}/{fact_flops / 1e9:<7.3f} {base_mem / 1e6:>7.2f}/{fact_mem / 1e6:<7.2f} '
+                  f'{stats[0][0]:>8.2f}/{stats[1][0]:<8.2f} {stats[0][1]:>7.1f}/{stats[1][1]:<7.1f} {(outs[0] - outs[1]).abs().max().item():>9.1e}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the factorized first edge-MLP layer (baseline/factorized)')
+    parser.add_argument('--num_graphs', type=int, help='graphs per batch', default=128)
+    parser.add_argument('--nodes_per_graph', type=int, help='nodes per graph', default=100)
+    parser.add_argument('--hidden_size', type=int, help='hidden size', default=64)
+    parser.add_argument('--k_min', type=int, help='smallest k of the kNN graph', default=5)
+    parser.add_argument('--k_max', type=int, help='largest k of the kNN graph', default=10)
+    parser.add_argument('--n_iters', type=int, help='timed iterations', default=20)
+    parser.add_argument('--device', type=str, help='cpu or cuda', default='cpu')
+    args = parser.parse_args()
+    main(args)
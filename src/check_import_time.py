@@ -0,0 +1,45 @@
+import sys
+import json
+import argparse
+import subprocess
+
+# modules that only some datasets/methods need; they must not be pulled in by importing the entry points
+heavy_modules = ['rdkit', 'Bio', 'pint', 'nni', 'torch_sparse', 'networkx', 'pgmpy', 'torch.utils.tensorboard']
+
+
+def measure(module):
+    # import in a fresh interpreter so that nothing is cached from previous measurements
+    code = 'import sys, time, json\n' \
+           'import torch, torch_geometric\n' \
+           't = time.perf_counter()\n' \
+           f'import {module}\n' \
+           f'print(json.dumps([time.perf_counter() - t, [m for m in {heavy_modules} if m in sys.modules]]))'
+    proc = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+    if proc.returncode != 0:
+        return None, proc.stderr.strip().splitlines()[-1]
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main(args):
+    failed = False
+    for module in args.modules:
+        elapsed, loaded = measure(module)
+        if elapsed is None:
+            # a dependency missing from this environment is reported, it is not a startup regression
+            missing = loaded.startswith('ModuleNotFoundError')
+            failed = failed or not missing
+            print(f'[{"SKIP" if missing else "FAIL"}] import {module}: {loaded}')
+            continue
+        ok = elapsed <= args.budget and len(loaded) == 0
+        failed = failed or not ok
+        print(f'[{"OK" if ok else "FAIL"}] import {module}: {elapsed:.2f}s on top of torch/torch_geometric (budget {args.budget:.2f}s)'
+              + (f', loaded {loaded}' if loaded else ''))
+    sys.exit(int(failed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the import time of the entry points')
+    parser.add_argument('--budget', type=float, help='allowed import time in seconds', default=1.0)
+    parser.add_argument('--modules', type=str, nargs='+', help='modules to import', default=['trainer', 'get_model', 'utils'])
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,53 @@
+import time
+import argparse
+from copy import deepcopy
+from pathlib import Path
+from datetime import datetime
+import pandas as pd
+from trainer import run_one_seed
+from utils import inherent_models
+import warnings
+warnings.filterwarnings("ignore")
+
+
+def main(args):
+    rows = []
+    for dataset in args.datasets:
+        for method in args.methods:
+            for precision in ['fp32', 'bf16']:
+                run_args = deepcopy(args)
+                run_args.dataset, run_args.method, run_args.precision = dataset, method, precision
+                start = time.perf_counter()
+                report_dict, _ = run_one_seed(run_args, None)
+                # fidelity is only evaluated for post-hoc methods, NaN for the inherent ones
+                rows.append({'dataset': dataset, 'method': method, 'precision': precision,
+                             'test_clf_acc': report_dict['test_clf_acc'], 'test_exp_auc': report_dict['test_exp_auc'],
+                             'test_mean_fid': report_dict['test_mean_fid'] if method not in inherent_models else float('nan'), 'sec': time.perf_counter() - start})
+
+    df = pd.DataFrame(rows).set_index(['dataset', 'method', 'precision'])
+    # drift of bf16 from fp32 for every dataset and method. sec is not compared: the fp32 run of a post-hoc method
+    # also trains the ERM classifier when there is no checkpoint yet, and the bf16 run explains the same checkpoint
+    drift = (df.xs('bf16', level='precision') - df.xs('fp32', level='precision')).drop(columns='sec')
+    drift = pd.concat({'bf16-fp32': drift}, names=['precision']).reorder_levels([1, 2, 0])
+    df = pd.concat([df, drift]).sort_index(level=[0, 1], sort_remaining=False)
+    print(df.to_string(float_format='%.4f'))
+
+    output = Path(args.output) if args.output is not None else \
+        Path('result') / 'precision' / ('_'.join([args.backbone, datetime.now().strftime("%m_%d")] + args.datasets) + '.csv')
+    output.parent.mkdir(parents=True, exist_ok=True)
+    df.to_csv(output)
+    print(f'[INFO] Saved the comparison to {output}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Accuracy and explanation AUC of fp32 vs bf16 autocast')
+    parser.add_argument('--datasets', type=str, nargs='+', help='datasets used', default=['actstrack_2T', 'synmol'])
+    parser.add_argument('--methods', type=str, nargs='+', help='methods used', default=['lri_bern', 'lri_gaussian', 'gradcam'])
+    parser.add_argument('-b', '--backbone', type=str, help='backbone used', default='egnn')
+    parser.add_argument('--cuda', type=int, help='cuda device id, -1 for cpu', default=-1)
+    parser.add_argument('--seed', type=int, help='random seed', default=0)
+    parser.add_argument('--bseed', type=int, help='random seed for training backbone', default=0)
+    parser.add_argument('--output', type=str, help='csv file for the comparison, result/precision/ by default', default=None)
+    args = parser.parse_args()
+    args.note, args.quick, args.save, args.quantize = '', True, False, False
+    main(args)
@@ -10,9 +10,8 @@ import torch.nn as nn
 from torch.nn import functional as F
 from eval import FidelEvaluation, AUCEvaluation
 from get_model import Model
-from baselines import *
 from utils import to_cpu, log_epoch, get_data_loaders, set_seed, load_checkpoint, ExtractorMLP, get_optimizer
-from utils import inherent_models, post_hoc_explainers, post_hoc_attribution, name_mapping
+from utils import inherent_models, post_hoc_explainers, post_hoc_attribution, get_method_class
 import torchmetrics
 import numpy as np
 import pandas as pd
@@ -58,8 +57,8 @@ def data_insights(config, method_name, model_name, backbone_seed, dataset_name,
     criterion = F.binary_cross_entropy_with_logits
 
     map_location = torch.device('cpu') if not torch.cuda.is_available() else None
-    baseline = eval(name_mapping[method_name])(clf, extractor, criterion, config[method_name]) if method_name in inherent_models + ['pgexplainer'] \
-        else eval(name_mapping[method_name])(clf, criterion, config[method_name])
+    baseline = get_method_class(method_name)(clf, extractor, criterion, config[method_name]) if method_name in inherent_models + ['pgexplainer'] \
+        else get_method_class(method_name)(clf, criterion, config[method_name])
 
     if method_name in inherent_models:
         assert load_checkpoint(baseline, log_dir, model_name=method_name, seed=backbone_seed, map_location=map_location,
@@ -1,4 +1,5 @@
-from .actstrack import ActsTrack
-from .plbind import PLBind
-from .tau3mu import Tau3Mu
-from .synmol import SynMol
+from utils.registry import lazy_getattr
+
+_modules = {'ActsTrack': '.actstrack', 'PLBind': '.plbind', 'Tau3Mu': '.tau3mu', 'SynMol': '.synmol'}
+__all__ = list(_modules)
+__getattr__ = lazy_getattr(__name__, _modules)
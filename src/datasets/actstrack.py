@@ -4,7 +4,6 @@ sys.path.append('../')
 import os
 import yaml
 import shutil
-import pickle
 import os.path as osp
 from tqdm import tqdm
 from itertools import combinations
@@ -13,7 +12,7 @@ import numpy as np
 import torch
 from torch_geometric.data import Data, InMemoryDataset
 
-from utils import get_random_idx_split, download_url, extract_zip, decide_download
+from utils import get_random_idx_split, download_url, extract_zip, decide_download, iter_pickle_chunks, get_chunked_pickle, ChunkedCollater
 
 
 class ActsTrack(InMemoryDataset):
@@ -24,6 +23,7 @@ class ActsTrack(InMemoryDataset):
         self.tesla = tesla
         self.split = data_config['split']
         self.sample_tracks = data_config['sample_tracks']
+        self.process_chunk_size = data_config.get('process_chunk_size', 1000)
         self.pos_features = data_config['pos_features']
         self.other_features = data_config['other_features']
         self.seed = seed
@@ -93,22 +93,21 @@ class ActsTrack(InMemoryDataset):
             os.unlink(path)
             return
 
-        signal_events = pickle.load(open(self.raw_dir + f'/signal_events_{self.tesla}.pkl', 'rb'))
-        signal_data_list = self.build_data(signal_events, 'signal')
+        # raw events are read, converted and collated chunk by chunk to keep memory bounded
+        collater = ChunkedCollater(self.collate)
+        for event_type in ['signal', 'bkg']:
+            for events in iter_pickle_chunks(get_chunked_pickle(self.raw_dir + f'/{event_type}_events_{self.tesla}.pkl', self.process_chunk_size), self.process_chunk_size):
+                collater.append(self.build_data(events, event_type))
+                del events
 
-        bkg_events = pickle.load(open(self.raw_dir + f'/bkg_events_{self.tesla}.pkl', 'rb'))
-        bkg_data_list = self.build_data(bkg_events, 'bkg')
-
-        data_list = signal_data_list + bkg_data_list
-        idx_split = get_random_idx_split(len(data_list), self.split, self.seed)
-
-        data, slices = self.collate(data_list)
+        idx_split = get_random_idx_split(len(collater), self.split, self.seed)
+        data, slices = collater.collate()
         torch.save((data, slices, idx_split), self.processed_paths[0])
 
     def build_data(self, events, event_type):
         data_list = []
         cnt = 0
-        pbar = tqdm(events)
+        pbar = tqdm(events, leave=False)
         for initial, _, hits in pbar:
             muons = initial[(initial['particle_type'] == 13) | (initial['particle_type'] == -13)]
             electrons = initial[(initial['particle_type'] == 11) | (initial['particle_type'] == -11)]
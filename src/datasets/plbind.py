@@ -29,7 +29,7 @@ from rdkit.Chem.rdPartialCharges import ComputeGasteigerCharges
 from Bio.PDB import PDBParser
 from Bio.PDB.PDBExceptions import PDBConstructionWarning
 
-from utils import pmap_multi, disable_rdkit_logging, safe_index, log, allowable_features, sr
+from utils import pmap_multi, disable_rdkit_logging, safe_index, log, allowable_features, get_shrake_rupley, get_reorder_transform, compose_transforms, uncrop_node_values
 from utils import download_url, extract_zip, decide_download
 
 
@@ -57,6 +57,34 @@ class GenContact(BaseTransform):
         return data
 
 
+class CropPocket(BaseTransform):
+    # keep only receptor residues within crop_radius of any ligand atom, or the crop_knn nearest residues of every ligand atom,
+    # and always the pocket (pocket_label, within pocket_cutoff) and contact residues, so no residue node_label can mark is cropped
+    # full_res_idx/num_full_res map the kept residues back to the full receptor, see uncrop_node_values
+    def __init__(self, data_config):
+        self.crop_radius = data_config.get('crop_radius', 0)
+        self.crop_knn = data_config.get('crop_knn', 0)
+        assert not (self.crop_radius > 0 and self.crop_knn > 0), 'Use either crop_radius or crop_knn.'
+
+    def __call__(self, data):
+        dist = torch.cdist(data.true_pos_lig, data.true_pos)
+        if self.crop_radius > 0:
+            keep = (dist.min(dim=0).values < self.crop_radius).nonzero().view(-1)
+            # no residue within crop_radius: keep the nearest residue of every ligand atom rather than an empty receptor
+            keep = dist.argmin(dim=1).unique() if keep.numel() == 0 else keep
+        else:
+            k = min(self.crop_knn, data.true_pos.shape[0])
+            keep = dist.topk(k, dim=1, largest=False).indices.view(-1).unique()
+        keep = torch.cat([keep, ((data.pocket_label + data.contact_label) > 0).nonzero().view(-1)]).unique()
+
+        num_full_res = data.x.shape[0]
+        for key in ['x', 'pos', 'true_pos', 'node_label', 'contact_label', 'pocket_label']:
+            data[key] = data[key][keep]
+        data.full_res_idx = keep
+        data.num_full_res = torch.tensor([num_full_res])
+        return data
+
+
 class PLBind(InMemoryDataset):
 
     def __init__(self, root, data_config, n_jobs=32, debug=False):
@@ -69,7 +97,9 @@ class PLBind(InMemoryDataset):
         self.n_jobs = n_jobs
         self.debug = debug
 
-        super().__init__(root, transform=GenContact(data_config))
+        self.crop_pocket = data_config.get('crop_radius', 0) > 0 or data_config.get('crop_knn', 0) > 0
+        transform = compose_transforms(GenContact(data_config), CropPocket(data_config) if self.crop_pocket else None, get_reorder_transform(data_config))
+        super().__init__(root, transform=transform)
         self.data, self.slices, self.idx_split = torch.load(self.processed_paths[0])
         self.complex_names = pickle.load(open(os.path.join(self.processed_dir, 'raw_data.pkl'), 'rb'))[-1]
         self.signal_class = 1
@@ -319,25 +349,25 @@ def read_molecule(molecule_file, sanitize=False, calc_charges=False, remove_hs=F
 
 def get_pocket_nodes(lig_graph, rec_graph, res_no, chain_id, complex_name, contacts_dir, cutoff):
     node_label = torch.zeros(rec_graph.num_nodes).float()
-    lig_rec_distance = spatial.distance.cdist(lig_graph.true_pos, rec_graph.true_pos)
-    signal_idx = np.argwhere(lig_rec_distance.min(0) < cutoff).reshape(-1)
+    lig_tree = spatial.cKDTree(np.asarray(lig_graph.true_pos))
+    min_dist, _ = lig_tree.query(np.asarray(rec_graph.true_pos), k=1, distance_upper_bound=cutoff)
+    signal_idx = np.argwhere(min_dist < cutoff).reshape(-1)
     node_label[signal_idx] = 1
 
     contact_label = torch.zeros(rec_graph.num_nodes).float()
-    res_info = np.array(list(zip(res_no, chain_id)))
     contacts = pickle.load(open(contacts_dir / (complex_name + '.pkl'), 'rb'))
-    df = pd.DataFrame([], columns=['res_no_rec', 'chain_rec'])
-    for each in contacts:
-        if each['hydrogen_df'] is not None:
-            df = pd.concat([df, each['hydrogen_df'][['res_no_rec', 'chain_rec']].drop_duplicates()], ignore_index=True)
-        if each['non_bond_df'] is not None:
-            df = pd.concat([df, each['non_bond_df'][['res_no_rec', 'chain_rec']].drop_duplicates()], ignore_index=True)
-    df['res_no_rec'] = [int(each) if str(each).lstrip('-').isdigit() else int(each[:-1]) for each in df['res_no_rec']]
-    contact_res = df.drop_duplicates().values
-    contact_idx = []
-    for each_contact in contact_res:
-        res = np.where((res_info[:, 0] == str(each_contact[0])) & (res_info[:, 1] == each_contact[1]))[0]
-        contact_idx.extend(list(res))
+    contact_dfs = [each[key][['res_no_rec', 'chain_rec']] for each in contacts for key in ['hydrogen_df', 'non_bond_df'] if each[key] is not None]
+    if len(contact_dfs) == 0:
+        return node_label, contact_label
+
+    # one contact table per complex, joined against the (res_no, chain) index of the receptor residues
+    df = pd.concat(contact_dfs, ignore_index=True)
+    res_no_str = df['res_no_rec'].astype(str)
+    res_no_str = res_no_str.where(res_no_str.str.lstrip('-').str.isdigit(), res_no_str.str[:-1])  # drop insertion codes, e.g. 100A
+    contact_res = pd.DataFrame({'res_no': res_no_str.astype(int).to_numpy(), 'chain': df['chain_rec'].astype(str).to_numpy()}).drop_duplicates()
+
+    res_index = pd.DataFrame({'res_no': np.asarray(res_no).astype(int), 'chain': np.asarray(chain_id).astype(str), 'node_idx': np.arange(len(res_no))})
+    contact_idx = res_index.merge(contact_res, on=['res_no', 'chain'], how='inner')['node_idx'].to_numpy()
     contact_label[contact_idx] = 1
     return node_label, contact_label
 
@@ -474,7 +504,7 @@ def get_lig_data(mol, name, use_rdkit_coords, debug):
 
 def rec_residue_featurizer(rec):
     feature_list = []
-    sr.compute(rec, level="R")
+    get_shrake_rupley().compute(rec, level="R")
     for residue in rec.get_residues():
         sasa = residue.sasa
         for atom in residue:
@@ -8,15 +8,14 @@ import os.path as osp
 from tqdm import tqdm
 
 import numpy as np
-import pandas as pd
 import torch
 from torch_geometric.data import Data, InMemoryDataset
 
-from utils import log, get_random_idx_split, download_url, extract_zip, decide_download
+from utils import log, get_random_idx_split, download_url, extract_zip, decide_download, iter_pickle_chunks, get_chunked_pickle, ChunkedCollater
 
 
 class Tau3Mu(InMemoryDataset):
-    def __init__(self, root, data_config, seed):
+    def __init__(self, root, data_config, seed, transform=None):
         self.url_raw = 'https://zenodo.org/record/7265547/files/tau3mu_raw.zip'
         self.url_processed = 'https://zenodo.org/record/7265547/files/tau3mu_processed.zip'
         self.split = data_config['split']
@@ -25,8 +24,9 @@ class Tau3Mu(InMemoryDataset):
 
         self.sample_filters = data_config['sample_filters']
         self.hit_filters = data_config['hit_filters']
+        self.process_chunk_size = data_config.get('process_chunk_size', 10000)
 
-        super().__init__(root=root)
+        super().__init__(root=root, transform=transform)
         self.data, self.slices, self.idx_split = torch.load(self.processed_paths[0])
         self.x_dim = self.data.x.shape[1]
         self.pos_dim = self.data.pos.shape[1]
@@ -78,28 +78,30 @@ class Tau3Mu(InMemoryDataset):
             os.unlink(path)
             return
 
-        df = pd.read_pickle(self.raw_dir + '/tau3mu_mixed.pkl')
-
         log('[INFO] Processing entries...')
-        data_list = []
-        for entry in tqdm(df.itertuples(), total=len(df)):
-            entry = self.mask_hits(entry, self.hit_filters, self.sample_filters)
-            if entry is None:
-                continue
-            x = torch.tensor(np.stack([entry[feature] for feature in self.other_features], axis=1)).float()
-            pos = self.get_pos(entry)
-            y = torch.tensor(entry['y']).float().view(-1, 1)
-
-            if y.item() == 1:
-                node_label = torch.tensor(entry['node_label']).float().view(-1)
-            else:
-                node_label = torch.zeros((x.shape[0])).float()
-
-            data = Data(x=x, pos=pos, y=y, node_label=node_label)
-            data_list.append(data)
-
-        idx_split = get_random_idx_split(len(data_list), self.split, self.seed)
-        data, slices = self.collate(data_list)
+        collater = ChunkedCollater(self.collate)
+        for df in iter_pickle_chunks(get_chunked_pickle(self.raw_dir + '/tau3mu_mixed.pkl', self.process_chunk_size), self.process_chunk_size):
+            data_list = []
+            for entry in tqdm(df.itertuples(), total=len(df), leave=False):
+                entry = self.mask_hits(entry, self.hit_filters, self.sample_filters)
+                if entry is None:
+                    continue
+                x = torch.tensor(np.stack([entry[feature] for feature in self.other_features], axis=1)).float()
+                pos = self.get_pos(entry)
+                y = torch.tensor(entry['y']).float().view(-1, 1)
+
+                if y.item() == 1:
+                    node_label = torch.tensor(entry['node_label']).float().view(-1)
+                else:
+                    node_label = torch.zeros((x.shape[0])).float()
+
+                data = Data(x=x, pos=pos, y=y, node_label=node_label)
+                data_list.append(data)
+            collater.append(data_list)
+            del df, data_list
+
+        idx_split = get_random_idx_split(len(collater), self.split, self.seed)
+        data, slices = collater.collate()
 
         log('[INFO] Saving data.pt...')
         torch.save((data, slices, idx_split), self.processed_paths[0])
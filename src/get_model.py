@@ -3,8 +3,8 @@ import torch.nn as nn
 from torch_geometric.nn import knn_graph, radius_graph
 from torch_geometric.nn import global_mean_pool, global_add_pool, global_max_pool
 
-from backbones import DGCNN, PointTransformer, EGNN
-from utils import ExtractorMLP, MLP, CoorsNorm
+from utils import ExtractorMLP, MLP, CoorsNorm, get_backbone_class
+from utils.parallel_utils import run_branches
 
 
 
@@ -19,6 +19,7 @@ class Model(nn.Module):
         self.covar_dim = method_config.get('covar_dim', None)
         self.pos_coef = method_config.get('pos_coef', None)
         self.kr = method_config.get('kr', None)
+        self.parallel_branches = model_config.get('parallel_branches', False)
         if method_name == 'lri_gaussian':
             assert self.pos_coef is not None and self.kr is not None
 
@@ -28,14 +29,7 @@ class Model(nn.Module):
         norm_type = model_config['norm_type']
         act_type = model_config['act_type']
 
-        if model_name == 'dgcnn':
-            Model = DGCNN
-        elif model_name == 'pointtrans':
-            Model = PointTransformer
-        elif model_name == 'egnn':
-            Model = EGNN
-        else:
-            raise NotImplementedError
+        Model = get_backbone_class(model_name)
 
         if model_config['pool'] == 'mean':
             self.pool = global_mean_pool
@@ -90,13 +84,16 @@ class Model(nn.Module):
             emb = self.model(x, pos, edge_attr, edge_index, data.batch, edge_attn=edge_attn)
             pool_out = self.pool(emb, batch=data.batch)
         else:
-            _, _, edge_index_lig, edge_attr_lig = self.calc_geo_feat(data, None, self.method_name, is_lig=True)
-            emb_rec = self.model(x, pos, edge_attr, edge_index, data.batch, edge_attn=edge_attn)
-            emb_lig = self.model_lig(data.x_lig, data.pos_lig, edge_attr_lig, edge_index_lig, data.x_lig_batch)
+            emb_rec, emb_lig = run_branches([lambda: self.model(x, pos, edge_attr, edge_index, data.batch, edge_attn=edge_attn),
+                                             lambda: self.forward_lig(data)], [self.model, self.model_lig], self.parallel_branches)
             pool_out_rec, pool_out_lig = self.pool(emb_rec, batch=data.batch), self.pool(emb_lig, batch=data.x_lig_batch)
             pool_out = pool_out_rec + pool_out_lig
         return self.mlp_out(pool_out)
 
+    def forward_lig(self, data):
+        _, _, edge_index_lig, edge_attr_lig = self.calc_geo_feat(data, None, self.method_name, is_lig=True)
+        return self.model_lig(data.x_lig, data.pos_lig, edge_attr_lig, edge_index_lig, data.x_lig_batch)
+
     def get_pred_from_emb(self, emb, batch):
         pool_out = self.pool(emb, batch=batch)
         return self.mlp_out(pool_out)
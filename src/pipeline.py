@@ -7,7 +7,7 @@ import torch
 from trainer import run_one_seed
 import pandas as pd
 import warnings
-from utils import inherent_models, post_hoc_explainers, post_hoc_attribution
+from utils import inherent_models, post_hoc_explainers, post_hoc_attribution, restart_explainers
 from pathlib import Path
 warnings.filterwarnings("ignore")
 
@@ -76,17 +76,23 @@ def main(args):
         args.method = method
         multi_seeds_res, multi_seeds_attn = [], None
         save_dir = Path('log') / config_name / method / f"bs{args.bseed}_ms{args.seeds}_attns.csv"
-        for seed in args.seeds:
-            args.seed = seed
-            report_dict, attn_df = run_one_seed(args, None)
-            if multi_seeds_attn is None:
-                multi_seeds_attn = attn_df
-            else:
-                # four columns are: node_labels, graph_labels, batch_idx, graph_idx
-                assert multi_seeds_attn.iloc[:, -4:].equals(attn_df.iloc[:, -4:])
-                multi_seeds_attn.insert(seed-args.seeds[0], seed, attn_df[seed])
-            multi_seeds_res += [report_dict]
-            # print(json.dumps(report_dict, indent=4))
+        if args.fuse_seeds and method in restart_explainers and len(args.seeds) > 1:
+            # one run explains with all seeds as restarts, it reports and saves the attention of every seed as below
+            args.seed, args.restart_seeds = args.seeds[0], args.seeds
+            multi_seeds_res, multi_seeds_attn = run_one_seed(args, None)
+            args.restart_seeds = None
+        else:
+            for seed in args.seeds:
+                args.seed = seed
+                report_dict, attn_df = run_one_seed(args, None)
+                if multi_seeds_attn is None:
+                    multi_seeds_attn = attn_df
+                else:
+                    # four columns are: node_labels, graph_labels, batch_idx, graph_idx
+                    assert multi_seeds_attn.iloc[:, -4:].equals(attn_df.iloc[:, -4:])
+                    multi_seeds_attn.insert(seed-args.seeds[0], seed, attn_df[seed])
+                multi_seeds_res += [report_dict]
+                # print(json.dumps(report_dict, indent=4))
         multi_seeds_attn.to_csv(save_dir)
 
         avg_report, std_report, avg_std_report = get_avg_std_report(multi_seeds_res)
@@ -114,6 +120,9 @@ if __name__ == '__main__':
     parser.add_argument('--bseed', type=int, help='random seed for training backbone', default=0)
     parser.add_argument('--quick', action="store_true", help='ignore some evaluation')
     parser.add_argument('--no_tqdm', action="store_true", help='disable the tqdm')
+    parser.add_argument('--quantize', action="store_true", help='int8 CPU copy of the classifier for explanation search and fidelity')
+    parser.add_argument('--precision', type=str, help='fp32, or bf16 for autocast of the forward passes', default='fp32', choices=['fp32', 'bf16'])
+    parser.add_argument('--fuse_seeds', action="store_true", help='explain with all seeds in one run for explainers with restarts')
     args = parser.parse_args()
     use_tqdm = False if args.no_tqdm else True
     # main_metric = 'exp_auc'
@@ -8,9 +8,9 @@ import torch.nn as nn
 from torch.nn import functional as F
 from eval import FidelEvaluation, AUCEvaluation, AucFidelity
 from get_model import Model
-from baselines import LabelPerturb, VGIB, LRIBern, LRIGaussian, CIGA
+from baselines import LabelPerturb
 from utils import to_cpu, log_epoch, get_data_loaders, set_seed, load_checkpoint, ExtractorMLP, get_optimizer
-from utils import inherent_models, post_hoc_explainers, post_hoc_attribution, name_mapping
+from utils import inherent_models, post_hoc_explainers, post_hoc_attribution, get_method_class
 import torchmetrics
 from statistics import mean
 import numpy as np
@@ -82,14 +82,14 @@ def test(config, method_name, exp_method, model_name, backbone_seed, method_seed
     criterion = F.binary_cross_entropy_with_logits
 
     # establish the model and the metrics
-    backbone = eval(name_mapping[method_name])(clf, extractor, criterion, config[method_name]) \
+    backbone = get_method_class(method_name)(clf, extractor, criterion, config[method_name]) \
         if method_name in inherent_models else clf
     assert load_checkpoint(backbone, log_dir, model_name=method_name, seed=backbone_seed, map_location=torch.device('cpu') if not torch.cuda.is_available() else None)
 
     if 'label_perturb' in exp_method:
         model = LabelPerturb(backbone, mode=int(exp_method[-1]))
     else:
-        model = eval(name_mapping[exp_method])(clf, criterion, config[exp_method])
+        model = get_method_class(exp_method)(clf, criterion, config[exp_method])
 
 
     # metric_list = [AUCEvaluation()] + [FidelEvaluation(backbone, i/10) for i in range(2, 9)] + \
@@ -10,9 +10,8 @@ import torch.nn as nn
 from torch.nn import functional as F
 from eval import FidelEvaluation, AUCEvaluation
 from get_model import Model
-from baselines import PGExplainer, SubgraphX, PGMExplainer, GNNExplainer
 from utils import to_cpu, log_epoch, get_data_loaders, set_seed, load_checkpoint, ExtractorMLP, get_optimizer
-from utils import inherent_models, post_hoc_explainers, post_hoc_attribution, name_mapping
+from utils import inherent_models, post_hoc_explainers, post_hoc_attribution, get_method_class
 import torchmetrics
 from statistics import mean
 import numpy as np
@@ -77,8 +76,8 @@ def test_uncertainty(config, method_name, model_name, backbone_seed, method_seed
         multi_attn = None
         eval_dict = {}
         for method_seed in method_seeds:
-            baseline = eval(name_mapping[method_name])(clf, criterion, config[method_name]) \
-                if method_name != 'pgexplainer' else PGExplainer(clf, extractor, criterion, config['pgexplainer'])
+            baseline = get_method_class(method_name)(clf, criterion, config[method_name]) \
+                if method_name != 'pgexplainer' else get_method_class(method_name)(clf, extractor, criterion, config['pgexplainer'])
             if method_name == 'pgexplainer':
                 assert load_checkpoint(baseline, log_dir, model_name=method_name, seed=method_seed, map_location=map_location,
                                    backbone_seed=backbone_seed, verbose=False)
@@ -10,17 +10,19 @@ from tqdm import tqdm
 from pathlib import Path
 from copy import deepcopy
 from itertools import product
-import nni
 import numpy as np
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
-from torch.utils.tensorboard import SummaryWriter
+from torch_geometric.data import Data
 from eval import FidelEvaluation, LabelFidelity, AUCEvaluation
 from get_model import Model
-from baselines import *
-from utils import to_cpu, log_epoch, get_data_loaders, set_seed, update_and_save_best_epoch_res, load_checkpoint, save_checkpoint, ExtractorMLP, get_optimizer
-from utils import inherent_models, post_hoc_explainers, post_hoc_attribution, name_mapping
+from utils import to_cpu, log_epoch, get_data_loaders, split_batch, restore_node_order, uncrop_node_values, set_seed, update_and_save_best_epoch_res, load_checkpoint, save_checkpoint, ExtractorMLP, get_optimizer
+from utils import inherent_models, post_hoc_explainers, post_hoc_attribution, gradient_free_explainers, restart_explainers, get_method_class, get_nni
+from utils.quant_utils import quantize_clf, quantization_drift
+from utils.precision_utils import get_autocast, float32, to_float
+from utils.budget_utils import budget_keys, cache_keys
+from utils.parallel_utils import close_pool
 import torchmetrics
 from statistics import mean
 import warnings
@@ -40,7 +42,7 @@ def negative_augmentation(data, data_config, phase, data_loader, batch_idx, load
     return data
 
 
-def eval_one_batch(baseline, optimizer, data, epoch, phase):
+def eval_one_batch(baseline, optimizer, data, epoch, phase, precision='fp32', node_budget=None):
     with torch.set_grad_enabled(baseline.name in ['gradcam', 'gradx', 'inter_grad', 'gnnexplainer']):
         assert optimizer is None
         baseline.extractor.eval() if hasattr(baseline, 'extractor') else None
@@ -48,55 +50,87 @@ def eval_one_batch(baseline, optimizer, data, epoch, phase):
 
         # BernMaskP
         do_sampling = True if phase == 'valid' and baseline.name == 'pgexplainer' else False # we find this is better for BernMaskP
-        loss, loss_dict, infer_clf_logits, node_attn = baseline.forward_pass(data, epoch=epoch, do_sampling=do_sampling)
+        with get_autocast(baseline.device, precision):
+            loss, loss_dict, infer_clf_logits, node_attn = baseline.forward_pass(data, epoch=epoch, do_sampling=do_sampling)
 
-        return loss_dict, to_cpu(infer_clf_logits), to_cpu(node_attn)
+        return loss_dict, to_cpu(to_float(infer_clf_logits)), to_cpu(to_float(node_attn))
 
 
-def train_one_batch(baseline, optimizer, data, epoch, phase):
+def train_one_batch(baseline, optimizer, data, epoch, phase, precision='fp32', node_budget=None):
     baseline.extractor.train() if hasattr(baseline, 'extractor') else None
     baseline.clf.train() if (baseline.name != 'pgexplainer' or phase == 'warm') else baseline.clf.eval()
 
-    if phase == 'warm':
-        loss, loss_dict, org_clf_logits, node_attn = baseline.warming(data)
-    else:
-        loss, loss_dict, org_clf_logits, node_attn = baseline.forward_pass(data, epoch=epoch, do_sampling=True)
+    # with a node budget the batch runs as micro-batches of whole graphs whose gradients are accumulated,
+    # so that the optimizer step still sees the configured batch_size
+    micro_batches = split_batch(data, node_budget) if node_budget and baseline.name != 'test_inherent' else [data]
     optimizer.zero_grad()
+    loss_dict, org_clf_logits, node_attn = {}, [], []
+    for micro_data in micro_batches:
+        with get_autocast(baseline.device, precision):
+            if phase == 'warm':
+                loss, micro_loss_dict, micro_clf_logits, micro_attn = baseline.warming(micro_data)
+            else:
+                loss, micro_loss_dict, micro_clf_logits, micro_attn = baseline.forward_pass(micro_data, epoch=epoch, do_sampling=True)
+        weight = micro_data.num_graphs / data.num_graphs
+
+        if baseline.name == 'test_inherent':
+            loss.backward(retain_graph=True)
+            data.node_grads += data.pos.grad.norm(dim=1, p=2)
+            data.edge_grads += data.edge_attn.grad
+        else:
+            (loss * weight).backward()
 
-    if baseline.name == 'test_inherent':
-        loss.backward(retain_graph=True)
-        data.node_grads += data.pos.grad.norm(dim=1, p=2)
-        data.edge_grads += data.edge_attn.grad
-    else:
-        loss.backward()
+        for k, v in micro_loss_dict.items():
+            loss_dict[k] = loss_dict.get(k, 0) + v * weight
+        org_clf_logits.append(to_cpu(to_float(micro_clf_logits)))
+        node_attn.append(to_cpu(to_float(micro_attn)))
 
     optimizer.step()
-    return loss_dict, to_cpu(org_clf_logits), to_cpu(node_attn)
+    node_attn = torch.cat(node_attn) if node_attn[0] is not None else None
+    return loss_dict, torch.cat(org_clf_logits), node_attn
 
 
-def run_one_epoch(baseline, optimizer, data_loader, epoch, phase, seed, signal_class, writer=None, metric_list=None, return_attn=False):
+def run_one_epoch(baseline, optimizer, data_loader, epoch, phase, seed, signal_class, writer=None, metric_list=None, return_attn=False, precision='fp32', node_budget=None):
     use_tqdm = True
     run_one_batch = train_one_batch if optimizer else eval_one_batch
     pbar, avg_loss_dict = tqdm(data_loader) if use_tqdm else data_loader, dict()
-    [eval_metric.reset() for eval_metric in metric_list] if phase in ['valid', 'test'] else None
+    # explainers with restarts return one attention column per restart, each scored with its own list of metrics
+    restarts = bool(metric_list) and isinstance(metric_list[0], list)
+    metric_lists = metric_list if restarts else [metric_list]
+    [eval_metric.reset() for metrics in metric_lists for eval_metric in metrics] if phase in ['valid', 'test'] else None
 
     clf_ACC, clf_AUC = torchmetrics.Accuracy(task='binary'), torchmetrics.AUROC(task='binary')
     save_epoch_attn = []
     for idx, data in enumerate(pbar):
         # data = negative_augmentation(data, data_config, phase, data_loader, idx, loader_len)
-        loss_dict, clf_logits, attn = run_one_batch(baseline, optimizer, data.to(baseline.device), epoch, phase)
+        loss_dict, clf_logits, attn = run_one_batch(baseline, optimizer, data.to(baseline.device), epoch, phase, precision, node_budget)
         ex_labels, clf_labels, data = to_cpu(data.node_label), to_cpu(data.y), data.cpu()
 
         # prepare to save attn
         if return_attn:
-            graph_labels = data.y[data.batch]
+            node_values, batch = torch.cat([attn.reshape(attn.shape[0], -1), ex_labels.unsqueeze(-1)], dim=1), data.batch
+            if data.get('full_res_idx', None) is not None:
+                # cropped PLBind receptors are saved with every residue of the full receptor, 0 outside the pocket
+                node_values = uncrop_node_values(node_values, data)
+                batch = torch.arange(data.num_graphs).repeat_interleave(data.num_full_res.view(-1))
+            else:
+                # rows are saved in the original node order of each graph when the nodes were reordered (node_order)
+                node_values = restore_node_order(node_values, data)
+            graph_labels = data.y[batch]
             batch_idx = torch.full_like(graph_labels, idx)
-            graph_idx = data.batch.unsqueeze(-1)
-            save_attn = torch.cat([attn.unsqueeze(-1), ex_labels.unsqueeze(-1), graph_labels, batch_idx, graph_idx], dim=1)
+            graph_idx = batch.unsqueeze(-1)
+            save_attn = torch.cat([node_values, graph_labels, batch_idx, graph_idx], dim=1)
             save_epoch_attn.append(save_attn)
 
-        eval_dict = {metric.name: metric.collect_batch(ex_labels, attn, data, signal_class, 'geometric')
-                     for metric in metric_list} if phase in ['valid', 'test'] else {}
+        attns = attn.T if attn is not None and attn.dim() == 2 else [attn]
+        # the explanation AUC of cropped PLBind receptors is computed on the full receptors (residues outside the crop
+        # ranked last), comparable to runs on the full receptors; fidelity needs the graphs the classifier saw
+        cropped = data.get('full_res_idx', None) is not None
+        metric_inputs = lambda metric, restart_attn: uncrop_metric_inputs(ex_labels, restart_attn, data) \
+            if cropped and isinstance(metric, AUCEvaluation) else (ex_labels, restart_attn, data)
+        eval_dicts = [{metric.name: metric.collect_batch(*metric_inputs(metric, restart_attn), signal_class, 'geometric') for metric in metrics}
+                      for metrics, restart_attn in zip(metric_lists, attns)] if phase in ['valid', 'test'] else [{}]
+        eval_dict = {k: mean([d[k] for d in eval_dicts]) for k in eval_dicts[0]} if restarts else eval_dicts[0]
         eval_dict.update({'clf_acc': clf_ACC(clf_logits, clf_labels), 'clf_auc': clf_AUC(clf_logits, clf_labels)})
         batch_fid = [eval_dict[k] for k in eval_dict if 'fid' in k and 'all' in k]
         eval_dict.update({'mean_fid': mean(batch_fid)}) if phase in ['valid', 'test'] and batch_fid else {}
@@ -106,12 +140,17 @@ def run_one_epoch(baseline, optimizer, data_loader, epoch, phase, seed, signal_c
         # compute the avg_loss for the epoch desc
         exec('for k, v in loss_dict.items():\n\tavg_loss_dict[k]=(avg_loss_dict.get(k, 0) * idx + v) / (idx + 1)')
 
-    epoch_dict = {eval_metric.name: eval_metric.eval_epoch() for eval_metric in metric_list} if metric_list else {}
-    epoch_dict.update({'clf_acc': clf_ACC.compute().item(), 'clf_auc': clf_AUC.compute().item()})
-    fid_score = [epoch_dict[k] for k in epoch_dict if 'fid' in k and 'all' in k]
-    epoch_dict.update({'mean_fid': mean(fid_score)}) if phase in ['valid', 'test'] and fid_score else {}
-
-    log_epoch(seed, epoch, phase, avg_loss_dict, epoch_dict, writer)
+    epoch_dicts = []
+    for metrics in metric_lists:
+        epoch_dict = {eval_metric.name: eval_metric.eval_epoch() for eval_metric in metrics} if metrics else {}
+        epoch_dict.update({'clf_acc': clf_ACC.compute().item(), 'clf_auc': clf_AUC.compute().item()})
+        fid_score = [epoch_dict[k] for k in epoch_dict if 'fid' in k and 'all' in k]
+        epoch_dict.update({'mean_fid': mean(fid_score)}) if phase in ['valid', 'test'] and fid_score else {}
+        # compute budgets and convergence of the anytime explainers and the SubgraphX value cache, reported next to exp_auc
+        epoch_dict.update({k: avg_loss_dict[k] for k in budget_keys + cache_keys if k in avg_loss_dict}) if phase in ['valid', 'test'] else {}
+        log_epoch(seed, epoch, phase, avg_loss_dict, epoch_dict, writer)
+        epoch_dicts.append(epoch_dict)
+    epoch_dict = epoch_dicts if restarts else epoch_dicts[0]
 
     if return_attn:
         save_epoch_attn = torch.cat(save_epoch_attn, dim=0)
@@ -120,7 +159,21 @@ def run_one_epoch(baseline, optimizer, data_loader, epoch, phase, seed, signal_c
         return epoch_dict
 
 
-def train(config, method_name, model_name, backbone_seed, seed, dataset_name, parent_dir, device, main_metric, quick=False, save=False):
+def uncrop_metric_inputs(ex_labels, attn, data):
+    # labels and attention of cropped PLBind receptors spread over the full receptors (see CropPocket, which keeps every
+    # labelled residue), and a stand-in for data with what AUCEvaluation reads: the graph labels and the graph of each residue
+    batch = torch.arange(data.num_graphs).repeat_interleave(data.num_full_res.view(-1))
+    return uncrop_node_values(ex_labels, data), uncrop_node_values(attn, data), Data(y=data.y, batch=batch, num_nodes=batch.shape[0])
+
+
+def get_metric_list(infer_clf, quick):
+    return [AUCEvaluation()] + [FidelEvaluation(infer_clf, i/10) for i in range(2, 9)] + \
+        [FidelEvaluation(infer_clf, i/10, instance='pos') for i in range(2, 9)] + \
+        [FidelEvaluation(infer_clf, i/10, instance='neg') for i in range(2, 9)] if quick==False else \
+        [AUCEvaluation()] + [FidelEvaluation(infer_clf, i/10) for i in range(2, 9)]
+
+
+def train(config, method_name, model_name, backbone_seed, seed, dataset_name, parent_dir, device, main_metric, quick=False, save=False, quantize=False, precision='fp32', restart_seeds=None):
     # writer = SummaryWriter(log_dir) if log_dir is not None else None
     writer = None
     model_dir, log_dir = (parent_dir / method_name, ) * 2 if method_name in inherent_models \
@@ -131,6 +184,7 @@ def train(config, method_name, model_name, backbone_seed, seed, dataset_name, pa
     model_dir.mkdir(parents=True, exist_ok=True)
 
     batch_size = config['optimizer']['batch_size']
+    node_budget = config['optimizer'].get('node_budget', None)
     model_cofig = config[method_name] if method_name in inherent_models else config['erm']
     warmup = model_cofig['warmup']
     epochs = config[method_name]['epochs']
@@ -144,33 +198,36 @@ def train(config, method_name, model_name, backbone_seed, seed, dataset_name, pa
     extractor = ExtractorMLP(config[model_name]['hidden_size'], config[method_name], config['data'].get('use_lig_info', False)) \
         if method_name in inherent_models + ['pgexplainer'] else nn.Identity()
     extractor = extractor.to(device)
-    criterion = F.binary_cross_entropy_with_logits
-    constructor = eval(name_mapping[method_name])
+    criterion = float32(F.binary_cross_entropy_with_logits)
+    constructor = get_method_class(method_name)
     optimizer = get_optimizer(clf, extractor, config['optimizer'], method_name, warmup=True)
 
     # establish the model and the metrics
     if method_name in inherent_models:
         baseline = constructor(clf, extractor, criterion, config[method_name])
         for epoch in range(1, warmup+1):
-            run_one_epoch(baseline, optimizer, loaders['train'], epoch, 'warm', seed, signal_class, writer)
+            run_one_epoch(baseline, optimizer, loaders['train'], epoch, 'warm', seed, signal_class, writer, precision=precision, node_budget=node_budget)
             if save:
                 save_checkpoint(baseline.clf, model_dir, model_name='erm', backbone_seed=backbone_seed,
                                 seed=backbone_seed)
         metric_list = [AUCEvaluation()]
     elif method_name in post_hoc_attribution + post_hoc_explainers:
-        baseline = constructor(clf, criterion, config[method_name]) if method_name != 'pgexplainer' else PGExplainer(clf, extractor, criterion, config['pgexplainer'])
+        baseline = constructor(clf, criterion, config[method_name]) if method_name != 'pgexplainer' else constructor(clf, extractor, criterion, config['pgexplainer'])
         if not load_checkpoint(baseline.clf, model_dir, model_name='erm', seed=backbone_seed, map_location=torch.device('cpu') if not torch.cuda.is_available() else None):
             for epoch in range(1, warmup + 1):
-                run_one_epoch(baseline, optimizer, loaders['train'], epoch, 'warm', backbone_seed, signal_class, writer)
+                run_one_epoch(baseline, optimizer, loaders['train'], epoch, 'warm', backbone_seed, signal_class, writer, precision=precision, node_budget=node_budget)
             save_checkpoint(baseline.clf, model_dir, model_name='erm', backbone_seed=backbone_seed, seed=backbone_seed)
-        metric_list = [AUCEvaluation()] + [FidelEvaluation(baseline.clf, i/10) for i in range(2, 9)] + \
-                  [FidelEvaluation(baseline.clf, i/10, instance='pos') for i in range(2, 9)] + \
-                  [FidelEvaluation(baseline.clf, i/10, instance='neg') for i in range(2, 9)] if quick==False else \
-                  [AUCEvaluation()] + [FidelEvaluation(baseline.clf, i/10) for i in range(2, 9)]
+        infer_clf = get_quantized_clf(baseline, method_name, loaders['valid'], device) if quantize else baseline.clf
+        metric_list = get_metric_list(infer_clf, quick)
+        if restart_seeds is not None:
+            # the explainer runs once for all seeds, every restart is scored and reported like a run with its seed
+            assert method_name in restart_explainers, f'{method_name} has no restarts'
+            baseline.set_restarts(restart_seeds)
+            metric_list = [metric_list] + [get_metric_list(infer_clf, quick) for _ in restart_seeds[1:]]
         baseline.start_tracking() if 'grad' in method_name or method_name == 'gnnlrp' else None
     else:
         assert 'test' == method_name
-        baseline = Test(clf, criterion, config=None)
+        baseline = constructor(clf, criterion, config=None)
         load_checkpoint(baseline.clf, model_dir, model_name='erm', seed=backbone_seed, map_location=torch.device('cpu') if not torch.cuda.is_available() else None)
         # for epoch in range(1, warmup+1):
         #     run_one_epoch(baseline, optimizer, loaders['train'], epoch, 'warm', seed, signal_class, writer)
@@ -178,34 +235,59 @@ def train(config, method_name, model_name, backbone_seed, seed, dataset_name, pa
         print('New method is ready!')
 
     set_seed(seed)
-    metric_names = [a + b for a, b in product(['valid_', 'test_'], [i.name for i in metric_list]+['clf_acc', 'clf_auc', 'mean_fid'])]
+    metric_names = [a + b for a, b in product(['valid_', 'test_'], [i.name for i in (metric_list[0] if restart_seeds is not None else metric_list)]+['clf_acc', 'clf_auc', 'mean_fid'])]
     # metric_names = [j+i.name for i in metric_list for j in ['valid_', 'test_']]
     metric_dict = {}.fromkeys(metric_names, 0)
+    restart_dicts = [{}.fromkeys(metric_names, 0) for _ in restart_seeds] if restart_seeds is not None else None
     best_attn = None
     optimizer = get_optimizer(clf, extractor, config['optimizer'], method_name, warmup=False)
     for epoch in range(1, epochs+1):
         if method_name in inherent_models + ['pgexplainer']:
-            run_one_epoch(baseline, optimizer, loaders['train'], epoch, 'train', seed, signal_class, writer, metric_list)
-            valid_dict = run_one_epoch(baseline, None, loaders['valid'], epoch, 'valid', seed, signal_class, writer, metric_list)
+            run_one_epoch(baseline, optimizer, loaders['train'], epoch, 'train', seed, signal_class, writer, metric_list, precision=precision, node_budget=node_budget)
+            valid_dict = run_one_epoch(baseline, None, loaders['valid'], epoch, 'valid', seed, signal_class, writer, metric_list, precision=precision)
             test_dict, epoch_attn = run_one_epoch(baseline, None, loaders['test'], epoch, 'test', seed,
-                                                  signal_class, writer, metric_list, return_attn=True)
+                                                  signal_class, writer, metric_list, return_attn=True, precision=precision)
         else:
             test_dict, epoch_attn = run_one_epoch(baseline, None, loaders['test'], epoch, 'test', seed,
-                                                  signal_class,  writer, metric_list, return_attn=True)
+                                                  signal_class,  writer, metric_list, return_attn=True, precision=precision)
             valid_dict = test_dict # other methods don't need validation to select epochs
 
+        if restart_seeds is not None:
+            for i, restart_seed in enumerate(restart_seeds):
+                restart_dicts[i], new_best = update_and_save_best_epoch_res(baseline, restart_dicts[i], valid_dict[i], test_dict[i], epoch, log_dir, backbone_seed, restart_seed, writer, method_name, main_metric)
+                if new_best:
+                    best_attn = epoch_attn.clone() if best_attn is None else best_attn
+                    best_attn[:, i] = epoch_attn[:, i]
+            continue
+
         # print(metric_dict)
         metric_dict, new_best = update_and_save_best_epoch_res(baseline, metric_dict, valid_dict, test_dict, epoch, log_dir, backbone_seed, seed, writer, method_name, main_metric)
         best_attn = epoch_attn if new_best else best_attn
         metric_dict.update({'default': metric_dict[f'valid_{main_metric}']})
-        nni.report_intermediate_result(metric_dict)
+        report_intermediate_result(metric_dict)
 
+    # the worker processes of explain_workers hold a copy of this explainer
+    close_pool()
     meta_index = 'attn' if method_name in post_hoc_attribution + inherent_models else seed
     indexes = [meta_index, 'node_labels', 'graph_labels', 'batch_idx', 'graph_idx']
+    if restart_seeds is not None:
+        return restart_dicts, (best_attn, list(restart_seeds) + indexes[1:])
 
     return metric_dict, (best_attn, indexes)
 
 
+def get_quantized_clf(baseline, method_name, data_loader, device):
+    # the int8 copy of the trained float classifier is only used for fidelity and, for explainers that only query the
+    # classifier, for the explanation search; it runs on CPU
+    qclf = quantize_clf(baseline.clf)
+    drift = quantization_drift(baseline.clf, qclf, data_loader, device)
+    print('[INFO] Quantized classifier drift on the validation set: ', json.dumps(drift, indent=4))
+    if method_name in gradient_free_explainers:
+        baseline.clf = qclf
+        baseline.device = torch.device('cpu')
+    return qclf
+
+
 def run_one_seed(args, optimized_params):
     print(args)
     dataset_name, method_name, model_name, cuda_id, note = args.dataset, args.method, args.backbone, args.cuda, args.note
@@ -230,13 +312,19 @@ def run_one_seed(args, optimized_params):
     main_dir = Path('log') / config_name
     main_dir.mkdir(parents=True, exist_ok=True)
         # shutil.copy(config_path, log_dir / config_path.name)
-    report_dict, (best_attn, indexes) = train(config, method_name, model_name, backbone_seed, method_seed, dataset_name, main_dir, device, main_metric, quick=args.quick, save=args.save)
+    report_dict, (best_attn, indexes) = train(config, method_name, model_name, backbone_seed, method_seed, dataset_name, main_dir, device, main_metric, quick=args.quick, save=args.save, quantize=args.quantize, precision=args.precision,
+                                                   restart_seeds=getattr(args, 'restart_seeds', None))
     attn_df = pd.DataFrame(best_attn, columns=indexes)
 
     return report_dict, attn_df
 
 
+def report_intermediate_result(metric_dict):
+    get_nni().report_intermediate_result(metric_dict)
+
+
 def main(args):
+    nni = get_nni()
     if args.gpu_ratio is not None:
         torch.cuda.set_per_process_memory_fraction(args.gpu_ratio)
 
@@ -260,6 +348,8 @@ if __name__ == '__main__':
     parser.add_argument('--bseed', type=int, help='random seed for training backbone', default=0)
     parser.add_argument('--quick', action="store_true", help='ignore some evaluation')
     parser.add_argument('--no_tqdm', action="store_true", help='disable the tqdm')
+    parser.add_argument('--quantize', action="store_true", help='int8 CPU copy of the classifier for explanation search and fidelity')
+    parser.add_argument('--precision', type=str, help='fp32, or bf16 for autocast of the forward passes', default='fp32', choices=['fp32', 'bf16'])
 
     exp_args = parser.parse_args()
     use_tqdm = False if exp_args.no_tqdm else True
@@ -2,4 +2,6 @@ from .info_utils import *
 from .model_utils import *
 from .url import *
 from .logger import log_epoch, log, update_and_save_best_epoch_res, load_checkpoint, save_checkpoint
-from .get_data_loaders import get_data_loaders
+from .reorder_utils import SFCReorder, restore_node_order, uncrop_node_values, get_reorder_transform, compose_transforms
+from .registry import name_mapping, get_dataset_class, get_backbone_class, get_method_class
+from .get_data_loaders import get_data_loaders, split_batch, replicate_edge_index
@@ -0,0 +1,90 @@
+import time
+import numpy as np
+import torch
+from scipy.stats import rankdata
+
+# per-graph diagnostics of the anytime explainers, reported next to exp_auc
+budget_keys = ['budget_evals', 'budget_sec', 'converged', 'exhausted']
+# statistics of the SubgraphX value cache per explained graph, reported with them
+cache_keys = ['cache_hits', 'cache_misses', 'cache_hit_rate']
+
+
+def to_numpy(values):
+    return values.detach().float().cpu().numpy().reshape(-1) if torch.is_tensor(values) else np.asarray(values).reshape(-1)
+
+
+def rank_corr(a, b):
+    # spearman correlation of two score vectors over the same nodes, ties share their average rank
+    ra, rb = rankdata(a), rankdata(b)
+    if ra.std() == 0 or rb.std() == 0:
+        return float(np.array_equal(ra, rb))
+    return float(np.corrcoef(ra, rb)[0, 1])
+
+
+class ExplanationBudget:
+    # compute budget of an anytime explainer for one graph: a maximum number of classifier evaluations (graphs
+    # scored) and of seconds, and early stopping once the node ranking of successive best-so-far explanations has a
+    # rank correlation of at least rank_tol for rank_patience checks in a row. None disables a limit, so an
+    # unconfigured budget only counts. A batch explained at once gets the budgets of its graphs (num_graphs) and
+    # converges once the ranking of every graph has.
+
+    def __init__(self, max_evals=None, max_sec=None, rank_tol=None, rank_patience=3, num_graphs=1):
+        self.num_graphs = num_graphs
+        self.max_evals = None if max_evals is None else max_evals * num_graphs
+        self.max_sec = None if max_sec is None else max_sec * num_graphs
+        self.rank_tol = rank_tol
+        self.rank_patience = rank_patience
+        self.evals = 0
+        self.reset_ranking()
+        self.started, self.ended = time.perf_counter(), None
+
+    @classmethod
+    def from_config(cls, config, num_graphs=1):
+        return cls(config.get('max_evals'), config.get('max_sec'), config.get('rank_tol'), config.get('rank_patience', 3), num_graphs)
+
+    @property
+    def tracks_ranking(self):
+        return self.rank_tol is not None
+
+    @property
+    def elapsed(self):
+        return (self.ended or time.perf_counter()) - self.started
+
+    def charge(self, evals):
+        self.evals += evals
+
+    def exhausted(self):
+        return (self.max_evals is not None and self.evals >= self.max_evals) or (self.max_sec is not None and self.elapsed >= self.max_sec)
+
+    def reset_ranking(self):
+        # for explainers whose rankings are not comparable across stages (the rounds of PGMExplainer)
+        self.last_scores, self.stable, self.converged = None, 0, False
+
+    def update(self, scores, index=None):
+        # index assigns the scores to the graphs of a batch (e.g. data.batch), each graph is ranked on its own
+        if not self.tracks_ranking or scores is None:
+            return self.converged
+        scores = to_numpy(scores)
+        index = np.zeros(len(scores), dtype=int) if index is None else to_numpy(index)
+        if self.last_scores is not None and len(self.last_scores) == len(scores):
+            corr = np.array([rank_corr(self.last_scores[index == g], scores[index == g]) for g in np.unique(index)])
+            self.stable = np.where(corr >= self.rank_tol, self.stable + 1, 0)
+        self.last_scores = scores
+        self.converged = bool(np.all(self.stable >= self.rank_patience))
+        return self.converged
+
+    def should_stop(self, scores=None, index=None):
+        # scores are the node scores of the current best-so-far explanation
+        return self.update(scores, index) or self.exhausted()
+
+    def finish(self):
+        self.ended = time.perf_counter()
+        return self.diagnostics()
+
+    def diagnostics(self):
+        return {'budget_evals': self.evals / self.num_graphs, 'budget_sec': self.elapsed / self.num_graphs,
+                'converged': float(self.converged), 'exhausted': float(self.exhausted())}
+
+
+def mean_diagnostics(diagnostics):
+    return {k: float(np.mean([d[k] for d in diagnostics])) for k in diagnostics[0]}
@@ -1,11 +1,16 @@
+import torch
 from pathlib import Path
 from torch_geometric.loader import DataLoader
-from datasets import ActsTrack, PLBind, Tau3Mu, SynMol
+from torch_geometric.data import Batch
 from torch_geometric.nn import knn_graph, radius_graph
+from .reorder_utils import get_reorder_transform, compose_transforms
+from .registry import get_dataset_class
 
 def get_data_loaders(dataset_name, batch_size, data_config, dataset_seed):
     data_dir = Path(data_config['data_dir'])
     assert dataset_name in ['tau3mu', 'plbind', 'synmol'] or 'acts' in dataset_name
+    Dataset = get_dataset_class(dataset_name)
+    reorder = get_reorder_transform(data_config)
 
     if 'actstrack' in dataset_name:
         def act_transform(data):
@@ -16,11 +21,11 @@ def get_data_loaders(dataset_name, batch_size, data_config, dataset_seed):
             data.edge_index = edge_index
             return data
         tesla = '2T' if len(dataset_name.split('_')) == 1 else dataset_name.split('_')[-1]
-        dataset = ActsTrack(data_dir / 'actstrack', tesla=tesla, data_config=data_config, seed=dataset_seed, transform=act_transform)
+        dataset = Dataset(data_dir / 'actstrack', tesla=tesla, data_config=data_config, seed=dataset_seed, transform=compose_transforms(act_transform, reorder))
         loaders, test_set = get_loaders_and_test_set(batch_size, dataset=dataset, idx_split=dataset.idx_split)
 
     elif dataset_name == 'tau3mu':
-        dataset = Tau3Mu(data_dir / 'tau3mu', data_config=data_config, seed=dataset_seed)
+        dataset = Dataset(data_dir / 'tau3mu', data_config=data_config, seed=dataset_seed, transform=reorder)
         loaders, test_set = get_loaders_and_test_set(batch_size, dataset=dataset, idx_split=dataset.idx_split)
 
     elif dataset_name == 'synmol':
@@ -28,11 +33,11 @@ def get_data_loaders(dataset_name, batch_size, data_config, dataset_seed):
             edge_index = knn_graph(data.pos, k=5, batch=data.batch, loop=True)
             data.edge_index = edge_index
             return data
-        dataset = SynMol(data_dir / 'synmol', data_config=data_config, seed=dataset_seed, transform=syn_transform)
+        dataset = Dataset(data_dir / 'synmol', data_config=data_config, seed=dataset_seed, transform=compose_transforms(syn_transform, reorder))
         loaders, test_set = get_loaders_and_test_set(batch_size, dataset=dataset, idx_split=dataset.idx_split)
 
     elif dataset_name == 'plbind':
-        dataset = PLBind(data_dir / 'plbind', data_config=data_config, n_jobs=32, debug=False)
+        dataset = Dataset(data_dir / 'plbind', data_config=data_config, n_jobs=32, debug=False)
         loaders, test_set = get_loaders_and_test_set(batch_size, dataset=dataset, idx_split=dataset.idx_split, dataset_name=dataset_name)
 
     return loaders, test_set, dataset
@@ -46,3 +51,30 @@ def get_loaders_and_test_set(batch_size, dataset, idx_split, dataset_name=None):
 
     test_set = dataset.copy(idx_split["test"])  # For visualization
     return {'train': train_loader, 'valid': valid_loader, 'test': test_loader}, test_set
+
+
+def split_batch(data, node_budget):
+    # split a batch into micro-batches of whole graphs with at most node_budget nodes (receptor + ligand for PLBind),
+    # a graph larger than the budget forms a micro-batch on its own
+    follow_batch = ['x_lig'] if hasattr(data, 'x_lig_batch') else None
+    num_nodes = torch.bincount(data.batch, minlength=data.num_graphs)
+    if follow_batch is not None:
+        num_nodes = num_nodes + torch.bincount(data.x_lig_batch, minlength=data.num_graphs)
+    if num_nodes.sum().item() <= node_budget:
+        return [data]
+
+    chunks, chunk, size = [], [], 0
+    for graph, n in zip(data.to_data_list(), num_nodes.tolist()):
+        if chunk and size + n > node_budget:
+            chunks.append(chunk)
+            chunk, size = [], 0
+        chunk.append(graph)
+        size += n
+    chunks.append(chunk)
+    return [Batch.from_data_list(chunk, follow_batch=follow_batch) for chunk in chunks]
+
+
+def replicate_edge_index(edge_index, num_graphs, num_nodes):
+    # edge_index of num_graphs copies of a graph with num_nodes nodes, as collated in a Batch
+    offsets = torch.arange(num_graphs, device=edge_index.device).repeat_interleave(edge_index.shape[1]) * num_nodes
+    return edge_index.repeat(1, num_graphs) + offsets
@@ -1,25 +1,39 @@
 import os
 import sys
 import random
+import pickle
 from tqdm import tqdm
-from joblib import Parallel, delayed
 import torch
 import numpy as np
-from Bio.PDB import ShrakeRupley
+from torch_geometric.data.collate import collate
 
 inherent_models = ['lri_bern', 'lri_gaussian', 'vgib', 'ciga']
 post_hoc_explainers = ['pgexplainer', 'gnnexplainer', 'subgraphx', 'pgmexplainer']
 post_hoc_attribution = ['gradcam', 'gnnlrp', 'gradx', 'inter_grad']
+gradient_free_explainers = ['subgraphx', 'pgmexplainer']  # only query the classifier, so they can use a quantized copy
+restart_explainers = ['gnnexplainer']  # can explain with several seeds in one run, see --fuse_seeds of pipeline.py
 
-name_mapping = {'lri_bern': 'LRIBern', 'lri_gaussian': 'LRIGaussian', 'vgib': 'VGIB', 'ciga': 'CIGA', 'dir': 'DIR',
-                'gradcam': 'GradCAM', 'inter_grad': 'InterGrad', 'gradx': 'GradX', 'gnnlrp': 'GNNLRP',
-                'pgexplainer': 'PGExplainer', 'gnnexplainer': 'GNNExplainer', 'subgraphx': 'SubgraphX',
-                'pgmexplainer': 'PGMExplainer',
-                'test': 'Test'}
+_sr = None
+_nni = None
 
 
-sr = ShrakeRupley(probe_radius=1.4,  # in A. Default is 1.40 roughly the radius of a water molecule.
-                  n_points=100)  # resolution of the surface of each atom. Default is 100. A higher number of points results in more precise measurements, but slows down the calculation.
+def get_shrake_rupley():
+    # Biopython is only needed to compute residue SASA when processing PLBind, so it is imported on first use
+    global _sr
+    if _sr is None:
+        from Bio.PDB import ShrakeRupley
+        _sr = ShrakeRupley(probe_radius=1.4,  # in A. Default is 1.40 roughly the radius of a water molecule.
+                           n_points=100)  # resolution of the surface of each atom. Default is 100. A higher number of points results in more precise measurements, but slows down the calculation.
+    return _sr
+
+
+def get_nni():
+    # nni is only needed to report results to a tuning experiment, so it is imported on first use
+    global _nni
+    if _nni is None:
+        import nni
+        _nni = nni
+    return _nni
 
 
 allowable_features = {
@@ -100,6 +114,7 @@ def disable_rdkit_logging():
 
 
 def pmap_multi(pickleable_fn, data, n_jobs, verbose=1, desc=None, **kwargs):
+  from joblib import Parallel, delayed
   results = Parallel(n_jobs=n_jobs, verbose=verbose, timeout=None, )(
     delayed(pickleable_fn)(*d, **kwargs) for i, d in tqdm(enumerate(data), desc=desc)
   )
@@ -119,3 +134,88 @@ def get_random_idx_split(dataset_len, split, seed):
     valid_idx = idx[n_train:n_train+n_valid]
     test_idx = idx[n_train+n_valid:]
     return {'train': train_idx, 'valid': valid_idx, 'test': test_idx}
+
+
+def iter_pickle_chunks(path, chunk_size):
+    # a raw file holds either one pickled list/DataFrame of events, or several of them dumped one after another,
+    # which lets newly generated raw data be read back without ever holding all events in memory
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                records = pickle.load(f)
+            except EOFError:
+                return
+            for start in range(0, len(records), chunk_size):
+                if hasattr(records, 'iloc'):
+                    yield records.iloc[start:start + chunk_size]
+                else:
+                    chunk = records[start:start + chunk_size]
+                    records[start:start + chunk_size] = [None] * len(chunk)  # release events already consumed
+                    yield chunk
+            del records
+
+
+def write_pickle_chunks(path, out_path, chunk_size):
+    # rewrites the raw file path as consecutive pickles of chunk_size events, the format iter_pickle_chunks reads
+    # without holding all events; written to a temporary file first so an interrupted run leaves no partial file
+    tmp_path = out_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        for chunk in iter_pickle_chunks(path, chunk_size):
+            pickle.dump(chunk, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, out_path)
+
+
+def get_chunked_pickle(path, chunk_size):
+    # the released raw files are single pickles of all events, which can only be unpickled as a whole. They are
+    # converted once per chunk_size, in a child process that alone holds all events while it runs, so the process
+    # ingesting the events only ever holds a chunk of them
+    out_path = os.path.splitext(path)[0] + f'_chunked{chunk_size}.pkl'
+    if not os.path.exists(out_path):
+        import multiprocessing as mp
+        print(f'[INFO] Writing {path} in chunks of {chunk_size} events to {out_path}')
+        proc = mp.get_context('spawn').Process(target=write_pickle_chunks, args=(path, out_path, chunk_size))
+        proc.start()
+        proc.join()
+        assert proc.exitcode == 0, f'Failed to write {out_path}'
+    return out_path
+
+
+class ChunkedCollater(object):
+    # collates Data objects chunk by chunk so that only one chunk of them is alive at a time
+    def __init__(self, collate_fn):
+        self.collate_fn = collate_fn
+        self.chunks = []
+        self.num_graphs = 0
+
+    def append(self, data_list):
+        if len(data_list) == 0:
+            return
+        data, slices = self.collate_fn(data_list)
+        if slices is None:
+            # InMemoryDataset.collate returns a single graph as is, without slices
+            data, slices, _ = collate(data_list[0].__class__, data_list=data_list, increment=False, add_batch=False)
+        self.chunks.append((data, slices))
+        self.num_graphs += len(data_list)
+
+    def __len__(self):
+        return self.num_graphs
+
+    def collate(self):
+        data, slices = self.chunks[0]
+        if len(self.chunks) == 1:
+            return data, slices
+
+        for key in list(slices.keys()):
+            cat_dim = data.__cat_dim__(key, data[key])
+            data[key] = torch.cat([chunk_data[key] for chunk_data, _ in self.chunks], dim=cat_dim)
+
+            key_slices, offset = [slices[key]], slices[key][-1]
+            for _, chunk_slices in self.chunks[1:]:
+                key_slices.append(chunk_slices[key][1:] + offset)
+                offset = offset + chunk_slices[key][-1]
+            slices[key] = torch.cat(key_slices)
+
+            for chunk_data, _ in self.chunks[1:]:
+                del chunk_data[key]
+        self.chunks = [(data, slices)]
+        return data, slices
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch_geometric.nn import BatchNorm
 
 
@@ -76,18 +77,20 @@ class ExtractorMLP(nn.Module):
 
 class FeatEncoder(torch.nn.Module):
 
-    def __init__(self, hidden_size, categorical_feat, scalar_feat, n_categorical_feat_to_use=-1, n_scalar_feat_to_use=-1):
+    def __init__(self, hidden_size, categorical_feat, scalar_feat, n_categorical_feat_to_use=-1, n_scalar_feat_to_use=-1, fold_dim_mapping=False):
         super().__init__()
-        self.embedding_list = torch.nn.ModuleList()
-
         self.num_categorical_feat = len(categorical_feat)
         self.n_categorical_feat_to_use = self.num_categorical_feat if n_categorical_feat_to_use == -1 else n_categorical_feat_to_use
         self.num_scalar_feat_to_use = scalar_feat if n_scalar_feat_to_use == -1 else n_scalar_feat_to_use
+        self.fold_dim_mapping = fold_dim_mapping
+        self.folded = None
 
-        for i in range(self.n_categorical_feat_to_use):
-            num_categories = categorical_feat[i]
-            emb = torch.nn.Embedding(num_categories, hidden_size)
-            self.embedding_list.append(emb)
+        # all categorical features share one table, feature i owns the rows offsets[i]:offsets[i] + categorical_feat[i];
+        # the tables are initialized one by one as separate nn.Embedding would be
+        self.num_categories = list(categorical_feat[:self.n_categorical_feat_to_use])
+        self.embedding = torch.nn.Embedding.from_pretrained(torch.cat([torch.nn.Embedding(n, hidden_size).weight.data for n in self.num_categories]), freeze=False) \
+            if self.num_categories else None
+        self.register_buffer('offsets', torch.tensor([0] + self.num_categories[:-1], dtype=torch.long).cumsum(0), persistent=False)
 
         if self.num_scalar_feat_to_use > 0:
             assert n_scalar_feat_to_use == -1
@@ -98,8 +101,11 @@ class FeatEncoder(torch.nn.Module):
 
     def forward(self, x):
         x_embedding = []
-        for i in range(self.n_categorical_feat_to_use):
-            x_embedding.append(self.embedding_list[i](x[:, i].long()))
+        if self.embedding is not None:
+            index = x[:, :self.n_categorical_feat_to_use].long() + self.offsets
+            if self.fold_dim_mapping and not self.training:
+                return self.folded_forward(x, index)
+            x_embedding.append(self.embedding(index).flatten(1))
 
         if self.num_scalar_feat_to_use > 0:
             x_embedding.append(self.linear(x[:, self.num_categorical_feat:]))
@@ -107,6 +113,31 @@ class FeatEncoder(torch.nn.Module):
         x_embedding = self.dim_mapping(torch.cat(x_embedding, dim=-1))
         return x_embedding
 
+    def folded_forward(self, x, index):
+        # dim_mapping(cat([e_1, ..., e_n, s])) = sum_i W_i e_i + W_s s + b, where W_i e_i is looked up from a table
+        # folded once per weight update (inference only, the folded table is not differentiated)
+        hidden_size = self.embedding.weight.shape[1]
+        key = [(w.data_ptr(), w._version) for w in [self.embedding.weight, self.dim_mapping.weight, self.dim_mapping.bias]]
+        folded = self.folded
+        if folded is None or folded[0] != key:
+            with torch.no_grad():
+                weights = self.dim_mapping.weight[:, :self.n_categorical_feat_to_use * hidden_size].split(hidden_size, dim=1)
+                tables = self.embedding.weight.split(self.num_categories)
+                folded = (key, torch.cat([table @ w.T for table, w in zip(tables, weights)]))
+                self.folded = folded
+
+        out = folded[1][index].sum(dim=1) + self.dim_mapping.bias
+        if self.num_scalar_feat_to_use > 0:
+            out = out + F.linear(self.linear(x[:, self.num_categorical_feat:]), self.dim_mapping.weight[:, -hidden_size:])
+        return out
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved before the tables were fused have one embedding_list.i.weight per categorical feature
+        legacy_keys = [f'{prefix}embedding_list.{i}.weight' for i in range(self.n_categorical_feat_to_use)]
+        if legacy_keys and all(k in state_dict for k in legacy_keys):
+            state_dict[f'{prefix}embedding.weight'] = torch.cat([state_dict.pop(k) for k in legacy_keys])
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
 
 def get_optimizer(clf, extractor, optimizer_config, method_name, warmup):
     # pred_lr = method_config['pred_lr']
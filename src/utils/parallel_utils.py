@@ -0,0 +1,141 @@
+import random
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.multiprocessing as mp
+
+_executor = None
+_local = threading.local()
+# (shared object, num_workers, process pool) of the explainer currently sharded, see get_pool
+_pool = None
+_worker_shared = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=max(torch.get_num_interop_threads(), 2), thread_name_prefix='branch')
+    return _executor
+
+
+def can_run_concurrently(modules):
+    # only branches in eval mode are independent: in training, dropout draws its masks from the global generator
+    # and the batch norms of a module shared by the branches (e.g. masked and original logits of the same clf)
+    # update their running statistics, both in scheduling order
+    return all(not m.training for m in modules)
+
+
+def with_thread_state(fn):
+    # grad mode and autocast are thread local, the worker threads get the state of the calling thread
+    grad_enabled = torch.is_grad_enabled()
+    autocast = [(device, torch.get_autocast_dtype(device)) for device in ['cpu', 'cuda'] if torch.is_autocast_enabled(device)] \
+        if hasattr(torch, 'get_autocast_dtype') else []
+
+    def run():
+        _local.in_branch = True
+        try:
+            with torch.set_grad_enabled(grad_enabled):
+                if not autocast:
+                    return fn()
+                with torch.autocast(device_type=autocast[0][0], dtype=autocast[0][1]):
+                    return fn()
+        finally:
+            _local.in_branch = False
+    return run
+
+
+def run_branches(branches, modules, enabled=True):
+    # runs the independent callables in branches concurrently on CPU and returns their outputs in order. torch ops
+    # release the GIL, so the wall-clock time follows the longest branch. modules[i] is the module branches[i] runs;
+    # training-mode branches (see can_run_concurrently), GPU tensors and branches nested in another branch run
+    # sequentially, so the outputs are the same as calling the branches one after another
+    devices = {p.device.type for m in modules for p in m.parameters()}
+    if not enabled or len(branches) < 2 or devices != {'cpu'} or getattr(_local, 'in_branch', False) \
+            or not can_run_concurrently(modules):
+        return [branch() for branch in branches]
+
+    futures = [get_executor().submit(with_thread_state(branch)) for branch in branches[1:]]
+    first = branches[0]()
+    return [first] + [future.result() for future in futures]
+
+
+def _init_worker(shared, num_threads):
+    global _worker_shared
+    _worker_shared = shared
+    torch.set_num_threads(num_threads)
+
+
+def seed_all(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+@contextmanager
+def preserved_rng_state():
+    # the global generators are left as they were, so seeding inside does not change the draws after the block
+    state = random.getstate(), np.random.get_state()
+    with torch.random.fork_rng(devices=list(range(torch.cuda.device_count())) if torch.cuda.is_available() else []):
+        yield
+    random.setstate(state[0])
+    np.random.set_state(state[1])
+
+
+def _run_task(fn, seed, args):
+    # every graph gets its own seed, so results do not depend on which worker explains it or in which order
+    seed_all(seed)
+    return fn(*args) if _worker_shared is None else fn(_worker_shared, *args)
+
+
+def get_pool(shared, num_workers):
+    # one pool at a time, kept across the batches of the explainer shared. A pool for another explainer (a new seed)
+    # or another number of workers terminates the old one, close_pool terminates it at the end of a run
+    global _pool
+    if _pool is not None and _pool[0] is shared and _pool[1] == num_workers:
+        return _pool[2]
+    close_pool()
+    if shared is not None:
+        # the tensors of shared (classifier weights) are moved to shared memory and read by the workers in place
+        shared.share_memory()
+    num_threads = max(torch.get_num_threads() // num_workers, 1)
+    pool = mp.get_context('spawn').Pool(num_workers, initializer=_init_worker, initargs=(shared, num_threads))
+    _pool = (shared, num_workers, pool)
+    return pool
+
+
+def close_pool():
+    global _pool
+    if _pool is not None:
+        _pool[2].terminate()
+        _pool[2].join()
+        _pool = None
+
+
+def run_per_graph(fn, tasks, sizes, num_workers=0, shared=None):
+    # [fn(shared, *task) for task in tasks] (fn(*task) without shared) with the graphs sharded across num_workers
+    # processes; fn must be picklable by name, e.g. a method looked up on the class. shared is sent once per worker.
+    # Tasks are dispatched largest first (sizes) to the next free worker, so a large graph does not hold back the
+    # rest of a batch, and the results come back in the original order. Without workers (num_workers 0) the graphs
+    # are explained one after the other on the global generators, as before there were workers. With workers every
+    # graph is explained with its own seed drawn from the numpy generator, so the explanations do not depend on the
+    # number of workers, but they differ from those of num_workers 0 for the same seed. Runs sequentially on GPU
+    if num_workers <= 0:
+        return [fn(*task) if shared is None else fn(shared, *task) for task in tasks]
+
+    seeds = np.random.randint(2 ** 31 - 1, size=len(tasks))
+    devices = {p.device.type for p in shared.parameters()} if isinstance(shared, nn.Module) else set()
+    if len(tasks) < 2 or 'cuda' in devices:
+        results = []
+        with preserved_rng_state():
+            for seed, task in zip(seeds, tasks):
+                seed_all(int(seed))
+                results.append(fn(*task) if shared is None else fn(shared, *task))
+        return results
+
+    pool = get_pool(shared, num_workers)
+    order = sorted(range(len(tasks)), key=lambda i: sizes[i], reverse=True)
+    results = {i: pool.apply_async(_run_task, (fn, int(seeds[i]), tasks[i])) for i in order}
+    return [results[i].get() for i in range(len(tasks))]
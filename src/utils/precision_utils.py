@@ -0,0 +1,22 @@
+import functools
+import torch
+
+
+def get_autocast(device, precision):
+    # bf16 autocast of forward passes for --precision bf16 (bf16 matrix units of recent Xeons), a no-op for fp32
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=precision == 'bf16')
+
+
+def to_float(x):
+    return x.float() if torch.is_tensor(x) and x.is_floating_point() else x
+
+
+def float32(fn):
+    # run fn outside of autocast with float32 inputs, for the numerically sensitive pieces (losses, determinants, KL)
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        tensors = [a for a in list(args) + list(kwargs.values()) if torch.is_tensor(a)]
+        device_type = tensors[0].device.type if tensors else 'cpu'
+        with torch.autocast(device_type=device_type, enabled=False):
+            return fn(*[to_float(a) for a in args], **{k: to_float(v) for k, v in kwargs.items()})
+    return wrapper
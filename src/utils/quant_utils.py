@@ -0,0 +1,79 @@
+import time
+from copy import deepcopy
+import numpy as np
+import torch
+import torch.nn as nn
+from torch_geometric.nn import BatchNorm
+from sklearn.metrics import roc_auc_score
+
+# (linear, norm) pairs outside of nn.Sequential where forward applies norm directly to the output of linear
+norm_after_linear = {'EdgeConv': ('post_nn', 'norm'), 'E_GCL_mask': ('node_mlp.2', 'norm')}
+# linears whose weights are read directly (factorized and dense edge MLPs, folded FeatEncoder), they stay in float
+float_linears = {'E_GCL_mask': ['edge_mlp.0'], 'EdgeConv': ['nn.0']}
+
+
+def fold_bn(linear, bn):
+    # bn(linear(x)) in eval mode is an affine map of x, so it can be merged into the weights of linear
+    bn = bn.module if isinstance(bn, BatchNorm) else bn
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    bias = linear.bias if linear.bias is not None else torch.zeros_like(bn.running_mean)
+    linear.weight.data.mul_(scale.view(-1, 1))
+    linear.bias = nn.Parameter((bias - bn.running_mean) * scale + bn.bias)
+
+
+def is_bn(module):
+    return isinstance(module, (BatchNorm, nn.BatchNorm1d))
+
+
+def fold_batch_norms(model):
+    # in place, the model must be in eval mode afterwards since the folded norms are replaced by nn.Identity
+    with torch.no_grad():
+        for module in list(model.modules()):
+            if isinstance(module, nn.Sequential):
+                for i in range(1, len(module)):
+                    if isinstance(module[i - 1], nn.Linear) and is_bn(module[i]):
+                        fold_bn(module[i - 1], module[i])
+                        module[i] = nn.Identity()
+            pair = norm_after_linear.get(type(module).__name__)
+            if pair is not None and is_bn(getattr(module, pair[1])):
+                fold_bn(module.get_submodule(pair[0]), getattr(module, pair[1]))
+                setattr(module, pair[1], nn.Identity())
+    return model
+
+
+def quantize_clf(clf, dtype=torch.qint8):
+    # int8 dynamic-quantized copy of the classifier for CPU inference: batch norms folded into the preceding linears,
+    # linear weights quantized ahead of time and activations quantized on the fly. Inference only, no gradients.
+    qclf = fold_batch_norms(deepcopy(clf).cpu().eval())
+    skip = set()
+    for name, module in qclf.named_modules():
+        subs = float_linears.get(type(module).__name__, []) + (['dim_mapping'] if getattr(module, 'fold_dim_mapping', False) else [])
+        for sub in subs:
+            skip.add(f'{name}.{sub}' if name else sub)
+    names = {name for name, module in qclf.named_modules() if isinstance(module, nn.Linear) and name not in skip}
+    return torch.ao.quantization.quantize_dynamic(qclf, names, dtype=dtype)
+
+
+@torch.no_grad()
+def quantization_drift(clf, qclf, data_loader, device):
+    # accuracy drift of the quantized copy against the float model on the same batches
+    clf.eval()
+    logits, q_logits, labels, elapsed, q_elapsed = [], [], [], 0.0, 0.0
+    for data in data_loader:
+        start = time.perf_counter()
+        logits.append(clf(data.to(device)).cpu())
+        elapsed += time.perf_counter() - start
+        start = time.perf_counter()
+        q_logits.append(qclf(data.cpu()))
+        q_elapsed += time.perf_counter() - start
+        labels.append(data.y.cpu())
+    logits, q_logits, labels = torch.cat(logits), torch.cat(q_logits), torch.cat(labels)
+
+    pred, q_pred = (logits.sigmoid() > 0.5).float(), (q_logits.sigmoid() > 0.5).float()
+    has_both = len(np.unique(labels.numpy())) > 1
+    return {'acc': (pred == labels).float().mean().item(), 'q_acc': (q_pred == labels).float().mean().item(),
+            'auc': roc_auc_score(labels.numpy(), logits.numpy()) if has_both else -1,
+            'q_auc': roc_auc_score(labels.numpy(), q_logits.numpy()) if has_both else -1,
+            'agreement': (pred == q_pred).float().mean().item(),
+            'max_logit_diff': (logits - q_logits).abs().max().item(), 'mean_logit_diff': (logits - q_logits).abs().mean().item(),
+            'sec': elapsed, 'q_sec': q_elapsed}
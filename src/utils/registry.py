@@ -0,0 +1,50 @@
+import sys
+import importlib
+
+# name -> (module, class); a module is only imported the first time one of its names is resolved
+datasets = {'actstrack': ('datasets.actstrack', 'ActsTrack'), 'tau3mu': ('datasets.tau3mu', 'Tau3Mu'),
+            'synmol': ('datasets.synmol', 'SynMol'), 'plbind': ('datasets.plbind', 'PLBind')}
+
+backbones = {'dgcnn': ('backbones.dgcnn', 'DGCNN'), 'pointtrans': ('backbones.pointtrans', 'PointTransformer'),
+             'egnn': ('backbones.egnn', 'EGNN')}
+
+methods = {'lri_bern': ('baselines.inherent.lri_bern', 'LRIBern'), 'lri_gaussian': ('baselines.inherent.lri_gaussian', 'LRIGaussian'),
+           'vgib': ('baselines.inherent.vgib', 'VGIB'), 'ciga': ('baselines.inherent.ciga', 'CIGA'), 'dir': ('baselines.inherent.dir', 'DIR'),
+           'gradcam': ('baselines.posthoc.grads', 'GradCAM'), 'inter_grad': ('baselines.posthoc.grads', 'InterGrad'),
+           'gradx': ('baselines.posthoc.grads', 'GradX'), 'gnnlrp': ('baselines.posthoc.gnnlrp', 'GNNLRP'),
+           'pgexplainer': ('baselines.posthoc.pgexplainer', 'PGExplainer'), 'gnnexplainer': ('baselines.posthoc.gnnexplainer', 'GNNExplainer'),
+           'subgraphx': ('baselines.posthoc.subgraphx', 'SubgraphX'), 'pgmexplainer': ('baselines.posthoc.pgmexplainer', 'PGMExplainer'),
+           'test': ('baselines.test_method', 'Test')}
+
+name_mapping = {name: cls_name for name, (_, cls_name) in methods.items()}
+
+
+def resolve(registry, name):
+    if name not in registry:
+        raise NotImplementedError(f'{name} is not registered.')
+    module_name, cls_name = registry[name]
+    return getattr(importlib.import_module(module_name), cls_name)
+
+
+def get_dataset_class(dataset_name):
+    return resolve(datasets, 'actstrack' if 'actstrack' in dataset_name else dataset_name)
+
+
+def get_backbone_class(model_name):
+    return resolve(backbones, model_name)
+
+
+def get_method_class(method_name):
+    return resolve(methods, method_name)
+
+
+def lazy_getattr(package, name_to_module):
+    # module __getattr__ of a package whose names are imported from their modules on first access, which keeps
+    # importing the package cheap; a resolved name is stored in the package so that this runs once per name
+    def __getattr__(name):
+        if name not in name_to_module:
+            raise AttributeError(f'module {package!r} has no attribute {name!r}')
+        value = getattr(importlib.import_module(name_to_module[name], package), name)
+        setattr(sys.modules[package], name, value)
+        return value
+    return __getattr__
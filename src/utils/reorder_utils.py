@@ -0,0 +1,116 @@
+import torch
+
+
+NODE_KEYS = ['x', 'pos', 'true_pos', 'node_label', 'contact_label', 'pocket_label', 'node_dir', 'track_ids', 'full_res_idx']
+EDGE_KEYS = ['edge_attr', 'edge_label']
+
+
+def quantize(pos, bits):
+    pos_min, pos_max = pos.min(dim=0).values, pos.max(dim=0).values
+    scale = ((1 << bits) - 1) / (pos_max - pos_min).clamp(min=1e-12)
+    return ((pos - pos_min) * scale).round().long()
+
+
+def interleave(coords, bits):
+    key = torch.zeros(coords.shape[0], dtype=torch.long, device=coords.device)
+    dim = coords.shape[1]
+    for b in range(bits - 1, -1, -1):
+        for i in range(dim):
+            key = (key << 1) | ((coords[:, i] >> b) & 1)
+    return key
+
+
+def morton_key(pos, bits=10):
+    return interleave(quantize(pos, bits), bits)
+
+
+def hilbert_key(pos, bits=10):
+    # Skilling, "Programming the Hilbert curve", 2004, vectorized over points
+    X = quantize(pos, bits)
+    dim = X.shape[1]
+    Q = 1 << (bits - 1)
+    while Q > 1:
+        P = Q - 1
+        for i in range(dim):
+            flip = (X[:, i] & Q) != 0
+            t = (X[:, 0] ^ X[:, i]) & P
+            X[:, 0] = torch.where(flip, X[:, 0] ^ P, X[:, 0] ^ t)
+            X[:, i] = torch.where(flip, X[:, i], X[:, i] ^ t)
+        Q >>= 1
+
+    for i in range(1, dim):
+        X[:, i] ^= X[:, i - 1]
+    t = torch.zeros_like(X[:, 0])
+    Q = 1 << (bits - 1)
+    while Q > 1:
+        t = torch.where((X[:, dim - 1] & Q) != 0, t ^ (Q - 1), t)
+        Q >>= 1
+    X ^= t.unsqueeze(1)
+    return interleave(X, bits)
+
+
+class SFCReorder(object):
+    # reorder the nodes of a graph along a space-filling curve of pos and sort edge_index by destination
+    # orig_node_idx[i] is the index in the original graph of the i-th node, see restore_node_order
+    def __init__(self, curve, bits=10):
+        assert curve in ['morton', 'hilbert']
+        self.key_fn = morton_key if curve == 'morton' else hilbert_key
+        self.bits = bits
+
+    def __call__(self, data):
+        num_nodes = data.pos.shape[0]
+        perm = torch.sort(self.key_fn(data.pos, self.bits), stable=True)[1] if num_nodes > 1 else torch.arange(num_nodes)
+        for key in NODE_KEYS:
+            if data.get(key, None) is not None and torch.is_tensor(data[key]) and data[key].shape[0] == num_nodes:
+                data[key] = data[key][perm]
+        data.orig_node_idx = perm
+
+        if data.get('edge_index', None) is not None:
+            inv_perm = torch.empty_like(perm)
+            inv_perm[perm] = torch.arange(num_nodes)
+            edge_index = inv_perm[data.edge_index]
+            edge_perm = (edge_index[1] * num_nodes + edge_index[0]).argsort()
+            data.edge_index = edge_index[:, edge_perm]
+            for key in EDGE_KEYS:
+                if data.get(key, None) is not None:
+                    data[key] = data[key][edge_perm]
+        return data
+
+
+def restore_node_order(values, data):
+    # node values (rows) of a reordered graph or batch back in the original node order, unchanged without node_order
+    if data.get('orig_node_idx', None) is None:
+        return values
+    idx = data.orig_node_idx if data.batch is None else data.orig_node_idx + data.ptr[data.batch]
+    out = torch.empty_like(values)
+    out[idx] = values
+    return out
+
+
+def uncrop_node_values(values, data, fill_value=0):
+    # node values (rows) of cropped PLBind receptors (see CropPocket) spread over every residue of the full receptors,
+    # fill_value for the residues outside the pocket. full_res_idx is reordered with the nodes, so this also restores
+    # the node order
+    num_full_res = data.num_full_res.view(-1)
+    batch = data.batch if data.batch is not None else torch.zeros(values.shape[0], dtype=torch.long, device=values.device)
+    offset = num_full_res.cumsum(dim=0) - num_full_res
+    out = values.new_full((int(num_full_res.sum()),) + tuple(values.shape[1:]), fill_value)
+    out[data.full_res_idx + offset[batch]] = values
+    return out
+
+
+def compose_transforms(*transforms):
+    transforms = [t for t in transforms if t is not None]
+    if len(transforms) == 0:
+        return None
+
+    def transform(data):
+        for t in transforms:
+            data = t(data)
+        return data
+    return transform
+
+
+def get_reorder_transform(data_config):
+    curve = data_config.get('node_order', None)
+    return SFCReorder(curve, bits=data_config.get('node_order_bits', 10)) if curve is not None else None
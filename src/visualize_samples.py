@@ -10,9 +10,9 @@ import torch.nn as nn
 from torch.nn import functional as F
 from eval import FidelEvaluation, AUCEvaluation
 from get_model import Model
-from baselines import LabelPerturb, VGIB, LRIBern, LRIGaussian, CIGA
-from utils import to_cpu, log_epoch, get_data_loaders, set_seed, load_checkpoint, ExtractorMLP, get_optimizer
-from utils import inherent_models, post_hoc_explainers, post_hoc_attribution, name_mapping
+from baselines import LabelPerturb
+from utils import to_cpu, log_epoch, get_data_loaders, restore_node_order, set_seed, load_checkpoint, ExtractorMLP, get_optimizer
+from utils import inherent_models, post_hoc_explainers, post_hoc_attribution, get_method_class
 import torchmetrics
 from torch_geometric.data import Data
 from torch_geometric.loader import DataLoader
@@ -208,10 +208,12 @@ def eval_one_epoch(baseline, data_loader, epoch, phase, seed, signal_class, writ
                 mis += 1
                 fig, ax = plt.subplots(figsize=(10, 8))
                 sparse_attn = control_sparsity(attn, sparsity=eval_metric.sparsity)
+                # the smiles edges index the atoms in their original order
+                sparse_attn, node_label, node_type = [restore_node_order(v, data) for v in [sparse_attn, data.node_label, data.x]]
                 edge_index = get_edges_from_smiles(mol_df.iloc[data.mol_df_idx]['smiles'])
                 # edge_index = knn_graph(data.pos, k=2, batch=data.batch, loop=False)
                 edge_attn = node_attn_to_edge_attn(sparse_attn, edge_index) if baseline.name != 'lri_gaussian' else None
-                visualize_a_graph(edge_index, 1 - edge_attn, data.node_label, data.x, ax, coor=None, norm=False, mol_type=None, nodesize=300)
+                visualize_a_graph(edge_index, 1 - edge_attn, node_label, node_type, ax, coor=None, norm=False, mol_type=None, nodesize=300)
                 # fig.tight_layout()
                 masked_pred = 1 - pred if masked_perf_drop == 1 else pred
                 plt.title(f'label: {label}, pred: {pred}, masked_pred: {masked_pred}, sparsity: {eval_metric.sparsity}')
@@ -256,14 +258,14 @@ def test(config, method_name, exp_method, model_name, backbone_seed, dataset_nam
 
     # establish the model and the metrics
 
-    backbone = eval(name_mapping[method_name])(clf, extractor, criterion, config[method_name]) \
+    backbone = get_method_class(method_name)(clf, extractor, criterion, config[method_name]) \
         if method_name in inherent_models else clf
     assert load_checkpoint(backbone, log_dir, model_name=method_name, seed=backbone_seed, map_location=torch.device('cpu') if not torch.cuda.is_available() else None)
 
     if 'label_perturb' in exp_method:
         model = LabelPerturb(backbone, mode=int(exp_method[-1]))
     else:
-        model = eval(name_mapping[exp_method])(clf, criterion, config[exp_method])
+        model = get_method_class(exp_method)(clf, criterion, config[exp_method])
 
     # metric_list = [FidelEvaluation(backbone, i/10) for i in range(2, 9)]
     main_metric = FidelEvaluation(backbone, 0.8)